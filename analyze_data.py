@@ -1,5 +1,6 @@
 
 import sqlite3
+import sys
 import pandas as pd
 import os
 from dotenv import load_dotenv
@@ -11,6 +12,12 @@ load_dotenv()
 # .envからデータベースのパスを取得
 DB_PATH = os.getenv('DB_FILE_PATH')
 
+# scraping/ のモジュール (snapshot.py など) を読み込めるようにする。
+# 読み込み自体は DB_FILE_PATH を確かめてから関数内で行う
+SCRAPING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scraping')
+if SCRAPING_DIR not in sys.path:
+    sys.path.insert(0, SCRAPING_DIR)
+
 def analyze_database():
     """
     データベースに接続し、簡単な分析を行う。
@@ -25,9 +32,11 @@ def analyze_database():
         return
 
     try:
-        # データベースに接続
-        conn = sqlite3.connect(DB_PATH)
-        print(f"'{DB_PATH}'に正常に接続しました。")
+        # スナップショットがあればそちらを読み取り専用で開き、スクレイピング中の書き込みを妨げない
+        from snapshot import connect_readonly, SNAPSHOT_PATH
+        conn = connect_readonly()
+        source = SNAPSHOT_PATH if os.path.exists(SNAPSHOT_PATH) else DB_PATH
+        print(f"'{source}'に読み取り専用で接続しました。")
 
         # --- 1. テーブル一覧の取得 ---
         print("\n--- データベース内のテーブル一覧 ---")
@@ -106,7 +115,7 @@ def analyze_database():
     finally:
         if 'conn' in locals() and conn:
             conn.close()
-            print(f"\n'{DB_PATH}'との接続を閉じました。")
+            print(f"\n'{source}'との接続を閉じました。")
 
 if __name__ == "__main__":
     analyze_database()
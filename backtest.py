@@ -0,0 +1,290 @@
+import os
+import sys
+import time
+import argparse
+import itertools
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+# .envファイルから環境変数を読み込む
+# このスクリプトはプロジェクトのルートに配置される想定
+load_dotenv()
+
+DB_PATH = os.getenv('DB_FILE_PATH')
+
+# scraping/ のモジュール (snapshot.py など) を読み込めるようにする。
+# 読み込み自体は DB_FILE_PATH を確かめてから関数内で行う
+SCRAPING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scraping')
+if SCRAPING_DIR not in sys.path:
+    sys.path.insert(0, SCRAPING_DIR)
+
+# 買い方の条件 (bet_type: win / place, staking: flat / kelly)
+Strategy = namedtuple('Strategy', ['bet_type', 'min_ev', 'min_prob', 'max_odds', 'top_k', 'staking'])
+
+# スイープする条件の既定値 (組み合わせすべてを評価する)
+SWEEP_GRID = {
+    'bet_type': ['win', 'place'],
+    'min_ev': [0.0, 0.8, 1.0, 1.2, 1.5],
+    'min_prob': [0.0, 0.1, 0.2],
+    'max_odds': [10.0, 30.0, 1000.0],
+    'top_k': [1, 2, 3],
+    'staking': ['flat', 'kelly'],
+}
+# 複勝の配当はDBにないため、単勝オッズから推定する (1 + (単勝 - 1) × 係数、下限1.1倍)
+PLACE_ODDS_RATIO = 0.25
+MIN_PLACE_ODDS = 1.1
+# ケリー基準で賭ける割合 (資金100に対するケリーの値×この係数、複利にはしない)
+KELLY_FRACTION = 0.25
+KELLY_BANKROLL = 100.0
+# レーティングから勝率を求めるときの騎手の重み
+JOCKEY_WEIGHT = 0.5
+# 1プロセスで一度に評価する条件の数
+STRATEGIES_PER_TASK = 16
+
+RUNS_QUERY = '''
+SELECT r.race_id, ra.date, ra.venue, ra.race_class, ra.entries, r.horse_no, r.rank, r.odds,
+       rh.horse_rating, rh.jockey_rating
+FROM results r
+JOIN races ra ON ra.race_id = r.race_id
+LEFT JOIN horse_keys hk ON hk.horse_id = r.horse_id
+LEFT JOIN rating_history rh ON rh.race_id = r.race_id AND rh.horse_key = hk.key
+WHERE ra.date IS NOT NULL {condition}
+ORDER BY ra.date, r.race_id, r.horse_no
+'''
+
+def load_runs(conn, signal='rating', predictions=None, since=None):
+    """出走ごとの結果と予測の勝率 (prob) を読み込む
+
+    signal は 'rating' (出走前のレーティングから求めた勝率) または 'market' (単勝オッズの逆数)。
+    predictions に race_id, horse_no, prob の列を持つcsvを指定するとその予測を使う。
+    """
+    condition, params = ('AND ra.date >= ?', (since,)) if since else ('', ())
+    df = pd.read_sql_query(RUNS_QUERY.format(condition=condition), conn, params=params)
+    if predictions:
+        preds = pd.read_csv(predictions, dtype={'race_id': str})
+        df = df.merge(preds[['race_id', 'horse_no', 'prob']], on=['race_id', 'horse_no'], how='left')
+        weight = df['prob'].fillna(0).to_numpy(float)
+    elif signal == 'market':
+        weight = np.nan_to_num(1 / df['odds'].to_numpy(float), nan=0.0, posinf=0.0)
+    else:
+        # Eloの期待勝率は 10^(R/400) に比例する (未評価は初期値とみなす)
+        strength = df['horse_rating'].fillna(1500).to_numpy(float) + JOCKEY_WEIGHT * (df['jockey_rating'].fillna(1500).to_numpy(float) - 1500)
+        weight = 10 ** ((strength - 1500) / 400)
+    race_codes = pd.factorize(df['race_id'])[0]
+    totals = np.bincount(race_codes, weights=weight)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        df['prob'] = weight / totals[race_codes]
+    return df
+
+def build_arrays(df):
+    """出走のDataFrameをレース単位の計算用の配列にまとめる
+
+    出走はレース順 (日付順) に並んでいる前提。レース内の予測順位は
+    (レース数, 最大頭数) の配列に並べて一度に求める。
+    """
+    race_codes, race_ids = pd.factorize(df['race_id'])
+    starts = np.flatnonzero(np.diff(race_codes, prepend=-1))
+    counts = np.diff(np.append(starts, len(race_codes)))
+    runner_pos = np.arange(len(race_codes)) - np.repeat(starts, counts)
+
+    prob = df['prob'].fillna(0).to_numpy(float)
+    grid = np.full((len(starts), int(counts.max()) if len(counts) else 0), -np.inf)
+    grid[race_codes, runner_pos] = prob
+    order = np.argsort(-grid, axis=1, kind='stable')
+    grid_rank = np.empty_like(order)
+    np.put_along_axis(grid_rank, order, np.arange(grid.shape[1])[None, :], axis=1)
+
+    odds = df['odds'].to_numpy(float)
+    rank = df['rank'].to_numpy(float)
+    entries = df['entries'].fillna(0).to_numpy(float)
+    # 8頭以上は3着まで、7頭以下は2着までが複勝の的中
+    places = np.where(entries >= 8, 3, 2)
+    races = df.iloc[starts]
+    return {
+        'race': race_codes,
+        'prob': prob,
+        'prob_rank': grid_rank[race_codes, runner_pos] + 1,
+        'odds': odds,
+        'place_odds': np.maximum(MIN_PLACE_ODDS, 1 + (odds - 1) * PLACE_ODDS_RATIO),
+        'win_hit': rank == 1,
+        'place_hit': rank <= places,
+        # 複勝が発売されない4頭以下のレースは複勝の対象にしない
+        'place_sold': entries >= 5,
+        'n_races': len(starts),
+        'race_ids': np.asarray(race_ids),
+        'year': races['date'].str[:4].to_numpy(),
+        'venue': races['venue'].fillna('').to_numpy(),
+        'race_class': races['race_class'].fillna('').to_numpy(),
+    }
+
+def bet_stakes(arrays, strategy):
+    """条件に合う出走への賭け金・的中・払戻倍率の配列を返す (賭けない出走は賭け金0)"""
+    prob, odds = arrays['prob'], arrays['odds']
+    ev = prob * odds
+    selected = (
+        (arrays['prob_rank'] <= strategy.top_k) & (ev >= strategy.min_ev)
+        & (prob >= strategy.min_prob) & (odds <= strategy.max_odds) & (odds > 1)
+    )
+    if strategy.bet_type == 'win':
+        hit, payout = arrays['win_hit'], odds
+    else:
+        hit, payout = arrays['place_hit'], arrays['place_odds']
+        selected &= arrays['place_sold']
+
+    if strategy.staking == 'kelly':
+        # 単勝の勝率に対するケリー基準 (期待値が1未満なら賭けない)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            kelly = np.clip((ev - 1) / (odds - 1), 0, 1)
+        stake = np.where(selected, np.nan_to_num(kelly) * KELLY_FRACTION * KELLY_BANKROLL, 0.0)
+    else:
+        stake = selected.astype(float)
+    return stake, hit, payout
+
+def race_totals(arrays, strategy):
+    """レースごとの賭け金・払戻・賭けた数・的中数を返す"""
+    stake, hit, payout = bet_stakes(arrays, strategy)
+    race, n = arrays['race'], arrays['n_races']
+    returns = np.where(hit, stake * np.nan_to_num(payout), 0.0)
+    bets = stake > 0
+    return (
+        np.bincount(race, weights=stake, minlength=n),
+        np.bincount(race, weights=returns, minlength=n),
+        np.bincount(race, weights=bets, minlength=n),
+        np.bincount(race, weights=bets & hit, minlength=n),
+    )
+
+def max_drawdowns(codes, profit, n_groups):
+    """グループごとに、レース順の累積収支の最大ドローダウンを返す
+
+    グループごとに並べ替えて累積和を取り、グループ番号に応じた大きな値を足して
+    累積最大値がグループをまたがないようにする。
+    """
+    order = np.argsort(codes, kind='stable')
+    codes, profit = codes[order], profit[order]
+    starts = np.flatnonzero(np.diff(codes, prepend=-1))
+    cum = np.cumsum(profit)
+    base = np.repeat(cum[starts] - profit[starts], np.diff(np.append(starts, len(cum))))
+    cum -= base
+    # 0 (賭ける前の資金) を起点にした下落も含める
+    peak_offset = codes * (2 * np.abs(cum).max() + 1 if len(cum) else 0)
+    running_peak = np.maximum.accumulate(np.maximum(cum, 0) + peak_offset) - peak_offset
+    drawdowns = np.zeros(n_groups)
+    if len(cum):
+        drawdowns[codes[starts]] = np.maximum.reduceat(running_peak - cum, starts)
+    return drawdowns
+
+def summarize(arrays, strategies, by=()):
+    """条件ごとに全体と、by の列 (year / venue / race_class) 別の成績を集計する"""
+    rows = []
+    dims = [('all', np.zeros(arrays['n_races'], dtype=np.int64), np.array(['all']))]
+    for dim in by:
+        codes, labels = pd.factorize(arrays[dim])
+        dims.append((dim, codes, np.asarray(labels)))
+
+    for strategy in strategies:
+        stake, returns, bets, hits = race_totals(arrays, strategy)
+        for dim, codes, labels in dims:
+            n = len(labels)
+            group_stake = np.bincount(codes, weights=stake, minlength=n)
+            group_return = np.bincount(codes, weights=returns, minlength=n)
+            group_bets = np.bincount(codes, weights=bets, minlength=n)
+            group_hits = np.bincount(codes, weights=hits, minlength=n)
+            group_races = np.bincount(codes, weights=bets > 0, minlength=n)
+            drawdown = max_drawdowns(codes, returns - stake, n)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                roi = group_return / group_stake
+                hit_rate = group_hits / group_bets
+            for i, label in enumerate(labels):
+                rows.append({
+                    **strategy._asdict(), 'dim': dim, 'group': label,
+                    'races': int(group_races[i]), 'bets': int(group_bets[i]),
+                    'stake': group_stake[i], 'return': group_return[i],
+                    'roi': roi[i], 'hit_rate': hit_rate[i], 'max_drawdown': drawdown[i],
+                })
+    return rows
+
+# --- プロセスプールでのスイープ ---
+# 各プロセスは初期化時に配列を1回だけ受け取り、条件のまとまりごとに集計を返す
+
+_arrays = None
+
+def _init_worker(arrays):
+    global _arrays
+    _arrays = arrays
+
+def _summarize_chunk(strategies, by):
+    return summarize(_arrays, strategies, by)
+
+def sweep_strategies(grid=SWEEP_GRID):
+    """グリッドの組み合わせから条件の一覧を作る (複勝のケリー基準は除く)"""
+    return [
+        Strategy(**dict(zip(grid, values)))
+        for values in itertools.product(*grid.values())
+        if not (values[0] == 'place' and values[-1] == 'kelly')
+    ]
+
+def run_sweep(arrays, strategies, by=(), workers=None):
+    """条件を複数プロセスに分けて評価し、結果をDataFrameで返す"""
+    chunks = [strategies[i:i + STRATEGIES_PER_TASK] for i in range(0, len(strategies), STRATEGIES_PER_TASK)]
+    if workers == 1 or len(chunks) == 1:
+        return pd.DataFrame(summarize(arrays, strategies, by))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(arrays,)) as executor:
+        results = executor.map(_summarize_chunk, chunks, itertools.repeat(by))
+        return pd.DataFrame([row for rows in results for row in rows])
+
+def main():
+    parser = argparse.ArgumentParser(description='過去の結果で単勝・複勝の買い方をまとめて検証する')
+    parser.add_argument('--signal', choices=['rating', 'market'], default='rating',
+                        help='予測の勝率 (rating: 出走前のレーティング, market: 単勝オッズ)')
+    parser.add_argument('--predictions', help='予測のcsv (race_id, horse_no, prob の列)。指定すると --signal より優先')
+    parser.add_argument('--since', help='この日付 (YYYY-MM-DD) 以降のレースだけを使う')
+    parser.add_argument('--by', nargs='*', choices=['year', 'venue', 'race_class'], default=['year'],
+                        help='成績を分けて表示する列')
+    parser.add_argument('--workers', type=int, default=None, help='スイープに使うプロセス数 (既定はCPU数)')
+    parser.add_argument('--top', type=int, default=10, help='表示する上位の条件数')
+    parser.add_argument('--min-bets', type=int, default=100, help='上位に含める条件の最小の賭け数')
+    parser.add_argument('--output', help='全条件の集計をcsvで書き出すパス')
+    args = parser.parse_args()
+
+    if not DB_PATH:
+        print("エラー: .envファイルにDB_FILE_PATHが設定されていません。")
+        return
+
+    # スナップショットがあればそちらを読み取り専用で開き、スクレイピング中の書き込みを妨げない
+    from snapshot import connect_readonly
+    conn = connect_readonly()
+    try:
+        start = time.perf_counter()
+        df = load_runs(conn, args.signal, args.predictions, args.since)
+    finally:
+        conn.close()
+    if df.empty:
+        print("検証に使えるレースがありません。")
+        return
+    arrays = build_arrays(df)
+    print(f"Loaded {len(df)} runs in {arrays['n_races']} races ({time.perf_counter() - start:.1f} s).")
+
+    strategies = sweep_strategies()
+    start = time.perf_counter()
+    report = run_sweep(arrays, strategies, tuple(args.by), args.workers)
+    print(f"Evaluated {len(strategies)} strategies in {time.perf_counter() - start:.1f} s.")
+    if args.output:
+        report.to_csv(args.output, index=False)
+
+    overall = report[(report['dim'] == 'all') & (report['bets'] >= args.min_bets)]
+    best = overall.sort_values('roi', ascending=False).head(args.top)
+    columns = list(Strategy._fields) + ['races', 'bets', 'roi', 'hit_rate', 'max_drawdown']
+    print("\n--- 回収率の上位 ---")
+    print(best[columns].round(3).to_string(index=False))
+    if not best.empty:
+        top = best.iloc[0]
+        detail = report[(report[list(Strategy._fields)] == top[list(Strategy._fields)]).all(axis=1) & (report['dim'] != 'all')]
+        for dim in args.by:
+            print(f"\n--- 最上位の条件の {dim} 別 ---")
+            print(detail[detail['dim'] == dim][['group', 'races', 'bets', 'roi', 'hit_rate', 'max_drawdown']].round(3).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+HEAVY = ('pandas', 'numpy', 'selenium', 'webdriver_manager')
+
+# (名前, keibaへの引数, 読み込まれてはいけないモジュール)
+CASES = [
+    ('keiba --help', ['--help'], HEAVY),
+    ('race --help', ['race', '--help'], HEAVY),
+    ('race-ids --help', ['race-ids', '--help'], HEAVY),
+    ('horse --help', ['horse', '--help'], HEAVY),
+    ('person --help', ['person', '--help'], HEAVY),
+    ('backfill --help', ['backfill', '--help'], HEAVY),
+    ('shard --help', ['shard', '--help'], HEAVY),
+    ('live-odds --help', ['live-odds', '--help'], HEAVY),
+    ('snapshot --help', ['snapshot', '--help'], HEAVY),
+    # 取得待ちがない場合はブラウザもpandasも読み込まずに終わること
+    ('person (nothing to do)', ['person'], HEAVY),
+    ('horse (nothing to do)', ['horse'], HEAVY),
+]
+
+def imported_modules(importtime_log):
+    """python -X importtime の出力から読み込まれたトップレベルのモジュール名を集める"""
+    modules = set()
+    for line in importtime_log.splitlines():
+        if not line.startswith('import time:') or line.rstrip().endswith('imported package'):
+            continue
+        name = line.rsplit('|', 1)[-1].strip()
+        if name:
+            modules.add(name.split('.')[0])
+    return modules
+
+def run_case(argv, env, repeat):
+    """コマンドをrepeat回実行し、所要時間(ms)の中央値と読み込まれたモジュールを返す"""
+    timings = []
+    modules = set()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-m', 'keiba'] + argv,
+            cwd=ROOT, env=env, capture_output=True, text=True,
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+        modules |= imported_modules(proc.stderr)
+        if proc.returncode != 0:
+            raise RuntimeError(f"keiba {' '.join(argv)} failed:\n{proc.stdout}\n{proc.stderr}")
+    return statistics.median(timings), modules
+
+def run_checks(repeat, max_ms):
+    workdir = tempfile.mkdtemp(prefix='keiba_cold_')
+    env = dict(os.environ, DB_FILE_PATH=os.path.join(workdir, 'keiba.db'), PYTHONDONTWRITEBYTECODE='1')
+    # 取得待ちが空のDBを用意する
+    subprocess.run([sys.executable, '-m', 'keiba', 'init'], cwd=ROOT, env=env, capture_output=True, check=True)
+
+    report = []
+    for name, argv, forbidden in CASES:
+        median_ms, modules = run_case(argv, env, repeat)
+        loaded = sorted(set(forbidden) & modules)
+        ok = not loaded and (max_ms is None or median_ms <= max_ms)
+        report.append({'case': name, 'median_ms': round(median_ms, 1), 'forbidden_loaded': loaded, 'ok': ok})
+    return report
+
+def print_report(report, max_ms):
+    print(f"{'case':<26} {'median ms':>10}  result")
+    for row in report:
+        status = 'ok' if row['ok'] else 'FAIL'
+        detail = f" (loaded: {', '.join(row['forbidden_loaded'])})" if row['forbidden_loaded'] else ''
+        print(f"{row['case']:<26} {row['median_ms']:>10.1f}  {status}{detail}")
+    if max_ms is not None:
+        print(f"\nbudget: {max_ms:.0f} ms per command")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='keiba CLIの起動時間と重い依存の読み込みを確認する')
+    parser.add_argument('--repeat', type=int, default=5, help='各コマンドの実行回数 (中央値を取る)')
+    parser.add_argument('--max-ms', type=float, default=None, help='この時間を超えたコマンドを失敗とする')
+    parser.add_argument('--json', help='結果をJSONで書き出すパス')
+    args = parser.parse_args()
+
+    report = run_checks(args.repeat, args.max_ms)
+    print_report(report, args.max_ms)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(0 if all(row['ok'] for row in report) else 1)
@@ -0,0 +1,224 @@
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import functools
+
+from stub_server import StubConfig, start_server
+
+SCRAPING_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scraping'))
+SCENARIOS = ['scrape_year', 'scrape_missing_horses', 'scraper_person_details']
+
+# DB書き込み件数として数えるテーブル
+COUNTED_TABLES = ['races', 'results', 'jockeys', 'trainers', 'horses', 'pedigrees', 'owners', 'breeders']
+
+class ParseTimer:
+    """HTMLのパースと抽出にかかった時間を集計する"""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.pages = 0
+
+    def wrap(self, func, count_page=False):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds += time.perf_counter() - start
+                if count_page:
+                    self.pages += 1
+        return timed
+
+    def instrument(self, module, parse_funcs, soup_func='make_soup'):
+        """モジュール内のsoup生成関数と解析関数を計測用に差し替える"""
+        setattr(module, soup_func, self.wrap(getattr(module, soup_func), count_page=True))
+        for name in parse_funcs:
+            setattr(module, name, self.wrap(getattr(module, name)))
+
+class HttpDriver:
+    """Seleniumの代わりにrequestsでページを取得する、ベンチマーク用の簡易ドライバ"""
+
+    def __init__(self):
+        import requests
+        self.session = requests.Session()
+        self.title = ""
+        self.page_source = ""
+
+    def get(self, url):
+        response = self.session.get(url, timeout=10)
+        self.page_source = response.text
+        match = re.search(r'<title>(.*?)</title>', self.page_source, re.S)
+        self.title = match.group(1) if match else ("エラー" if response.status_code >= 400 else "")
+
+    def quit(self):
+        self.session.close()
+
+def peak_rss_kb():
+    """プロセスのピークRSS(KB)を返す (Linux以外ではNone)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_child(scenario, server_url, workdir, year, keep_sleep):
+    """1シナリオを実行し、結果をworkdir内のJSONに書き出す"""
+    os.chdir(workdir)
+    sys.path.insert(0, SCRAPING_DIR)
+    if not keep_sleep:
+        # 固定待機を除いた処理能力を測る
+        time.sleep = lambda seconds: None
+
+    timer = ParseTimer()
+    start = time.perf_counter()
+    if scenario == 'scrape_year':
+        import scraper_race
+        scraper_race.BASE_URL = f"{server_url}/race/result/"
+        timer.instrument(scraper_race, ['parse_race_info', 'parse_race_results'])
+        scraper_race.scrape_year(year)
+    elif scenario == 'scrape_missing_horses':
+        import scraper_horse
+        scraper_horse.BASE_URL = f"{server_url}/horse/"
+        timer.instrument(scraper_horse, ['parse_horse_page', 'parse_pedigree'])
+        scraper_horse.scrape_missing_horses()
+    elif scenario == 'scraper_person_details':
+        import scraper_person_details
+        import crosswalk
+        scraper_person_details.NETKEIBA_DB_URL = f"{server_url}/"
+        crosswalk.NETKEIBA_RACE_URL = f"{server_url}/"
+        timer.instrument(scraper_person_details, ['parse_person_profile'], soup_func='BeautifulSoup')
+        driver = HttpDriver()
+        try:
+            crosswalk.resolve()
+            scraper_person_details.scrape_jockeys(driver)
+            scraper_person_details.scrape_trainers(driver)
+        finally:
+            driver.quit()
+    elapsed = time.perf_counter() - start
+
+    with open(os.path.join(workdir, f'result_{scenario}.json'), 'w', encoding='utf-8') as f:
+        json.dump({
+            'elapsed': elapsed,
+            'parse_seconds': timer.seconds,
+            'parsed_pages': timer.pages,
+            'peak_rss_kb': peak_rss_kb(),
+        }, f)
+
+def count_rows(db_path):
+    """テーブルごとの件数を返す (騎手・調教師は詳細取得済みの件数も含める)"""
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.cursor()
+        counts = {t: cursor.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in COUNTED_TABLES}
+        for t in ('jockeys', 'trainers'):
+            counts[f'{t}_detailed'] = cursor.execute(f"SELECT COUNT(*) FROM {t} WHERE birth_date IS NOT NULL").fetchone()[0]
+        return counts
+    finally:
+        conn.close()
+
+def write_race_csv(workdir, year, n_races):
+    """ベンチマーク用のレースID一覧CSVを作成する (1日36レース)"""
+    csv_dir = os.path.join(workdir, 'scraping', 'race_csv')
+    os.makedirs(csv_dir, exist_ok=True)
+    venues = ['05', '06', '09']
+    with open(os.path.join(csv_dir, f'race_ids_{year}.csv'), 'w', encoding='utf-8') as f:
+        for i in range(n_races):
+            day, rest = divmod(i, 36)
+            venue, race_round = divmod(rest, 12)
+            race_id = f"{year}{venues[venue]}01{day + 1:02d}{race_round + 1:02d}"
+            date_str = f"{year}-{1 + day // 28:02d}-{1 + day % 28:02d}"
+            f.write(f"{race_id},{date_str}\n")
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='keiba_bench_')
+    db_path = os.path.join(workdir, 'keiba.db')
+    os.environ['DB_FILE_PATH'] = db_path
+
+    sys.path.insert(0, SCRAPING_DIR)
+    import initialize_db
+    initialize_db.create_tables()
+    write_race_csv(workdir, args.year, args.races)
+
+    config = StubConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.no_data_rate, args.rate_limit)
+    server, stats = start_server(config)
+    server_url = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"Stub server: {server_url}  workdir: {workdir}")
+
+    report = {}
+    try:
+        for scenario in args.scenarios:
+            rows_before = count_rows(db_path)
+            requests_before = sum(stats.snapshot()['counts'].values())
+            cmd = [sys.executable, os.path.abspath(__file__), '--child', scenario,
+                   '--server-url', server_url, '--workdir', workdir, '--year', str(args.year)]
+            if args.keep_sleep:
+                cmd.append('--keep-sleep')
+            subprocess.run(cmd, check=True, stdout=None if args.verbose else subprocess.DEVNULL,
+                           stderr=None if args.verbose else subprocess.DEVNULL)
+
+            with open(os.path.join(workdir, f'result_{scenario}.json'), encoding='utf-8') as f:
+                result = json.load(f)
+            rows_after = count_rows(db_path)
+            rows_written = sum(rows_after[t] - rows_before[t] for t in rows_after)
+            pages = sum(stats.snapshot()['counts'].values()) - requests_before
+            elapsed = result['elapsed']
+            report[scenario] = {
+                'pages': pages,
+                'pages_per_sec': pages / elapsed if elapsed else 0.0,
+                'parse_ms_per_page': result['parse_seconds'] * 1000 / result['parsed_pages'] if result['parsed_pages'] else 0.0,
+                'db_rows': rows_written,
+                'db_rows_per_sec': rows_written / elapsed if elapsed else 0.0,
+                'peak_rss_mb': result['peak_rss_kb'] / 1024 if result['peak_rss_kb'] else None,
+                'elapsed_sec': elapsed,
+            }
+    finally:
+        server.shutdown()
+
+    report['_server'] = stats.snapshot()
+    return report
+
+def print_report(report):
+    print(f"\n{'scenario':<24}{'pages':>7}{'pages/s':>10}{'parse ms/pg':>13}{'rows':>8}{'rows/s':>10}{'peak MB':>9}{'sec':>8}")
+    for scenario in SCENARIOS:
+        r = report.get(scenario)
+        if not r:
+            continue
+        rss = f"{r['peak_rss_mb']:.1f}" if r['peak_rss_mb'] is not None else '-'
+        print(f"{scenario:<24}{r['pages']:>7}{r['pages_per_sec']:>10.1f}{r['parse_ms_per_page']:>13.2f}"
+              f"{r['db_rows']:>8}{r['db_rows_per_sec']:>10.1f}{rss:>9}{r['elapsed_sec']:>8.2f}")
+    print(f"server responses: {report['_server']['counts']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='スクレイパーのオフラインベンチマーク')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--races', type=int, default=36, help='scrape_yearで処理するレース数')
+    parser.add_argument('--year', type=int, default=2023)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--no-data-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=0.0)
+    parser.add_argument('--keep-sleep', action='store_true', help='スクレイパー内の待機時間も含めて計測する')
+    parser.add_argument('--json', help='結果をJSONで書き出すパス')
+    parser.add_argument('--verbose', action='store_true', help='スクレイパーの出力を表示する')
+    # 子プロセス用の内部オプション
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--server-url', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.server_url, args.workdir, args.year, args.keep_sleep)
+    else:
+        report = run_benchmark(args)
+        print_report(report)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,156 @@
+import os
+import re
+import time
+import random
+import zlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# パス -> (フィクスチャファイル, Content-Typeのcharset)
+ROUTES = [
+    (re.compile(r'^/race/result/(\d{8})/(\d{3})/(\d{2})/$'), 'race_result.html', 'utf-8'),
+    (re.compile(r'^/horse/(\w+)/pedigree/$'), 'horse_pedigree.html', 'utf-8'),
+    (re.compile(r'^/horse/(\w+)/$'), 'horse_profile.html', 'utf-8'),
+    (re.compile(r'^/(?:jockey|trainer)/prof/(\w+)/$'), 'person_profile.html', 'euc-jp'),
+    (re.compile(r'^/race/result\.html$'), 'netkeiba_result.html', 'euc-jp'),
+]
+
+class StubConfig:
+    """スタブサーバーの応答条件 (遅延・エラー率・レート制限)"""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, no_data_rate=0.0, rate_limit=0.0, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.no_data_rate = no_data_rate
+        self.rate_limit = rate_limit  # 1秒あたりの許容リクエスト数 (0は無制限)
+        self.random = random.Random(seed)
+
+class StubStats:
+    """スタブサーバーが返した応答の集計"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.bytes_sent = 0
+
+    def add(self, status, size):
+        with self.lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+            self.bytes_sent += size
+
+    def snapshot(self):
+        with self.lock:
+            return {'counts': dict(self.counts), 'bytes_sent': self.bytes_sent}
+
+def load_fixtures():
+    """フィクスチャを生バイト列のまま読み込む"""
+    fixtures = {}
+    for name in os.listdir(FIXTURE_DIR):
+        if name.endswith('.html'):
+            with open(os.path.join(FIXTURE_DIR, name), 'rb') as f:
+                fixtures[name] = f.read()
+    return fixtures
+
+def render(template, key):
+    """フィクスチャ中のプレースホルダを置換する
+
+    {{KEY}} はURLから導出した8桁の値に置換され、レースごとに異なる馬IDになる。
+    """
+    key_digits = f"{zlib.crc32(key.encode()) % 10**8:08d}"
+    return template.replace(b'{{KEY}}', key_digits.encode()).replace(b'{{ID}}', key.encode())
+
+def make_handler(config, stats, fixtures):
+    bucket = {'tokens': config.rate_limit, 'updated': time.monotonic()}
+    bucket_lock = threading.Lock()
+
+    def take_token():
+        if config.rate_limit <= 0:
+            return True
+        with bucket_lock:
+            now = time.monotonic()
+            bucket['tokens'] = min(config.rate_limit, bucket['tokens'] + (now - bucket['updated']) * config.rate_limit)
+            bucket['updated'] = now
+            if bucket['tokens'] >= 1:
+                bucket['tokens'] -= 1
+                return True
+            return False
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # keep-alive時にヘッダと本文の分割送信で遅延ACK待ちが発生しないようにする
+        disable_nagle_algorithm = True
+
+        def _send(self, status, body, charset='utf-8', headers=None):
+            self.send_response(status)
+            self.send_header('Content-Type', f'text/html; charset={charset}')
+            self.send_header('Content-Length', str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+            stats.add(status, len(body))
+
+        def do_GET(self):
+            if not take_token():
+                self._send(429, b'Too Many Requests', headers={'Retry-After': '1'})
+                return
+
+            delay = config.latency_ms + config.random.uniform(0, config.jitter_ms)
+            if delay > 0:
+                time.sleep(delay / 1000)
+
+            if config.random.random() < config.error_rate:
+                self._send(503, b'Service Unavailable')
+                return
+
+            path = self.path.split('?', 1)[0]
+            for pattern, name, charset in ROUTES:
+                match = pattern.match(path)
+                if not match:
+                    continue
+                if config.random.random() < config.no_data_rate:
+                    self._send(200, fixtures['no_data.html'])
+                    return
+                key = match.group(1) if match.lastindex == 1 else path
+                self._send(200, render(fixtures[name], key), charset=charset)
+                return
+            self._send(404, b'Not Found')
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+def start_server(config, host='127.0.0.1', port=0):
+    """スタブサーバーを別スレッドで起動し、(server, stats) を返す"""
+    stats = StubStats()
+    server = ThreadingHTTPServer((host, port), make_handler(config, stats, load_fixtures()))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='JBIS/netkeibaのローカル代替サーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='応答ごとの固定遅延(ms)')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='応答ごとのランダム遅延の上限(ms)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='503を返す割合')
+    parser.add_argument('--no-data-rate', type=float, default=0.0, help='「該当データなし」ページを返す割合')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='1秒あたりの許容リクエスト数 (超過分は429)')
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.no_data_rate, args.rate_limit)
+    server, stats = start_server(config, args.host, args.port)
+    print(f"Stub server listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print(stats.snapshot())
+        server.shutdown()
@@ -0,0 +1 @@
+"""各スクリプトをサブコマンドとして実行する統合CLI (python -m keiba <command>)"""
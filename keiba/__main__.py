@@ -0,0 +1,4 @@
+import sys
+from keiba.cli import main
+
+sys.exit(main())
@@ -0,0 +1,60 @@
+import os
+import sys
+import runpy
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# サブコマンド名 -> (スクリプトのパス, 概要)
+# 各スクリプトは実行するサブコマンドが決まってから読み込むため、
+# pandas や Selenium は使うコマンドでだけ読み込まれる。
+COMMANDS = {
+    'init': ('scraping/initialize_db.py', 'データベースとテーブルの初期化'),
+    'race-ids': ('scraping/get_race_ids.py', '年ごとのレースIDと日付をcsvに出力'),
+    'race': ('scraping/scraper_race.py', 'csvのレースIDからレース結果を取得'),
+    'horse': ('scraping/scraper_horse.py', '馬のプロフィールと血統を取得'),
+    'person': ('scraping/scraper_person_details.py', '騎手・調教師の詳細を取得'),
+    'crosswalk': ('scraping/crosswalk.py', 'JBISとnetkeibaのIDの対応を解決'),
+    'backfill': ('scraping/backfill.py', '複数年分を一括で取得'),
+    'shard': ('scraping/shard.py', '複数プロセスでの分担取得'),
+    'live-odds': ('scraping/live_odds.py', '当日のオッズ・馬体重を定期取得'),
+    'series': ('scraping/series_store.py', '馬体重・オッズの系列を圧縮保存'),
+    'speed': ('scraping/speed_figures.py', '基準タイムと馬場差からスピード指数を計算'),
+    'laps': ('scraping/lap_times.py', 'ハロンタイムの取得し直しとペースの集計'),
+    'ratings': ('scraping/ratings.py', '馬・騎手・調教師のレーティングを更新'),
+    'names': ('scraping/name_index.py', '馬名の検索索引の作成と検索'),
+    'pedigree': ('scraping/pedigree_similarity.py', '血統の似た馬の署名の作成と検索'),
+    'conditions': ('scraping/race_conditions.py', '同じ条件の過去レースの索引の更新と検索'),
+    'snapshot': ('scraping/snapshot.py', '分析用の読み取り専用コピーを作成'),
+    'keys': ('scraping/entity_keys.py', 'IDと整数キーの対応表を表示'),
+    'migrate-results': ('scraping/migrate_results_typed.py', '通過順・着差を数値列に変換'),
+    'analyze': ('analyze_data.py', 'データベースの簡単な分析'),
+    'predict': ('predict_service.py', '出馬表の予測 (CLI / HTTP)'),
+    'backtest': ('backtest.py', '過去の結果で買い方を検証'),
+}
+
+def usage():
+    lines = ['usage: python -m keiba <command> [args...]', '', 'commands:']
+    width = max(len(name) for name in COMMANDS)
+    for name, (_, summary) in COMMANDS.items():
+        lines.append(f"  {name:<{width}}  {summary}")
+    lines.append('')
+    lines.append("各コマンドの引数は 'python -m keiba <command> --help' で表示")
+    return '\n'.join(lines)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0
+    command, args = argv[0], argv[1:]
+    if command not in COMMANDS:
+        print(f"Unknown command: {command}\n", file=sys.stderr)
+        print(usage(), file=sys.stderr)
+        return 2
+
+    script = os.path.normpath(os.path.join(ROOT, COMMANDS[command][0]))
+    # スクリプトを直接実行したときと同じく、同じディレクトリのモジュールをimportできるようにする
+    sys.path.insert(0, os.path.dirname(script))
+    sys.argv = [script] + args
+    runpy.run_path(script, run_name='__main__')
+    return 0
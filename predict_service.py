@@ -0,0 +1,363 @@
+import sqlite3
+import pickle
+import json
+import time
+import os
+import argparse
+import threading
+import traceback
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from dotenv import load_dotenv
+
+# .envファイルから環境変数を読み込む
+# このスクリプトはプロジェクトのルートに配置される想定
+load_dotenv()
+
+DB_PATH = os.getenv('DB_FILE_PATH')
+MODEL_PATH = os.getenv('MODEL_FILE_PATH')
+
+# モデルに渡す特徴量の列順 (学習時と同じ順序であること)
+HORSE_STAT_COLUMNS = ['horse_runs', 'horse_win_rate', 'horse_top3_rate', 'horse_avg_rank', 'horse_avg_last_3f']
+JOCKEY_STAT_COLUMNS = ['jockey_rides', 'jockey_win_rate', 'jockey_top3_rate', 'jockey_avg_rank']
+TRAINER_STAT_COLUMNS = ['trainer_runs', 'trainer_win_rate', 'trainer_top3_rate', 'trainer_avg_rank']
+ENTRY_COLUMNS = ['frame_no', 'horse_no', 'age', 'weight', 'horse_weight', 'weight_diff', 'odds']
+FEATURE_COLUMNS = HORSE_STAT_COLUMNS + JOCKEY_STAT_COLUMNS + TRAINER_STAT_COLUMNS + ENTRY_COLUMNS
+
+# 直前に更新される項目 (この項目の更新では該当行のみ再計算する)
+LIVE_FIELDS = ('horse_weight', 'weight_diff', 'odds')
+
+# 馬・騎手・調教師の過去成績を1回のクエリでまとめて集計する
+STATS_QUERY = '''
+SELECT 'horse', r.horse_id, COUNT(*), AVG(r.rank = 1), AVG(r.rank <= 3), AVG(r.rank), AVG(r.last_3f)
+FROM results r JOIN card_ids c ON c.kind = 'horse' AND c.entity_id = r.horse_id
+WHERE r.rank > 0
+GROUP BY r.horse_id
+UNION ALL
+SELECT 'jockey', r.jockey_id, COUNT(*), AVG(r.rank = 1), AVG(r.rank <= 3), AVG(r.rank), NULL
+FROM results r JOIN card_ids c ON c.kind = 'jockey' AND c.entity_id = r.jockey_id
+WHERE r.rank > 0
+GROUP BY r.jockey_id
+UNION ALL
+SELECT 'trainer', r.trainer_id, COUNT(*), AVG(r.rank = 1), AVG(r.rank <= 3), AVG(r.rank), NULL
+FROM results r JOIN card_ids c ON c.kind = 'trainer' AND c.entity_id = r.trainer_id
+WHERE r.rank > 0
+GROUP BY r.trainer_id
+'''
+
+def load_model(model_path):
+    """pickleで保存された学習済みモデルを読み込む"""
+    with open(model_path, 'rb') as f:
+        return pickle.load(f)
+
+def _to_float(value):
+    """Noneを欠損値(NaN)に変換する"""
+    return np.nan if value is None else float(value)
+
+# DBのレース・結果が増えたかを調べる (どちらも索引・rowidで引けるため全件は数えない)
+DATA_VERSION_QUERY = "SELECT (SELECT MAX(date) FROM races), (SELECT MAX(rowid) FROM results)"
+
+class FeatureCache:
+    """馬・騎手・調教師ごとの過去成績特徴量をメモリ上に保持するキャッシュ
+
+    日をまたいだ常駐や当日の先のレースの結果の取り込みで古くならないよう、
+    refresh_if_changed() はDBのレース・結果が増えていればキャッシュを破棄する。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.stats = {'horse': {}, 'jockey': {}, 'trainer': {}}
+        self.data_version = None
+        self.widths = {
+            'horse': len(HORSE_STAT_COLUMNS),
+            'jockey': len(JOCKEY_STAT_COLUMNS),
+            'trainer': len(TRAINER_STAT_COLUMNS),
+        }
+
+    def ensure(self, ids_by_kind):
+        """キャッシュにないIDの成績をまとめて1回のクエリで取得する"""
+        missing = [
+            (kind, entity_id)
+            for kind, ids in ids_by_kind.items()
+            for entity_id in set(ids)
+            if entity_id and entity_id not in self.stats[kind]
+        ]
+        if not missing:
+            return 0
+
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("CREATE TEMP TABLE card_ids (kind TEXT, entity_id TEXT, PRIMARY KEY (kind, entity_id))")
+            cursor.executemany("INSERT OR IGNORE INTO card_ids (kind, entity_id) VALUES (?, ?)", missing)
+            for row in cursor.execute(STATS_QUERY):
+                kind, entity_id = row[0], row[1]
+                values = [_to_float(v) for v in row[2:2 + self.widths[kind]]]
+                self.stats[kind][entity_id] = np.array(values, dtype=np.float64)
+        finally:
+            conn.close()
+
+        # 過去成績がない(初出走など)IDは欠損値として記録し、再問い合わせしない
+        for kind, entity_id in missing:
+            if entity_id not in self.stats[kind]:
+                empty = np.full(self.widths[kind], np.nan)
+                empty[0] = 0.0
+                self.stats[kind][entity_id] = empty
+        return len(missing)
+
+    def get(self, kind, entity_id):
+        empty = np.full(self.widths[kind], np.nan)
+        return self.stats[kind].get(entity_id, empty)
+
+    def invalidate(self):
+        """レース結果の追加後などにキャッシュを破棄する"""
+        for kind in self.stats:
+            self.stats[kind].clear()
+        self.data_version = self.current_version()
+
+    def current_version(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute(DATA_VERSION_QUERY).fetchone()
+        finally:
+            conn.close()
+
+    def refresh_if_changed(self):
+        """前回からレース・結果が増えていればキャッシュを破棄してTrueを返す"""
+        version = self.current_version()
+        if version == self.data_version:
+            return False
+        changed = self.data_version is not None
+        if changed:
+            for kind in self.stats:
+                self.stats[kind].clear()
+        self.data_version = version
+        return changed
+
+class PredictionService:
+    """モデルと特徴量キャッシュを保持し、出馬表単位で予測を返すサービス"""
+
+    def __init__(self, db_path, model):
+        self.model = model
+        self.cache = FeatureCache(db_path)
+        # race_id -> {'entries': [dict], 'X': ndarray, 'scores': ndarray}
+        self.races = {}
+        self.lock = threading.Lock()
+
+    def _predict(self, X):
+        if hasattr(self.model, 'predict_proba'):
+            return np.asarray(self.model.predict_proba(X))[:, 1]
+        return np.asarray(self.model.predict(X), dtype=np.float64)
+
+    def _entry_vector(self, entry):
+        """1頭分の特徴量ベクトルを組み立てる"""
+        return np.concatenate([
+            self.cache.get('horse', entry.get('horse_id')),
+            self.cache.get('jockey', entry.get('jockey_id')),
+            self.cache.get('trainer', entry.get('trainer_id')),
+            np.array([_to_float(entry.get(col)) for col in ENTRY_COLUMNS]),
+        ])
+
+    def _score(self, race_ids):
+        """レースの特徴量を組み立て、全レース分を1回の推論でまとめて予測する"""
+        self.cache.ensure({
+            kind: [e.get(f'{kind}_id') for race_id in race_ids for e in self.races[race_id]['entries']]
+            for kind in ('horse', 'jockey', 'trainer')
+        })
+        for race_id in race_ids:
+            race = self.races[race_id]
+            race['X'] = np.vstack([self._entry_vector(e) for e in race['entries']])
+        if race_ids:
+            scores = self._predict(np.vstack([self.races[race_id]['X'] for race_id in race_ids]))
+            offset = 0
+            for race_id in race_ids:
+                n = len(self.races[race_id]['entries'])
+                self.races[race_id]['scores'] = scores[offset:offset + n].copy()
+                offset += n
+
+    def load_card(self, card):
+        """出馬表(複数レース)を読み込み、全頭の特徴量と予測をまとめて計算する
+
+        前回からDBにレース・結果が追加されていれば、読み込み済みのレースも
+        新しい成績で計算し直す。
+        card: {'races': [{'race_id': str, 'entries': [{'horse_id': ..., 'horse_no': ..., ...}]}]}
+        """
+        races = card.get('races', [])
+        with self.lock:
+            stale = list(self.races) if self.cache.refresh_if_changed() else []
+
+            loaded = []
+            for race in races:
+                entries = [dict(e) for e in race.get('entries', [])]
+                if not entries:
+                    continue
+                self.races[race['race_id']] = {'entries': entries, 'X': None, 'scores': None}
+                loaded.append(race['race_id'])
+            self._score(loaded + [race_id for race_id in stale if race_id not in loaded])
+        return loaded
+
+    def reload(self):
+        """キャッシュを破棄し、読み込み済みの全レースを最新の成績で計算し直す"""
+        with self.lock:
+            self.cache.invalidate()
+            reloaded = list(self.races)
+            self._score(reloaded)
+        return reloaded
+
+    def update(self, race_id, horse_no, fields):
+        """馬体重・オッズなどの直前情報を更新し、該当行のみ再計算する"""
+        with self.lock:
+            race = self.races.get(race_id)
+            if race is None:
+                raise KeyError(f"race {race_id} is not loaded")
+
+            for i, entry in enumerate(race['entries']):
+                if int(entry.get('horse_no') or 0) != int(horse_no):
+                    continue
+                for key in LIVE_FIELDS:
+                    if key in fields:
+                        entry[key] = fields[key]
+                # 直前情報は出馬表由来の列のみなので、該当列だけを書き換える
+                offset = len(FEATURE_COLUMNS) - len(ENTRY_COLUMNS)
+                race['X'][i, offset:] = [_to_float(entry.get(col)) for col in ENTRY_COLUMNS]
+                race['scores'][i] = self._predict(race['X'][i:i + 1])[0]
+                return True
+            return False
+
+    def ranking(self, race_id):
+        """予測スコアの高い順に並べた予測結果を返す"""
+        with self.lock:
+            race = self.races.get(race_id)
+            if race is None:
+                return None
+            order = np.argsort(-race['scores'], kind='stable')
+            return [
+                {
+                    'rank': pos + 1,
+                    'horse_no': race['entries'][i].get('horse_no'),
+                    'horse_id': race['entries'][i].get('horse_id'),
+                    'score': float(race['scores'][i]),
+                }
+                for pos, i in enumerate(order)
+            ]
+
+def make_handler(service):
+    """サービスを参照するHTTPリクエストハンドラを作成する"""
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_json(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            if parsed.path == '/health':
+                self._send_json(200, {'status': 'ok', 'races': len(service.races)})
+                return
+            if parsed.path == '/predict':
+                start = time.perf_counter()
+                race_ids = parse_qs(parsed.query).get('race_id') or sorted(service.races)
+                predictions = {race_id: service.ranking(race_id) for race_id in race_ids}
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                self._send_json(200, {'predictions': predictions, 'elapsed_ms': elapsed_ms})
+                return
+            self._send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            start = time.perf_counter()
+            try:
+                payload = self._read_json()
+                if self.path == '/card':
+                    loaded = service.load_card(payload)
+                    result = {'loaded': loaded}
+                elif self.path == '/reload':
+                    # レース結果の取り込み後などに成績のキャッシュを作り直す
+                    result = {'reloaded': service.reload()}
+                elif self.path == '/update':
+                    # 1件または {'updates': [...]} で複数件の更新を受け付ける
+                    updates = payload.get('updates', [payload])
+                    touched = set()
+                    for u in updates:
+                        if service.update(u['race_id'], u['horse_no'], u):
+                            touched.add(u['race_id'])
+                    result = {'predictions': {race_id: service.ranking(race_id) for race_id in sorted(touched)}}
+                else:
+                    self._send_json(404, {'error': 'not found'})
+                    return
+            except (KeyError, ValueError) as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            except Exception as e:
+                traceback.print_exc()
+                self._send_json(500, {'error': str(e)})
+                return
+            result['elapsed_ms'] = (time.perf_counter() - start) * 1000
+            self._send_json(200, result)
+
+        def log_message(self, format, *args):
+            # リクエストごとのログは出さない
+            pass
+
+    return PredictionHandler
+
+def serve(service, host, port):
+    """ローカルHTTPサーバーとして予測サービスを起動する"""
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Prediction service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down...")
+    finally:
+        server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description='当日の出馬表に対する予測サービス')
+    parser.add_argument('--model', default=MODEL_PATH, help='学習済みモデル(pickle)のパス')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='ローカルHTTPサーバーとして常駐する')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--card', help='起動時に読み込む出馬表(JSON)')
+
+    predict_parser = subparsers.add_parser('predict', help='出馬表(JSON)を1回だけ予測して表示する')
+    predict_parser.add_argument('card', help='出馬表(JSON)のパス')
+
+    args = parser.parse_args()
+
+    if not DB_PATH:
+        print("エラー: .envファイルにDB_FILE_PATHが設定されていません。")
+        return
+    if not args.model:
+        print("エラー: --model またはMODEL_FILE_PATHでモデルを指定してください。")
+        return
+
+    service = PredictionService(DB_PATH, load_model(args.model))
+
+    card_path = args.card
+    if card_path:
+        with open(card_path, 'r', encoding='utf-8') as f:
+            start = time.perf_counter()
+            loaded = service.load_card(json.load(f))
+            print(f"Loaded {len(loaded)} races in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    if args.command == 'predict':
+        for race_id in loaded:
+            print(f"\n--- {race_id} ---")
+            for p in service.ranking(race_id):
+                print(f"{p['rank']:>2}. 馬番{p['horse_no']:>2} {p['horse_id']} score={p['score']:.4f}")
+    else:
+        serve(service, args.host, args.port)
+
+if __name__ == "__main__":
+    main()
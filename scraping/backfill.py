@@ -0,0 +1,215 @@
+import os
+import time
+import queue
+import argparse
+import threading
+import traceback
+from dotenv import load_dotenv
+from metrics import metrics
+from work_queue import iter_tasks, pending_ids, TASK_HORSE, TASK_PEDIGREE, TASK_JOCKEY, TASK_TRAINER
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DB_PATH = os.getenv('DB_FILE_PATH')
+if not DB_PATH:
+    raise ValueError("DB_FILE_PATH is not set in .env file")
+
+# ステージの終端を表す番兵
+_END = object()
+
+class Stage:
+    """キューから1件ずつ取り出して処理するワーカースレッド群
+
+    func(item, context) で処理し、context は各ワーカースレッド固有の辞書
+    (Seleniumドライバなどスレッドごとの資源を保持する)。同じitemは1回だけ処理する。
+    """
+
+    def __init__(self, name, func, workers=1, on_worker_exit=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.on_worker_exit = on_worker_exit
+        self.queue = queue.Queue()
+        self.seen = set()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.done = 0
+        self.failed = 0
+
+    def put(self, item):
+        """未処理のitemを投入する (既に投入済みのものは無視する)"""
+        with self.lock:
+            if item in self.seen:
+                return False
+            self.seen.add(item)
+        self.queue.put(item)
+        return True
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def close(self):
+        """上流の投入が終わったことを通知する"""
+        for _ in self.threads:
+            self.queue.put(_END)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def _run(self):
+        context = {}
+        try:
+            while True:
+                item = self.queue.get()
+                if item is _END:
+                    return
+                try:
+                    ok = self.func(item, context)
+                except Exception as e:
+                    print(f"[{self.name}] An unexpected error occurred for {item}: {e}")
+                    metrics.fail('exception')
+                    traceback.print_exc()
+                    ok = False
+                with self.lock:
+                    if ok:
+                        self.done += 1
+                    else:
+                        self.failed += 1
+        finally:
+            if self.on_worker_exit:
+                self.on_worker_exit(context)
+
+def discover_races(years, refresh_calendar=False):
+    """年ごとのレースIDと日付を返す (CSVがあればそれを使い、なければカレンダーから取得する)"""
+    import scraper_race
+    for year in years:
+        csv_path = scraper_race.race_csv_path(year)
+        if refresh_calendar or not os.path.exists(csv_path):
+            # Selenium は必要な時だけ読み込む
+            import get_race_ids
+            pairs = get_race_ids.get_race_ids_for_year(year)
+            os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+            with open(csv_path, 'w', encoding='utf-8') as f:
+                for race_id, date_str in pairs:
+                    f.write(f"{race_id},{date_str}\n")
+            print(f"Saved {len(pairs)} race IDs to {csv_path}.")
+        existing = scraper_race.get_existing_race_ids(year)
+        for race_id, date_str in scraper_race.read_race_ids_csv(year):
+            if race_id not in existing:
+                yield race_id, date_str
+
+def run_backfill(start_year, end_year, race_workers=2, horse_workers=4, person_workers=1,
+                 skip_persons=False, refresh_calendar=False):
+    """レースID取得 → レース結果 → 馬・血統 → 騎手・調教師 を流れ作業で実行する
+
+    上流のステージが1件処理するたびに下流へIDを渡すため、下流は上流の完了を
+    待たずに開始する。リクエスト間隔はホスト単位のスケジューラで全ステージ共通に守られる。
+    """
+    import scraper_race
+    import scraper_horse
+    import crosswalk
+    from http_fetch import fetch_page
+
+    def process_horse(item, context):
+        task, horse_id = item
+        # プロフィール取得済みで血統だけが欠けている馬は血統ページのみ取得する
+        if task == TASK_PEDIGREE:
+            pedigree_url, = scraper_horse.pedigree_page_urls(horse_id)
+            return scraper_horse.process_pedigree_page(horse_id, fetch_page(pedigree_url))
+        profile_url, pedigree_url = scraper_horse.horse_page_urls(horse_id)
+        return scraper_horse.process_horse_pages(horse_id, fetch_page(profile_url), fetch_page(pedigree_url))
+
+    def process_person(item, context):
+        import scraper_person_details
+        if 'driver' not in context:
+            context['driver'] = scraper_person_details.get_driver()
+        kind, person_id, netkeiba_id = item
+        if kind == TASK_JOCKEY:
+            return scraper_person_details.scrape_jockey(context['driver'], person_id, netkeiba_id)
+        return scraper_person_details.scrape_trainer(context['driver'], person_id, netkeiba_id)
+
+    def close_driver(context):
+        if 'driver' in context:
+            context['driver'].quit()
+
+    horse_stage = Stage('horses', process_horse, workers=horse_workers)
+    person_stage = Stage('persons', process_person, workers=person_workers, on_worker_exit=close_driver)
+
+    def process_race(item, context):
+        race_id, date_str = item
+        scraped = scraper_race.scrape_race(race_id, date_str)
+        if not scraped:
+            return False
+        results, jockeys, trainers = scraped
+        # 下流へは取得待ちになっているIDだけを渡す
+        for horse_id in pending_ids(DB_PATH, TASK_HORSE, [r['horse_id'] for r in results if r['horse_id']]):
+            horse_stage.put((TASK_HORSE, horse_id))
+        if not skip_persons:
+            persons = [(TASK_JOCKEY, i) for i in pending_ids(DB_PATH, TASK_JOCKEY, [j['jockey_id'] for j in jockeys])]
+            persons += [(TASK_TRAINER, i) for i in pending_ids(DB_PATH, TASK_TRAINER, [t['trainer_id'] for t in trainers])]
+            # 未解決のIDがあれば同じレースのnetkeibaの結果ページ1回でまとめて対応を取る
+            for (kind, person_id), netkeiba_id in crosswalk.resolve_race(race_id, persons).items():
+                person_stage.put((kind, person_id, netkeiba_id))
+        return True
+
+    race_stage = Stage('races', process_race, workers=race_workers)
+    stages = [race_stage, horse_stage] + ([] if skip_persons else [person_stage])
+    for stage in stages:
+        stage.start()
+
+    # 前回までの取得待ちも下流に投入しておく
+    for task in (TASK_HORSE, TASK_PEDIGREE):
+        for horse_id in iter_tasks(DB_PATH, task):
+            horse_stage.put((task, horse_id))
+    if not skip_persons:
+        for task in (TASK_JOCKEY, TASK_TRAINER):
+            for person_id, netkeiba_id in crosswalk.iter_resolved(DB_PATH, task):
+                person_stage.put((task, person_id, netkeiba_id))
+
+    stop_report = threading.Event()
+
+    def report():
+        while not stop_report.wait(30):
+            print(' | '.join(f"{s.name}: done={s.done} failed={s.failed} queued={s.pending()}" for s in stages))
+
+    threading.Thread(target=report, daemon=True).start()
+
+    start = time.time()
+    try:
+        for race in discover_races(range(start_year, end_year + 1), refresh_calendar):
+            race_stage.put(race)
+        race_stage.close()
+        race_stage.join()
+        # レースの処理が終われば馬・人物の投入も終わる
+        horse_stage.close()
+        person_stage.close()
+        horse_stage.join()
+        person_stage.join()
+    finally:
+        stop_report.set()
+
+    elapsed = time.time() - start
+    print(f"\nBackfill {start_year}-{end_year} finished in {elapsed:.0f}s.")
+    for stage in stages:
+        print(f"  {stage.name}: done={stage.done} failed={stage.failed}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='複数年分のレース・馬・騎手・調教師データを一括で取得する')
+    parser.add_argument('start_year', type=int, help='開始年 (例: 2015)')
+    parser.add_argument('end_year', type=int, help='終了年 (例: 2024)')
+    parser.add_argument('--race-workers', type=int, default=2, help='レース結果の同時処理数')
+    parser.add_argument('--horse-workers', type=int, default=4, help='馬・血統の同時処理数')
+    parser.add_argument('--person-workers', type=int, default=1, help='騎手・調教師の同時処理数 (Seleniumドライバ数)')
+    parser.add_argument('--skip-persons', action='store_true', help='騎手・調教師の詳細を取得しない')
+    parser.add_argument('--refresh-calendar', action='store_true', help='CSVがあってもカレンダーから取り直す')
+    args = parser.parse_args()
+
+    run_backfill(args.start_year, args.end_year, args.race_workers, args.horse_workers,
+                 args.person_workers, args.skip_persons, args.refresh_calendar)
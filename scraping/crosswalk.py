@@ -0,0 +1,269 @@
+import os
+import re
+import time
+import heapq
+import sqlite3
+import argparse
+import traceback
+from tqdm import tqdm
+from dotenv import load_dotenv
+from metrics import metrics
+from http_fetch import fetch_page, make_soup, prefetched
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DB_PATH = os.getenv('DB_FILE_PATH')
+if not DB_PATH:
+    raise ValueError("DB_FILE_PATH is not set in .env file")
+
+NETKEIBA_RACE_URL = "https://race.netkeiba.com/"
+
+# 対応を取る種別 (騎手・調教師はnetkeibaのプロフィール取得に使う)
+CROSSWALK_KINDS = ('horse', 'jockey', 'trainer')
+PERSON_KINDS = ('jockey', 'trainer')
+
+# 1人あたり候補とする出走 (新しい順)。全出走を候補にしても選ばれるレースはほぼ変わらない
+CANDIDATE_RACES_PER_ID = 20
+# 結果ページの先読み数
+PREFETCH_RACES = 4
+
+_ID_PATTERNS = {
+    kind: re.compile(rf'/{kind}/(?:result/recent/)?(\w+)')
+    for kind in CROSSWALK_KINDS
+}
+
+def netkeiba_result_url(race_id):
+    return f"{NETKEIBA_RACE_URL}race/result.html?race_id={race_id}"
+
+def _link_id(row, kind):
+    link = row.select_one(f'a[href*="/{kind}/"]')
+    match = _ID_PATTERNS[kind].search(link['href']) if link else None
+    return match.group(1) if match else None
+
+def parse_netkeiba_entries(page):
+    """netkeibaのレース結果・出馬表から (馬番, 馬ID, 騎手ID, 調教師ID) のリストを返す"""
+    soup = make_soup(page, profile='entries')
+    entries = []
+    for row in soup.select('tr.HorseList'):
+        # 出馬表は td.Umaban*、結果は2つ目の td.Num が馬番
+        umaban = row.select_one('td[class^="Umaban"]')
+        if umaban is None:
+            nums = row.select('td.Num')
+            umaban = nums[1] if len(nums) > 1 else None
+        horse_no_text = umaban.get_text(strip=True) if umaban else ''
+        if not horse_no_text.isdigit():
+            continue
+        entries.append((int(horse_no_text), _link_id(row, 'horse'), _link_id(row, 'jockey'), _link_id(row, 'trainer')))
+    soup.decompose()
+    return entries
+
+def save_entries(conn, race_id, entries):
+    """netkeiba側の出走馬を保存する (トリガーで id_crosswalk に対応が追加される)"""
+    conn.executemany('''
+    INSERT OR REPLACE INTO netkeiba_entries (race_id, horse_no, horse_id, jockey_id, trainer_id)
+    VALUES (?, ?, ?, ?, ?)
+    ''', [(race_id,) + entry for entry in entries])
+    conn.execute(
+        "INSERT OR REPLACE INTO crosswalk_sources (race_id, fetched_at, entries) VALUES (?, ?, ?)",
+        (race_id, time.time(), len(entries)))
+
+def unresolved_counts(db_path=DB_PATH, kinds=PERSON_KINDS):
+    """取得待ちの人物のうち、netkeibaのIDが分かっていない件数を種別ごとに返す"""
+    conn = sqlite3.connect(db_path)
+    try:
+        return {
+            kind: conn.execute('''
+            SELECT COUNT(*) FROM scrape_queue q
+            WHERE q.task = ? AND NOT EXISTS (
+                SELECT 1 FROM id_crosswalk c WHERE c.kind = q.task AND c.jbis_id = q.entity_id)
+            ''', (kind,)).fetchone()[0]
+            for kind in kinds
+        }
+    finally:
+        conn.close()
+
+def plan_races(conn, kinds=PERSON_KINDS, max_pages=None):
+    """未解決の人物をすべて含むよう、取得するnetkeibaのレースを貪欲法で選ぶ
+
+    1ページで十数頭分の騎手・調教師が分かるため、未解決のIDを最も多く含む
+    レース (同数なら新しいレース) から順に選ぶ。取得済みのレースは候補にしない。
+    (選んだレースIDのリスト, 解決できる見込みのID数, 未解決のID数) を返す。
+    """
+    members = {}
+    dates = {}
+    total = 0
+    for kind in kinds:
+        rows = conn.execute(f'''
+        SELECT race_id, date, entity_id FROM (
+            SELECT r.race_id, ra.date, q.entity_id,
+                   ROW_NUMBER() OVER (PARTITION BY q.entity_id ORDER BY ra.date DESC) AS n
+            FROM scrape_queue q
+            JOIN results r ON r.{kind}_id = q.entity_id
+            JOIN races ra ON ra.race_id = r.race_id
+            WHERE q.task = ?
+              AND NOT EXISTS (SELECT 1 FROM id_crosswalk c WHERE c.kind = q.task AND c.jbis_id = q.entity_id)
+              AND NOT EXISTS (SELECT 1 FROM crosswalk_sources s WHERE s.race_id = r.race_id)
+        ) WHERE n <= ?
+        ''', (kind, CANDIDATE_RACES_PER_ID)).fetchall()
+        total += len({row[2] for row in rows})
+        for race_id, date, entity_id in rows:
+            members.setdefault(race_id, set()).add((kind, entity_id))
+            dates[race_id] = date or ''
+
+    # 新しい順の順位を同数時の優先度にする
+    order = {race_id: i for i, race_id in enumerate(sorted(members, key=lambda r: (dates[r], r), reverse=True))}
+    heap = [(-len(ids), order[race_id], race_id) for race_id, ids in members.items()]
+    heapq.heapify(heap)
+    covered = set()
+    plan = []
+    while heap and (max_pages is None or len(plan) < max_pages):
+        neg_gain, rank, race_id = heapq.heappop(heap)
+        gain = len(members[race_id] - covered)
+        if not gain:
+            continue
+        if gain < -neg_gain:
+            # 他のレースで一部が解決済みになったので、減った件数で入れ直す
+            heapq.heappush(heap, (-gain, rank, race_id))
+            continue
+        plan.append(race_id)
+        covered |= members[race_id]
+    return plan, len(covered), total
+
+def resolve(db_path=DB_PATH, kinds=PERSON_KINDS, max_pages=None):
+    """未解決の人物を含むnetkeibaのレース結果ページを取得し、IDの対応を保存する
+
+    取得したページは crosswalk_sources に記録し、同じレースは二度と取得しない。
+    新たに対応が分かったIDの数を返す。
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        before = sum(unresolved_counts(db_path, kinds).values())
+        plan, expected, total = plan_races(conn, kinds, max_pages)
+        if not plan:
+            print(f"No races to fetch for ID resolution ({total} unresolved without candidates).")
+            return 0
+        print(f"Fetching {len(plan)} netkeiba result pages to resolve {expected} of {total} IDs...")
+
+        pages = prefetched(plan, lambda race_id: [netkeiba_result_url(race_id)], window=PREFETCH_RACES,
+                           no_data_marker=None)
+        for race_id, (page,) in tqdm(pages, total=len(plan), desc="Resolving IDs"):
+            if not page:
+                # 取得に失敗したレースは記録せず、次回に再度候補とする
+                continue
+            try:
+                with metrics.stage('parse'):
+                    entries = parse_netkeiba_entries(page)
+                with metrics.stage('db_write'):
+                    save_entries(conn, race_id, entries)
+                    conn.commit()
+                metrics.item('crosswalk_race')
+            except Exception as e:
+                print(f"An unexpected error occurred for race {race_id}: {e}")
+                metrics.fail('exception')
+                traceback.print_exc()
+    finally:
+        conn.close()
+
+    resolved = before - sum(unresolved_counts(db_path, kinds).values())
+    print(f"Resolved {resolved} IDs.")
+    return resolved
+
+def resolve_race(race_id, kind_ids, db_path=DB_PATH):
+    """1レース分の未解決のIDを、そのレースのnetkeiba結果ページで解決する
+
+    kind_ids は (種別, JBISのID) の並び。既に対応があるIDしかない場合や、
+    そのレースを取得済みの場合はリクエストしない。プロフィールを未取得のものについて
+    {(種別, JBISのID): netkeibaのID} を返す。
+    """
+    kind_ids = list(kind_ids)
+    if not kind_ids:
+        return {}
+    conn = sqlite3.connect(db_path)
+    try:
+        known = lookup(conn, kind_ids)
+        if len(known) < len(kind_ids) and not conn.execute(
+                "SELECT 1 FROM crosswalk_sources WHERE race_id = ?", (race_id,)).fetchone():
+            page = fetch_page(netkeiba_result_url(race_id), no_data_marker=None)
+            if page:
+                with metrics.stage('parse'):
+                    entries = parse_netkeiba_entries(page)
+                with metrics.stage('db_write'):
+                    save_entries(conn, race_id, entries)
+                    conn.commit()
+                metrics.item('crosswalk_race')
+                known = lookup(conn, kind_ids)
+        return {key: netkeiba_id for key, (netkeiba_id, fetched_at) in known.items() if fetched_at is None}
+    finally:
+        conn.close()
+
+def lookup(conn, kind_ids):
+    """(種別, JBISのID) の並びのうち対応が分かっているものを {キー: (netkeibaのID, 取得時刻)} で返す"""
+    known = {}
+    for kind, jbis_id in kind_ids:
+        row = conn.execute(
+            "SELECT netkeiba_id, fetched_at FROM id_crosswalk WHERE kind = ? AND jbis_id = ?", (kind, jbis_id)).fetchone()
+        if row:
+            known[(kind, jbis_id)] = row
+    return known
+
+def count_resolved(db_path, kind):
+    """netkeibaのIDが分かっていて、まだプロフィールを取得していない取得待ちの件数"""
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('''
+        SELECT COUNT(*) FROM scrape_queue q
+        JOIN id_crosswalk c ON c.kind = q.task AND c.jbis_id = q.entity_id
+        WHERE q.task = ? AND c.fetched_at IS NULL
+        ''', (kind,)).fetchone()[0]
+    finally:
+        conn.close()
+
+def iter_resolved(db_path, kind, batch_size=1000):
+    """netkeibaのIDが分かっている取得待ちを (JBISのID, netkeibaのID) で順に返す
+
+    work_queue.iter_tasks と同じく主キー順に少しずつ読み出す。一度取得を
+    試みたID (fetched_at が設定済み) は返さない。
+    """
+    last_id = ''
+    while True:
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute('''
+            SELECT q.entity_id, c.netkeiba_id FROM scrape_queue q
+            JOIN id_crosswalk c ON c.kind = q.task AND c.jbis_id = q.entity_id
+            WHERE q.task = ? AND c.fetched_at IS NULL AND q.entity_id > ?
+            ORDER BY q.entity_id LIMIT ?
+            ''', (kind, last_id, batch_size)).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1][0]
+
+def mark_fetched(db_path, kind, jbis_id):
+    """netkeibaのプロフィールを取得したことを記録する (結果に関わらず再取得しない)"""
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("UPDATE id_crosswalk SET fetched_at = ? WHERE kind = ? AND jbis_id = ?",
+                     (time.time(), kind, jbis_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='JBISとnetkeibaのIDの対応をnetkeibaのレース結果ページからまとめて解決する')
+    parser.add_argument('--max-pages', type=int, help='取得するレース結果ページ数の上限')
+    parser.add_argument('--status', action='store_true', help='取得を行わず、未解決の件数だけを表示する')
+    args = parser.parse_args()
+
+    if not args.status:
+        import initialize_db
+        initialize_db.create_tables()
+        resolve(max_pages=args.max_pages)
+    try:
+        for kind, count in unresolved_counts().items():
+            print(f"{kind:<8} unresolved {count:>7}  ready {count_resolved(DB_PATH, kind):>7}")
+    except sqlite3.OperationalError as e:
+        # --status ではテーブルを作らないため、未初期化のDBでは件数を出せない
+        print(f"Crosswalk tables are not available ({e}). Run without --status first.")
@@ -0,0 +1,177 @@
+import os
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from initialize_db import ENTITY_KINDS
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DB_PATH = os.getenv('DB_FILE_PATH')
+if not DB_PATH:
+    raise ValueError("DB_FILE_PATH is not set in .env file")
+
+# 存在しないIDに対して返すキー (rowidは1から振られるため0は使われない)
+MISSING_KEY = 0
+
+class KeyMap:
+    """1種別分のID文字列と整数キーの双方向の対応
+
+    キーからIDへはキーを添字とする固定長バイト列の配列、IDからキーへは
+    ソート済みのID配列の二分探索で引く。Pythonの文字列と辞書を使わないため、
+    数十万件でもメモリは1件あたりID長+数バイトに収まる。
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.ids = np.zeros(1, dtype='S1')
+        self.sorted_ids = np.zeros(0, dtype='S1')
+        self.sorted_keys = np.zeros(0, dtype=np.int32)
+        self.max_key = 0
+
+    def __len__(self):
+        return len(self.sorted_keys)
+
+    def extend(self, rows):
+        """(key, id) の行を追加する (既に読み込んだキーより大きいもの)"""
+        if not rows:
+            return
+        keys = np.fromiter((row[0] for row in rows), dtype=np.int32, count=len(rows))
+        ids = np.array([row[1].encode() for row in rows])
+        width = max(self.ids.dtype.itemsize, ids.dtype.itemsize)
+        max_key = int(keys.max())
+
+        by_key = np.zeros(max_key + 1, dtype=f'S{width}')
+        by_key[:len(self.ids)] = self.ids
+        by_key[keys] = ids
+        self.ids = by_key
+        self.max_key = max_key
+
+        merged_ids = np.concatenate([self.sorted_ids.astype(f'S{width}'), ids])
+        merged_keys = np.concatenate([self.sorted_keys, keys])
+        order = np.argsort(merged_ids, kind='stable')
+        self.sorted_ids = merged_ids[order]
+        self.sorted_keys = merged_keys[order]
+
+    def key(self, entity_id):
+        """IDのキーを返す (未登録ならMISSING_KEY)"""
+        return int(self.keys([entity_id])[0])
+
+    def keys(self, entity_ids):
+        """IDの並びをキーの配列 (int32) に変換する (未登録はMISSING_KEY)"""
+        if not len(self.sorted_ids):
+            return np.full(len(entity_ids), MISSING_KEY, dtype=np.int32)
+        needles = np.array([(e or '').encode() for e in entity_ids], dtype='S')
+        haystack = self.sorted_ids
+        # 切り詰めによる誤一致を避けるため、長い方の幅にそろえて比較する
+        if needles.dtype.itemsize > haystack.dtype.itemsize:
+            haystack = haystack.astype(needles.dtype)
+        else:
+            needles = needles.astype(haystack.dtype)
+        pos = np.searchsorted(haystack, needles)
+        pos = np.minimum(pos, len(haystack) - 1)
+        found = haystack[pos] == needles
+        return np.where(found, self.sorted_keys[pos], MISSING_KEY).astype(np.int32)
+
+    def id(self, key):
+        """キーのIDを返す (未登録ならNone)"""
+        if not 0 < key <= self.max_key:
+            return None
+        return self.ids[key].decode() or None
+
+    def ids_of(self, keys):
+        """キーの配列をIDのリストに変換する (未登録・範囲外のキーはNone)
+
+        読み込んだ対応表より新しいキーで作った状態 (レーティングなど) のキーを
+        別のIDに読み替えないよう、max_key を超えるキーも None にする。
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        valid = (keys > 0) & (keys <= self.max_key)
+        ids = self.ids[np.where(valid, keys, 0)]
+        return [b.decode() or None if v else None for b, v in zip(ids, valid)]
+
+    def nbytes(self):
+        return self.ids.nbytes + self.sorted_ids.nbytes + self.sorted_keys.nbytes
+
+class EntityKeys:
+    """keiba.dbの *_keys テーブルから全種別の対応表を読み込んで保持する
+
+    refresh() は前回読み込んだ最大キーより後に振られた分だけを追加で読む。
+    """
+
+    def __init__(self, db_path=DB_PATH, kinds=ENTITY_KINDS):
+        self.db_path = db_path
+        self.maps = {kind: KeyMap(kind) for kind in kinds}
+
+    @classmethod
+    def load(cls, db_path=DB_PATH, kinds=ENTITY_KINDS):
+        keys = cls(db_path, kinds)
+        keys.refresh()
+        return keys
+
+    def __getitem__(self, kind):
+        return self.maps[kind]
+
+    def refresh(self):
+        """新しく振られたキーを読み込み、追加された件数を返す"""
+        added = 0
+        conn = sqlite3.connect(self.db_path)
+        try:
+            for kind, key_map in self.maps.items():
+                rows = conn.execute(
+                    f"SELECT key, {kind}_id FROM {kind}_keys WHERE key > ? ORDER BY key",
+                    (key_map.max_key,)
+                ).fetchall()
+                key_map.extend(rows)
+                added += len(rows)
+        finally:
+            conn.close()
+        return added
+
+def load_results(db_path=DB_PATH, where='', params=()):
+    """出走結果をID文字列の代わりに整数キーの列で読み込む
+
+    horse_key / jockey_key / trainer_key は int32 (未登録は0)、race_id は
+    レースごとの連番 race_index (int32) とし、race_idsに元のIDを並べて返す。
+    馬・騎手・調教師のIDとキーの結合はSQLite内で行い、pandasには整数キーだけを
+    読み出す。race_id は文字列のまま読み、連番に変換してから列を捨てる。
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        df = pd.read_sql_query(f'''
+        SELECT r.race_id, ra.date,
+               IFNULL(hk.key, 0) AS horse_key, IFNULL(jk.key, 0) AS jockey_key, IFNULL(tk.key, 0) AS trainer_key,
+               r.rank, r.frame_no, r.horse_no, r.age, r.weight, r.time_seconds, r.last_3f,
+               r.odds, r.popularity, r.horse_weight, r.weight_diff
+        FROM results r
+        JOIN races ra ON ra.race_id = r.race_id
+        LEFT JOIN horse_keys hk ON hk.horse_id = r.horse_id
+        LEFT JOIN jockey_keys jk ON jk.jockey_id = r.jockey_id
+        LEFT JOIN trainer_keys tk ON tk.trainer_id = r.trainer_id
+        {where}
+        ORDER BY ra.date, r.race_id, r.horse_no
+        ''', conn, params=params)
+    finally:
+        conn.close()
+
+    for col in ('horse_key', 'jockey_key', 'trainer_key'):
+        df[col] = df[col].astype(np.int32)
+    race_ids, race_index = np.unique(df['race_id'].to_numpy(), return_inverse=True)
+    df['race_index'] = race_index.astype(np.int32)
+    df = df.drop(columns=['race_id'])
+    return df, race_ids
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ID文字列と整数キーの対応表を読み込み、件数とメモリ量を表示する')
+    parser.add_argument('--id', nargs=2, metavar=('KIND', 'ID'), help='IDのキーを表示する')
+    parser.add_argument('--key', nargs=2, metavar=('KIND', 'KEY'), help='キーのIDを表示する')
+    args = parser.parse_args()
+
+    keys = EntityKeys.load()
+    for kind, key_map in keys.maps.items():
+        print(f"{kind:<8} {len(key_map):>9} ids  {key_map.nbytes() / 1024 / 1024:8.2f} MB")
+    if args.id:
+        print(keys[args.id[0]].key(args.id[1]))
+    if args.key:
+        print(keys[args.key[0]].id(int(args.key[1])))
@@ -4,19 +4,19 @@ import re
 from tqdm import tqdm
 from datetime import datetime
 import argparse
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
+from metrics import metrics
+from politeness import scheduler, is_blocked_page
 
 NETKEIBA_BASE_URL = "https://race.netkeiba.com"
 
 def get_driver():
     """Selenium WebDriverを初期化して返す"""
+    # Seleniumは読み込みに時間がかかるため、ブラウザが必要になった時点で読み込む
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
+    from selenium.webdriver.chrome.options import Options
+    from webdriver_manager.chrome import ChromeDriverManager
+
     chrome_options = Options()
     chrome_options.add_argument("--headless")
     chrome_options.add_argument("--no-sandbox")
@@ -36,6 +36,11 @@ def get_race_ids_for_year(year):
     Returns:
         list[tuple[str, str]]: [(race_id, 'YYYY-MM-DD'), ...]
     """
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.common.by import By
+    from selenium.common.exceptions import TimeoutException
+
     all_races = []
     print(f"Fetching race IDs for {year} from netkeiba calendar using Selenium...")
 
@@ -57,7 +62,17 @@ def get_race_ids_for_year(year):
 
         for month in tqdm(range(1, 13), desc=f"Fetching calendar for {year}"):
             calendar_url = f"{NETKEIBA_BASE_URL}/top/calendar.html?year={year}&month={month}"
-            driver.get(calendar_url)
+            scheduler.wait(calendar_url)
+            start = time.perf_counter()
+            with metrics.stage('fetch'):
+                driver.get(calendar_url)
+            # Seleniumではステータスが分からないため、制限・エラーのページかを内容で判定する
+            blocked = is_blocked_page(driver.title, driver.page_source)
+            scheduler.record(calendar_url, time.perf_counter() - start, error=blocked)
+            if blocked:
+                print(f"Blocked or server error page for {year}-{month:02d}, skipping.")
+                metrics.fail('blocked')
+                continue
             try:
                 # ページの主要な要素(カレンダーセル)が表示されるまで最大10秒待機
                 WebDriverWait(driver, 10).until(
@@ -66,9 +81,11 @@ def get_race_ids_for_year(year):
             except TimeoutException:
                 # この月にレースがなければタイムアウトするので、スキップする
                 print(f"No races found for {year}-{month:02d}, skipping.")
+                metrics.fail('no_data')
                 continue
             html = driver.page_source # JS実行後のHTMLを取得
-            soup = BeautifulSoup(html, 'lxml')
+            with metrics.stage('parse'):
+                soup = BeautifulSoup(html, 'lxml')
             
             # 開催日が含まれるリンクをすべて取得
             date_links = soup.select('a[href*="race_list.html?kaisai_date="]')
@@ -80,12 +97,28 @@ def get_race_ids_for_year(year):
                 
                 date_yyyymmdd = date_match.group(1)
                 race_list_url = f"{NETKEIBA_BASE_URL}/top/race_list.html?kaisai_date={date_yyyymmdd}"
-                driver.get(race_list_url)
-                time.sleep(1) # ページ遷移を待つ
+                scheduler.wait(race_list_url)
+                start = time.perf_counter()
+                with metrics.stage('fetch'):
+                    driver.get(race_list_url)
+                    try:
+                        # 固定待機ではなく、レースへのリンクが表示されるまで待つ
+                        WebDriverWait(driver, 10).until(
+                            EC.presence_of_element_located((By.CSS_SELECTOR, 'a[href*="/race/result.html?race_id="]'))
+                        )
+                    except TimeoutException:
+                        pass
+                blocked = is_blocked_page(driver.title, driver.page_source)
+                scheduler.record(race_list_url, time.perf_counter() - start, error=blocked)
+                if blocked:
+                    print(f"Blocked or server error page for {date_yyyymmdd}, skipping.")
+                    metrics.fail('blocked')
+                    continue
                 
                 # レース一覧ページからレースIDを抽出
                 list_html = driver.page_source
-                list_soup = BeautifulSoup(list_html, 'lxml')
+                with metrics.stage('parse'):
+                    list_soup = BeautifulSoup(list_html, 'lxml')
                 
                 for race_link in list_soup.select('a[href*="/race/result.html?race_id="]'):
                     race_id_match = re.search(r'race_id=(\d{12})', race_link['href'])
@@ -94,8 +127,7 @@ def get_race_ids_for_year(year):
                         date_obj = datetime.strptime(date_yyyymmdd, '%Y%m%d')
                         date_formatted = date_obj.strftime('%Y-%m-%d')
                         all_races.append((race_id, date_formatted))
-
-            time.sleep(1) # 次の月へのリクエスト前に待機
+                metrics.item('race_list')
     finally:
         driver.quit()
 
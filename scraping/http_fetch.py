@@ -0,0 +1,186 @@
+import re
+import time
+import codecs
+import requests
+from urllib.parse import urlparse
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from bs4 import BeautifulSoup, SoupStrainer
+import urllib3
+from urllib3.exceptions import InsecureRequestWarning
+from metrics import metrics
+from politeness import scheduler, parse_retry_after
+
+# SSL警告を抑制
+urllib3.disable_warnings(InsecureRequestWarning)
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+}
+
+# JBISで該当データがない場合に表示される文言
+NO_DATA_MARKER = "該当するデータが見つかりませんでした"
+
+# 取得したページの生バイト列と文字コード
+Page = namedtuple('Page', ['content', 'encoding'])
+
+# ホストごとの文字コード (初回の応答で決定し、以降は判定しない)
+_host_charsets = {}
+# 文字コードごとにエンコード済みの「データなし」文言
+_encoded_markers = {}
+
+_session = requests.Session()
+_session.headers.update(HEADERS)
+
+_CONTENT_TYPE_CHARSET = re.compile(r'charset=["\']?([\w-]+)', re.IGNORECASE)
+_META_CHARSET = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+def _normalize_charset(name):
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+def resolve_charset(host, content_type, content):
+    """ホストの文字コードを返す
+
+    Content-Typeヘッダ、なければ先頭のmetaタグから決定し、ホスト単位でキャッシュする。
+    本文全体の文字コード推定 (apparent_encoding) は行わない。
+    """
+    charset = _host_charsets.get(host)
+    if charset:
+        return charset
+
+    match = _CONTENT_TYPE_CHARSET.search(content_type or '')
+    if match:
+        charset = _normalize_charset(match.group(1))
+    if not charset:
+        match = _META_CHARSET.search(content[:4096])
+        if match:
+            charset = _normalize_charset(match.group(1).decode('ascii', 'ignore'))
+    if not charset:
+        # 宣言がないページはキャッシュせず、UTF-8として扱う
+        return 'utf-8'
+
+    _host_charsets[host] = charset
+    return charset
+
+def encoded_marker(charset, marker=NO_DATA_MARKER):
+    """「データなし」文言を指定の文字コードでエンコードしたバイト列を返す
+
+    その文字コードで表せない (latin-1 を宣言するホストなど) 場合は None。
+    errors='ignore' で一部を落とすと空のバイト列になり、どのページにも一致してしまう。
+    """
+    key = (charset, marker)
+    if key not in _encoded_markers:
+        try:
+            encoded = marker.encode(charset)
+        except (UnicodeEncodeError, LookupError):
+            encoded = None
+        _encoded_markers[key] = encoded or None
+    return _encoded_markers[key]
+
+def contains_marker(content, charset, marker=NO_DATA_MARKER):
+    """ページに「データなし」文言が含まれるか
+
+    通常はエンコード済みの文言でバイト列のまま探し、エンコードできない場合だけ
+    ページをデコードしてから探す。
+    """
+    encoded = encoded_marker(charset, marker)
+    if encoded is not None:
+        return encoded in content
+    try:
+        return marker in content.decode(charset, errors='replace')
+    except LookupError:
+        return marker in content.decode('utf-8', errors='replace')
+
+def fetch_page(url, no_data_marker=NO_DATA_MARKER):
+    """指定されたURLのページを生バイト列で取得し、Pageを返す (取得失敗・データなしはNone)"""
+    scheduler.wait(url)
+    start = time.perf_counter()
+    try:
+        with metrics.stage('fetch'):
+            response = _session.get(url, verify=False, timeout=10)
+        scheduler.record(url, time.perf_counter() - start, status=response.status_code,
+                         retry_after=parse_retry_after(response.headers.get('Retry-After')))
+        response.raise_for_status()
+
+        content = response.content
+        with metrics.stage('decode'):
+            charset = resolve_charset(urlparse(url).netloc, response.headers.get('Content-Type'), content)
+            no_data = bool(no_data_marker) and contains_marker(content, charset, no_data_marker)
+
+        if no_data:
+            print(f"Page not found or no data for URL: {url}")
+            metrics.fail('no_data')
+            return None
+
+        return Page(content, charset)
+    except requests.exceptions.Timeout as e:
+        print(f"Error fetching {url}: {e}")
+        scheduler.record(url, time.perf_counter() - start, error=True)
+        metrics.fail('timeout')
+        return None
+    except requests.exceptions.HTTPError as e:
+        print(f"Error fetching {url}: {e}")
+        metrics.fail('rate_limited' if e.response is not None and e.response.status_code == 429 else 'http_error')
+        return None
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching {url}: {e}")
+        scheduler.record(url, time.perf_counter() - start, error=True)
+        metrics.fail('http_error')
+        return None
+
+def _class_pattern(*names):
+    # SoupStrainerは解析中は分割前のclass属性 ("data-6-11 sort-1" など) と比較するため正規表現で照合する
+    return re.compile(r'(?:^|\s)(?:%s)(?:\s|$)' % '|'.join(re.escape(name) for name in names))
+
+# ページ種別ごとに、解析関数が参照する要素だけを木にする設定
+# (それ以外の要素はパーサーが読み飛ばし、Tagを作らない)
+PARSE_PROFILES = {
+    'race': SoupStrainer(['div', 'table'], class_=_class_pattern('box-race__text', 'data-6-11', 'tbl-data-05')),
+    # レース結果ページのレース条件 (クラスの取得し直し用)
+    'race_info': SoupStrainer('div', class_=_class_pattern('box-race__text')),
+    # レース結果ページのハロンタイム・上りの表
+    'laps': SoupStrainer('table', class_=_class_pattern('tbl-data-05')),
+    'horse': SoupStrainer(['h1', 'table'], class_=_class_pattern('heading-level2-bold', 'tbl-data-04')),
+    'pedigree': SoupStrainer('table', class_=_class_pattern('tbl-pedigree')),
+    'person': SoupStrainer('table', class_=_class_pattern('db_prof_table')),
+    # netkeibaのレース結果・出馬表の出走馬の行
+    'entries': SoupStrainer('tr', class_=_class_pattern('HorseList')),
+}
+
+def make_soup(page, parser='lxml', profile=None):
+    """Pageのバイト列を文字コード指定でそのままパーサーに渡す
+
+    profileにPARSE_PROFILESのキーを指定すると、その種別で必要な要素だけを木にする。
+    解析が終わったsoupは decompose() で解放すること (木は循環参照のため、
+    そのままではGCが回るまでメモリに残る)。
+    """
+    parse_only = PARSE_PROFILES[profile] if profile else None
+    return BeautifulSoup(page.content, parser, from_encoding=page.encoding, parse_only=parse_only)
+
+def prefetched(items, make_urls, window=4, no_data_marker=NO_DATA_MARKER):
+    """itemsごとのURL群を先読みしながら取得し、(item, [Page or None, ...]) を順に返す
+
+    make_urls(item) が返す複数のURLは同時に取得され、呼び出し側が現在の
+    itemを解析している間も、後続window件分のitemの取得が進む。
+    リクエスト間隔はスケジューラがホスト単位で守る。no_data_marker は
+    fetch_page に渡す (JBIS以外のページではNone)。
+    """
+    iterator = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(1, window) * 2) as executor:
+        def submit_next():
+            for item in iterator:
+                pending.append((item, [executor.submit(fetch_page, url, no_data_marker) for url in make_urls(item)]))
+                return True
+            return False
+
+        for _ in range(max(1, window) + 1):
+            if not submit_next():
+                break
+        while pending:
+            item, futures = pending.popleft()
+            submit_next()
+            yield item, [f.result() for f in futures]
@@ -10,6 +10,22 @@ DB_PATH = os.getenv('DB_FILE_PATH')
 if not DB_PATH:
     raise ValueError("DB_FILE_PATH is not set in .env file")
 
+# 整数キーを振るIDの種別
+ENTITY_KINDS = ('horse', 'jockey', 'trainer', 'owner', 'breeder')
+
+# 通過順・着差を解析した数値列 (後から追加したため既存DBではALTER TABLEで追加する)
+RESULTS_TYPED_COLUMNS = [
+    ('corner_1', 'INTEGER'), ('corner_2', 'INTEGER'), ('corner_3', 'INTEGER'), ('corner_4', 'INTEGER'),
+    ('margin_lengths', 'REAL'), ('margin_cum', 'REAL'),
+]
+
+def add_missing_columns(cursor, table, columns):
+    """テーブルにない列を追加する"""
+    existing = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+    for name, col_type in columns:
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {col_type}")
+
 def create_tables():
     if os.path.exists(DB_PATH):
         print(f"Database {DB_PATH} already exists.")
@@ -19,6 +35,9 @@ def create_tables():
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
+    # 読み手が書き込みを待たせないようWALモードにする (DBファイルに記録され、以後の接続にも効く)
+    cursor.execute("PRAGMA journal_mode=WAL")
+
     # 1. Races Table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS races (
@@ -33,10 +52,17 @@ def create_tables():
         rotation TEXT,
         weather TEXT,
         state TEXT,
-        entries INTEGER
+        entries INTEGER,
+        laps BLOB
     )
     ''')
 
+    # 開催日以降のレースだけを読む処理 (ratings.py など) 用
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_races_date ON races (date)")
+
+    # ハロンタイム (既存DBには列を追加し、値は lap_times.py --backfill で取得)
+    add_missing_columns(cursor, 'races', [('laps', 'BLOB')])
+
     # 2. Results Table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS results (
@@ -57,6 +83,13 @@ def create_tables():
         popularity INTEGER,
         horse_weight INTEGER,
         weight_diff INTEGER,
+        corner_1 INTEGER,
+        corner_2 INTEGER,
+        corner_3 INTEGER,
+        corner_4 INTEGER,
+        margin_lengths REAL,
+        margin_cum REAL,
+        speed_index INTEGER,
         PRIMARY KEY (race_id, horse_id),
         FOREIGN KEY (race_id) REFERENCES races (race_id),
         FOREIGN KEY (horse_id) REFERENCES horses (horse_id),
@@ -65,6 +98,16 @@ def create_tables():
     )
     ''')
 
+    # 既存DBには通過順・着差の数値列を追加する (値は migrate_results_typed.py で変換)
+    add_missing_columns(cursor, 'results', RESULTS_TYPED_COLUMNS)
+    # JBISのスピード指数 (既存の行は再取得するまでNULL)
+    add_missing_columns(cursor, 'results', [('speed_index', 'INTEGER')])
+
+    # 馬・騎手・調教師ごとの成績集計用インデックス
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_horse_id ON results (horse_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_jockey_id ON results (jockey_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_trainer_id ON results (trainer_id)")
+
     # 3. Horses Table
     create_horses_sql = f'''
     CREATE TABLE IF NOT EXISTS horses (
@@ -94,6 +137,8 @@ def create_tables():
         FOREIGN KEY (ancestor_id) REFERENCES horses (horse_id)
     )
     ''')
+    # 祖先IDからの逆引き (祖先の取得対象の集計と子孫からの血統導出に使用)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedigrees_ancestor_id ON pedigrees (ancestor_id)")
 
     # 4. Jockeys Table
     cursor.execute('''
@@ -132,9 +177,374 @@ def create_tables():
     )
     ''')
 
+    # 8. Scrape Queue (取得待ちの作業リスト)
+    # 各テーブルへの挿入・更新時にトリガーで追加・削除し、スクレイパーは
+    # 全件の突き合わせをせずにこのテーブルだけを読む
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'scrape_queue'")
+    queue_exists = cursor.fetchone() is not None
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS scrape_queue (
+        task TEXT NOT NULL,
+        entity_id TEXT NOT NULL,
+        PRIMARY KEY (task, entity_id)
+    ) WITHOUT ROWID
+    ''')
+    create_queue_triggers(cursor)
+    if not queue_exists:
+        seed_scrape_queue(cursor)
+
+    # 9. Shard Leases (複数プロセスでの分担取得の貸し出し記録)
+    # 書き込みプロセスがIDの範囲をワーカーに貸し出し、完了・期限切れを記録する
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS shard_leases (
+        lease_id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        range_start TEXT NOT NULL,
+        range_end TEXT NOT NULL,
+        items INTEGER NOT NULL,
+        worker TEXT,
+        leased_at REAL NOT NULL,
+        expires_at REAL NOT NULL,
+        done_at REAL
+    )
+    ''')
+
+    # 10. Entity Keys (ID文字列に対応する整数キー)
+    # 種別ごとに1テーブルで、key はrowidの別名のため一度振ったら変わらない
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'horse_keys'")
+    keys_exist = cursor.fetchone() is not None
+    for kind in ENTITY_KINDS:
+        cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {kind}_keys (
+            key INTEGER PRIMARY KEY,
+            {kind}_id TEXT NOT NULL UNIQUE
+        )
+        ''')
+    create_key_triggers(cursor)
+    if not keys_exist:
+        seed_entity_keys(cursor)
+
+    # 11. Odds Snapshots (当日のオッズ・馬体重の推移)
+    # live_odds.py が前回から変化した馬の行だけを取得時刻付きで追記する
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS odds_snapshots (
+        race_id TEXT NOT NULL,
+        horse_no INTEGER NOT NULL,
+        taken_at INTEGER NOT NULL,
+        odds REAL,
+        popularity INTEGER,
+        horse_weight INTEGER,
+        weight_diff INTEGER,
+        PRIMARY KEY (race_id, horse_no, taken_at)
+    ) WITHOUT ROWID
+    ''')
+
+    # 12. Series (差分符号化した時系列)
+    # 値は series_store.py の形式 (差分 → zigzag → 可変長整数) のBLOBで、件数はnに持つ
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS weight_series (
+        horse_key INTEGER PRIMARY KEY,
+        n INTEGER NOT NULL,
+        days BLOB,
+        weights BLOB,
+        diffs BLOB
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS odds_series (
+        race_id TEXT NOT NULL,
+        horse_no INTEGER NOT NULL,
+        n INTEGER NOT NULL,
+        times BLOB,
+        odds BLOB,
+        popularity BLOB,
+        horse_weight INTEGER,
+        weight_diff INTEGER,
+        PRIMARY KEY (race_id, horse_no)
+    ) WITHOUT ROWID
+    ''')
+
+    # 13. ID Crosswalk (JBISとnetkeibaのIDの対応)
+    # netkeibaのレースページの出走馬を (race_id, horse_no) で results と突き合わせて対応を作る
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS netkeiba_entries (
+        race_id TEXT NOT NULL,
+        horse_no INTEGER NOT NULL,
+        horse_id TEXT,
+        jockey_id TEXT,
+        trainer_id TEXT,
+        PRIMARY KEY (race_id, horse_no)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS crosswalk_sources (
+        race_id TEXT PRIMARY KEY,
+        fetched_at REAL NOT NULL,
+        entries INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS id_crosswalk (
+        kind TEXT NOT NULL,
+        jbis_id TEXT NOT NULL,
+        netkeiba_id TEXT NOT NULL,
+        fetched_at REAL,
+        PRIMARY KEY (kind, jbis_id)
+    ) WITHOUT ROWID
+    ''')
+    create_crosswalk_triggers(cursor)
+
+    # 14. Speed Figures (基準タイムと馬場差で補正したスピード指数)
+    # 基準タイムは勝ちタイムの件数と合計で持ち、新しいレースの分を足して更新する
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS speed_pars (
+        venue TEXT NOT NULL,
+        course_type TEXT NOT NULL,
+        distance INTEGER NOT NULL,
+        state TEXT NOT NULL,
+        n INTEGER NOT NULL,
+        total_seconds REAL NOT NULL,
+        PRIMARY KEY (venue, course_type, distance, state)
+    ) WITHOUT ROWID
+    ''')
+    # 馬場差は1000mあたりの秒数 (プラスは時計がかかる馬場)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS track_variants (
+        date TEXT NOT NULL,
+        venue TEXT NOT NULL,
+        course_type TEXT NOT NULL,
+        variant REAL NOT NULL,
+        races INTEGER NOT NULL,
+        PRIMARY KEY (date, venue, course_type)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS speed_figures (
+        race_id TEXT NOT NULL,
+        horse_id TEXT NOT NULL,
+        par_seconds REAL,
+        figure REAL,
+        PRIMARY KEY (race_id, horse_id)
+    ) WITHOUT ROWID
+    ''')
+
+    # 15. Rating History (出走前のレーティング)
+    # ratings.py が開催日順に計算する。現在の値は状態ファイル (keiba.ratings.npz) に持つ
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS rating_history (
+        race_id TEXT NOT NULL,
+        horse_key INTEGER NOT NULL,
+        horse_rating REAL,
+        jockey_rating REAL,
+        trainer_rating REAL,
+        PRIMARY KEY (race_id, horse_key)
+    ) WITHOUT ROWID
+    ''')
+
+    # 16. Pedigree Signatures (5代血統表のMinHash署名)
+    # pedigree_similarity.py が血統の保存時に作る。署名は uint32 × 64 のリトルエンディアン
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS pedigree_signatures (
+        horse_key INTEGER PRIMARY KEY,
+        signature BLOB NOT NULL
+    )
+    ''')
+
+    # 17. Ancestor Queue (血統表に現れる未取得の祖先と参照数)
+    # pedigrees・horses への挿入時にトリガーで増減し、scraper_horse.py --ancestors は
+    # pedigrees 全体を集計せずにこのテーブルを参照数の多い順に読む
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ancestor_queue'")
+    ancestors_exist = cursor.fetchone() is not None
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ancestor_queue (
+        ancestor_id TEXT PRIMARY KEY,
+        refs INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ancestor_queue_refs ON ancestor_queue (refs)")
+    create_ancestor_queue_triggers(cursor)
+    if not ancestors_exist:
+        seed_ancestor_queue(cursor)
+
     conn.commit()
     conn.close()
     print("Tables created successfully.")
 
+def create_queue_triggers(cursor):
+    """scrape_queueを更新するトリガーを作成する"""
+    # 新しい出走結果の馬が未取得なら 'horse' タスクを追加
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_results_queue_horse AFTER INSERT ON results
+    WHEN NEW.horse_id IS NOT NULL AND NEW.horse_id != ''
+    BEGIN
+        INSERT OR IGNORE INTO scrape_queue (task, entity_id)
+        SELECT 'horse', NEW.horse_id
+        WHERE NOT EXISTS (SELECT 1 FROM horses WHERE horse_id = NEW.horse_id);
+    END
+    ''')
+    # 馬を保存したら 'horse' を完了にし、血統がなければ 'pedigree' タスクを追加
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_horses_queue AFTER INSERT ON horses
+    BEGIN
+        DELETE FROM scrape_queue WHERE task = 'horse' AND entity_id = NEW.horse_id;
+        INSERT OR IGNORE INTO scrape_queue (task, entity_id)
+        SELECT 'pedigree', NEW.horse_id
+        WHERE NOT EXISTS (SELECT 1 FROM pedigrees WHERE horse_id = NEW.horse_id);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_pedigrees_queue AFTER INSERT ON pedigrees
+    BEGIN
+        DELETE FROM scrape_queue WHERE task = 'pedigree' AND entity_id = NEW.horse_id;
+    END
+    ''')
+    # 騎手・調教師は所属と生年月日が揃うまで取得待ちとする
+    for person in ('jockey', 'trainer'):
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{person}s_queue AFTER INSERT ON {person}s
+        WHEN NEW.belonging IS NULL OR NEW.birth_date IS NULL
+        BEGIN
+            INSERT OR IGNORE INTO scrape_queue (task, entity_id) VALUES ('{person}', NEW.{person}_id);
+        END
+        ''')
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{person}s_queue_done AFTER UPDATE OF belonging, birth_date ON {person}s
+        WHEN NEW.belonging IS NOT NULL AND NEW.birth_date IS NOT NULL
+        BEGIN
+            DELETE FROM scrape_queue WHERE task = '{person}' AND entity_id = NEW.{person}_id;
+        END
+        ''')
+
+def create_ancestor_queue_triggers(cursor):
+    """ancestor_queueの参照数を更新するトリガーを作成する"""
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_pedigrees_ancestor_queue AFTER INSERT ON pedigrees
+    WHEN NEW.ancestor_id IS NOT NULL AND NEW.ancestor_id != ''
+    BEGIN
+        INSERT INTO ancestor_queue (ancestor_id, refs)
+        SELECT NEW.ancestor_id, 1
+        WHERE NOT EXISTS (SELECT 1 FROM horses WHERE horse_id = NEW.ancestor_id)
+        ON CONFLICT (ancestor_id) DO UPDATE SET refs = refs + 1;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_horses_ancestor_queue AFTER INSERT ON horses
+    BEGIN
+        DELETE FROM ancestor_queue WHERE ancestor_id = NEW.horse_id;
+    END
+    ''')
+
+def create_key_triggers(cursor):
+    """新しいIDが現れたら整数キーを振るトリガーを作成する"""
+    # 出走結果・血統表には未取得の馬・祖先のIDも現れる
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_results_keys AFTER INSERT ON results
+    BEGIN
+        INSERT OR IGNORE INTO horse_keys (horse_id) SELECT NEW.horse_id WHERE NEW.horse_id IS NOT NULL AND NEW.horse_id != '';
+        INSERT OR IGNORE INTO jockey_keys (jockey_id) SELECT NEW.jockey_id WHERE NEW.jockey_id IS NOT NULL AND NEW.jockey_id != '';
+        INSERT OR IGNORE INTO trainer_keys (trainer_id) SELECT NEW.trainer_id WHERE NEW.trainer_id IS NOT NULL AND NEW.trainer_id != '';
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_pedigrees_keys AFTER INSERT ON pedigrees
+    BEGIN
+        INSERT OR IGNORE INTO horse_keys (horse_id) VALUES (NEW.horse_id);
+        INSERT OR IGNORE INTO horse_keys (horse_id) VALUES (NEW.ancestor_id);
+    END
+    ''')
+    for kind in ENTITY_KINDS:
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{kind}s_keys AFTER INSERT ON {kind}s
+        WHEN NEW.{kind}_id IS NOT NULL AND NEW.{kind}_id != ''
+        BEGIN
+            INSERT OR IGNORE INTO {kind}_keys ({kind}_id) VALUES (NEW.{kind}_id);
+        END
+        ''')
+
+def seed_entity_keys(cursor):
+    """既存データのIDに整数キーを1回だけ振る (ID順に振るため、既存分はキー順とID順が一致する)"""
+    sources = {
+        'horse': [('horses', 'horse_id'), ('results', 'horse_id'), ('pedigrees', 'horse_id'), ('pedigrees', 'ancestor_id')],
+        'jockey': [('jockeys', 'jockey_id'), ('results', 'jockey_id')],
+        'trainer': [('trainers', 'trainer_id'), ('results', 'trainer_id')],
+        'owner': [('owners', 'owner_id')],
+        'breeder': [('breeders', 'breeder_id')],
+    }
+    for kind, columns in sources.items():
+        union = ' UNION '.join(f"SELECT {column} AS id FROM {table}" for table, column in columns)
+        cursor.execute(f'''
+        INSERT OR IGNORE INTO {kind}_keys ({kind}_id)
+        SELECT id FROM ({union})
+        WHERE id IS NOT NULL AND id != ''
+        ORDER BY id
+        ''')
+
+def create_crosswalk_triggers(cursor):
+    """netkeiba_entries と results の一方が追加されたときに、もう一方と突き合わせてIDの対応を追加する"""
+    for kind in ('horse', 'jockey', 'trainer'):
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_netkeiba_entries_{kind}_crosswalk AFTER INSERT ON netkeiba_entries
+        WHEN NEW.{kind}_id IS NOT NULL AND NEW.{kind}_id != ''
+        BEGIN
+            INSERT OR IGNORE INTO id_crosswalk (kind, jbis_id, netkeiba_id)
+            SELECT '{kind}', r.{kind}_id, NEW.{kind}_id FROM results r
+            WHERE r.race_id = NEW.race_id AND r.horse_no = NEW.horse_no AND r.{kind}_id != '';
+        END
+        ''')
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_results_{kind}_crosswalk AFTER INSERT ON results
+        WHEN NEW.{kind}_id IS NOT NULL AND NEW.{kind}_id != ''
+        BEGIN
+            INSERT OR IGNORE INTO id_crosswalk (kind, jbis_id, netkeiba_id)
+            SELECT '{kind}', NEW.{kind}_id, n.{kind}_id FROM netkeiba_entries n
+            WHERE n.race_id = NEW.race_id AND n.horse_no = NEW.horse_no AND n.{kind}_id IS NOT NULL AND n.{kind}_id != '';
+        END
+        ''')
+
+def seed_scrape_queue(cursor):
+    """既存データから取得待ちの作業リストを1回だけ作成する"""
+    cursor.execute('''
+    INSERT OR IGNORE INTO scrape_queue (task, entity_id)
+    SELECT DISTINCT 'horse', r.horse_id
+    FROM results r
+    LEFT JOIN horses h ON r.horse_id = h.horse_id
+    WHERE h.horse_id IS NULL AND r.horse_id IS NOT NULL AND r.horse_id != ''
+    ''')
+    cursor.execute('''
+    INSERT OR IGNORE INTO scrape_queue (task, entity_id)
+    SELECT 'pedigree', h.horse_id
+    FROM horses h
+    LEFT JOIN pedigrees p ON h.horse_id = p.horse_id
+    WHERE p.horse_id IS NULL AND h.horse_id IS NOT NULL AND h.horse_id != ''
+    ''')
+    for person in ('jockey', 'trainer'):
+        cursor.execute(f'''
+        INSERT OR IGNORE INTO scrape_queue (task, entity_id)
+        SELECT '{person}', {person}_id FROM {person}s
+        WHERE belonging IS NULL OR birth_date IS NULL
+        ''')
+
+def seed_ancestor_queue(cursor):
+    """既存の血統表から未取得の祖先と参照数を1回だけ集計する
+
+    子孫の血統表から導出した4代分の血統 (5代目が欠けている) は、血統ページで
+    補完するよう 'pedigree_derived' タスクも追加する。
+    """
+    cursor.execute('''
+    INSERT OR IGNORE INTO ancestor_queue (ancestor_id, refs)
+    SELECT p.ancestor_id, COUNT(*)
+    FROM pedigrees p
+    WHERE p.ancestor_id IS NOT NULL AND p.ancestor_id != ''
+        AND p.ancestor_id NOT IN (SELECT horse_id FROM horses)
+    GROUP BY p.ancestor_id
+    ''')
+    cursor.execute('''
+    INSERT OR IGNORE INTO scrape_queue (task, entity_id)
+    SELECT 'pedigree_derived', horse_id
+    FROM pedigrees
+    GROUP BY horse_id
+    HAVING MAX(generation) < 5
+    ''')
+
 if __name__ == "__main__":
     create_tables()
@@ -0,0 +1,165 @@
+import os
+import sqlite3
+import argparse
+import traceback
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from dotenv import load_dotenv
+from metrics import metrics
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DB_PATH = os.getenv('DB_FILE_PATH')
+if not DB_PATH:
+    raise ValueError("DB_FILE_PATH is not set in .env file")
+
+# scraper_race.LAP_SCALE と同じ (0.1秒単位)
+LAP_SCALE = 10
+LAP_DTYPE = np.dtype('<u2')
+# 前半・後半として比べるハロン数
+PACE_FURLONGS = 3
+# 再取得するページの先読み数
+PREFETCH_RACES = 4
+
+def read_laps(db_path=DB_PATH, where='', params=()):
+    """races の条件 (where) に合うレースのハロンタイムを (race_id のリスト, 2次元配列) で返す
+
+    配列は (レース数, 最大のハロン数) の秒数で、通過順の数値列と同じくゴール側に
+    詰め、足りない先頭側はNaNにする。ハロンタイムがないレースは含めない。
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        condition = f"AND ({where})" if where else ''
+        rows = conn.execute(f'''
+        SELECT race_id, laps FROM races
+        WHERE laps IS NOT NULL AND length(laps) > 0 {condition}
+        ORDER BY date, race_id
+        ''', params).fetchall()
+    finally:
+        conn.close()
+
+    race_ids = [row[0] for row in rows]
+    if not rows:
+        return race_ids, np.zeros((0, 0))
+    counts = np.fromiter((len(row[1]) // LAP_DTYPE.itemsize for row in rows), dtype=np.int64, count=len(rows))
+    flat = np.frombuffer(b''.join(row[1] for row in rows), dtype=LAP_DTYPE)
+    width = int(counts.max())
+
+    # 各値の行と、ゴール側に詰めたときの列を求めて一度に書き込む
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    row_index = np.repeat(np.arange(len(rows)), counts)
+    col_index = np.arange(len(flat)) - np.repeat(starts, counts) + np.repeat(width - counts, counts)
+    laps = np.full((len(rows), width), np.nan)
+    laps[row_index, col_index] = flat / LAP_SCALE
+    return race_ids, laps
+
+def pace_features(race_ids, laps):
+    """ハロンタイムの配列からレースごとのペースの特徴量を計算する
+
+    first_3f / last_3f は先頭・最後の3区間の合計 (距離が200mで割り切れないレースは
+    先頭の区間が短い)。pace_diff がプラスなら前半が遅い (後傾)。
+    """
+    counts = np.count_nonzero(~np.isnan(laps), axis=1)
+    width = laps.shape[1]
+    # 先頭側は行ごとに始まる列が違うため、始まりの列からの位置で取り出す
+    first_cols = (width - counts)[:, None] + np.arange(PACE_FURLONGS)[None, :]
+    first_cols = np.minimum(first_cols, width - 1)
+    first_3f = np.take_along_axis(laps, first_cols, axis=1).sum(axis=1)
+    last_3f = laps[:, width - PACE_FURLONGS:].sum(axis=1)
+    enough = counts >= PACE_FURLONGS * 2
+    # 最も速い区間には、距離の端数で短くなることがある先頭の区間を含めない
+    running = laps.copy()
+    running[np.arange(len(laps)), np.minimum(width - counts, width - 1)] = np.nan
+
+    features = pd.DataFrame({
+        'race_id': race_ids,
+        'furlongs': counts,
+        'first_3f': np.where(enough, first_3f, np.nan),
+        'last_3f': np.where(enough, last_3f, np.nan),
+        # 最も速い区間から最後の区間までの失速
+        'final_slowdown': laps[:, -1] - np.nanmin(running, axis=1) if width > 1 else np.full(len(laps), np.nan),
+    })
+    features['pace_diff'] = features['first_3f'] - features['last_3f']
+    return features
+
+def run_pace_features(db_path=DB_PATH, where='', params=()):
+    """出走ごとの先行力・末脚の特徴量をレースのペースと合わせて返す
+
+    early_position は最初に記録されたコーナーの通過順位を頭数で割った値 (0に近いほど前)。
+    通過順は4コーナー側に詰めて保存されるため、コーナーが4つ未満のレース (短距離など) では
+    corner_1 が空になり、corner_2〜corner_4 のうち最初の値を使う。
+    closing は上がり3Fとレース全体の最後の3ハロンの差 (マイナスほど速い)。
+    """
+    race_ids, laps = read_laps(db_path, where, params)
+    pace = pace_features(race_ids, laps)
+    conn = sqlite3.connect(db_path)
+    try:
+        runs = pd.read_sql_query('''
+        SELECT r.race_id, r.horse_id, COALESCE(r.corner_1, r.corner_2, r.corner_3, r.corner_4) AS first_corner,
+            r.last_3f AS horse_last_3f, ra.entries
+        FROM results r
+        JOIN races ra ON ra.race_id = r.race_id
+        WHERE ra.laps IS NOT NULL AND length(ra.laps) > 0
+        ''', conn)
+    finally:
+        conn.close()
+    runs = runs.merge(pace, on='race_id', how='inner')
+    runs['early_position'] = runs['first_corner'] / runs['entries']
+    runs['closing'] = runs['horse_last_3f'] - runs['last_3f']
+    return runs
+
+def backfill_laps(db_path=DB_PATH, limit=None):
+    """ハロンタイムのない既存のレースの結果ページを取得し直して races.laps を埋める
+
+    ページにハロンタイムがなければ空のBLOBを保存し、二度は取得しない。
+    取得に失敗したレースはNULLのまま残して次回に回す。
+    """
+    from http_fetch import make_soup, prefetched
+    from scraper_race import construct_jbis_url, parse_lap_times, encode_laps
+
+    conn = sqlite3.connect(db_path)
+    try:
+        query = "SELECT race_id, date FROM races WHERE laps IS NULL AND date IS NOT NULL ORDER BY date DESC"
+        races = conn.execute(query + (f" LIMIT {int(limit)}" if limit else '')).fetchall()
+        if not races:
+            print("All races have lap times.")
+            return 0
+
+        filled = 0
+        pages = prefetched(races, lambda race: [url for url in [construct_jbis_url(*race)] if url], window=PREFETCH_RACES)
+        for (race_id, _), fetched in tqdm(pages, total=len(races), desc="Backfilling laps"):
+            page = fetched[0] if fetched else None
+            if not page:
+                continue
+            try:
+                with metrics.stage('parse'):
+                    soup = make_soup(page, profile='laps')
+                    laps = parse_lap_times(soup)
+                    soup.decompose()
+                with metrics.stage('db_write'):
+                    conn.execute("UPDATE races SET laps = ? WHERE race_id = ?", (encode_laps(laps), race_id))
+                    conn.commit()
+                filled += bool(laps)
+                metrics.item('laps')
+            except Exception as e:
+                print(f"An unexpected error occurred for race {race_id}: {e}")
+                metrics.fail('exception')
+                traceback.print_exc()
+        print(f"Stored lap times for {filled} of {len(races)} races.")
+        return filled
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='レースのハロンタイムの取得し直しとペースの集計')
+    parser.add_argument('--backfill', action='store_true', help='ハロンタイムのない既存のレースを取得し直す')
+    parser.add_argument('--limit', type=int, help='--backfill で取得するレース数の上限 (新しい順)')
+    args = parser.parse_args()
+
+    if args.backfill:
+        backfill_laps(limit=args.limit)
+    race_ids, laps = read_laps()
+    print(f"{len(race_ids)} races with lap times.")
+    if race_ids:
+        print(pace_features(race_ids, laps)[['furlongs', 'first_3f', 'last_3f', 'pace_diff']].describe().round(2))
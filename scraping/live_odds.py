@@ -0,0 +1,287 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import datetime
+import argparse
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from dotenv import load_dotenv
+from metrics import metrics
+from http_fetch import fetch_page, make_soup
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DB_PATH = os.getenv('DB_FILE_PATH')
+if not DB_PATH:
+    raise ValueError("DB_FILE_PATH is not set in .env file")
+
+NETKEIBA_RACE_URL = "https://race.netkeiba.com/"
+
+# ポーリング間隔(秒)と、発走何分前から取得を始めるか
+POLL_INTERVAL = int(os.getenv('LIVE_POLL_INTERVAL', '300'))
+ODDS_HORIZON_MINUTES = int(os.getenv('LIVE_ODDS_HORIZON', '120'))
+# 馬体重は発走70分前頃に発表されるため、この時刻以降に出馬表を取得する
+WEIGHT_WINDOW_MINUTES = 90
+# 発走後もこの分数は確定オッズを取りに行く
+CLOSE_GRACE_MINUTES = 10
+# 同時に取得するレース数 (リクエスト間隔はスケジューラが守る)
+FETCH_WORKERS = 4
+
+SNAPSHOT_FIELDS = ('odds', 'popularity', 'horse_weight', 'weight_diff')
+
+def race_list_url(date_str):
+    return f"{NETKEIBA_RACE_URL}top/race_list_sub.html?kaisai_date={date_str}"
+
+def shutuba_url(race_id):
+    return f"{NETKEIBA_RACE_URL}race/shutuba.html?race_id={race_id}"
+
+def odds_url(race_id):
+    # 単勝オッズ (type=1) のJSON
+    return f"{NETKEIBA_RACE_URL}api/api_get_jra_odds.html?race_id={race_id}&type=1&action=update"
+
+def parse_race_list(page, date_str):
+    """当日のレース一覧から (race_id, 発走時刻datetime) のリストを返す"""
+    soup = make_soup(page)
+    races = {}
+    for item in soup.select('li'):
+        link = item.select_one('a[href*="race_id="]')
+        if not link:
+            continue
+        id_match = re.search(r'race_id=(\d{12})', link['href'])
+        time_match = re.search(r'(\d{1,2}):(\d{2})', item.get_text(' '))
+        if not id_match or not time_match:
+            continue
+        post_time = datetime.datetime.strptime(date_str, '%Y%m%d').replace(
+            hour=int(time_match.group(1)), minute=int(time_match.group(2)))
+        races.setdefault(id_match.group(1), post_time)
+    return sorted(races.items(), key=lambda item: (item[1], item[0]))
+
+def parse_shutuba_weights(page):
+    """出馬表から馬番ごとの馬体重と増減を返す (未発表の馬は含めない)"""
+    soup = make_soup(page)
+    weights = {}
+    for row in soup.select('tr.HorseList'):
+        umaban = row.select_one('td[class^="Umaban"]')
+        weight_td = row.select_one('td.Weight')
+        if not umaban or not weight_td:
+            continue
+        horse_no_text = umaban.get_text(strip=True)
+        match = re.search(r'(\d+)\s*\(([+-]?\d+)\)', weight_td.get_text(strip=True))
+        if horse_no_text.isdigit() and match:
+            weights[int(horse_no_text)] = (int(match.group(1)), int(match.group(2)))
+    return weights
+
+def parse_odds(page):
+    """単勝オッズのJSONから馬番ごとの (オッズ, 人気) を返す"""
+    try:
+        data = json.loads(page.content)
+        odds_by_no = data['data']['odds']['1']
+    except (ValueError, KeyError, TypeError):
+        return {}
+    odds = {}
+    for horse_no, values in odds_by_no.items():
+        try:
+            odds[int(horse_no)] = (float(values[0]), int(values[2]) if values[2] else None)
+        except (ValueError, IndexError, TypeError):
+            # 取消・除外などで数値でない場合
+            continue
+    return odds
+
+class LiveOdds:
+    """当日の全レースのオッズと馬体重を定期的に取得し、変化した行だけを保存する
+
+    発走ODDS_HORIZON_MINUTES分前から発走後CLOSE_GRACE_MINUTES分までのレースのみ
+    オッズを取得し、出馬表 (馬体重) は発表時刻以降、取得できるまでだけ取得する。
+    1レースあたり1回のポーリングで通常1リクエストに収まる。
+    """
+
+    def __init__(self, date_str, db_path=DB_PATH, notify_url=None):
+        self.date_str = date_str
+        self.db_path = db_path
+        self.notify_url = notify_url
+        self.races = []
+        self.weights_done = set()
+        self.closed = set()
+        # (race_id, horse_no) -> 直前に保存した値のタプル
+        self.last = {}
+        self.requests = 0
+
+    def load_last(self, conn):
+        """再起動時に重複して保存しないよう、当日分の最新値を読み込む"""
+        rows = conn.execute('''
+        SELECT s.race_id, s.horse_no, s.odds, s.popularity, s.horse_weight, s.weight_diff
+        FROM odds_snapshots s
+        JOIN (SELECT race_id, horse_no, MAX(taken_at) AS taken_at FROM odds_snapshots
+              WHERE race_id IN (SELECT value FROM json_each(?)) GROUP BY race_id, horse_no) m
+          ON s.race_id = m.race_id AND s.horse_no = m.horse_no AND s.taken_at = m.taken_at
+        ''', (json.dumps([race_id for race_id, _ in self.races]),)).fetchall()
+        for race_id, horse_no, *values in rows:
+            self.last[(race_id, horse_no)] = tuple(values)
+            if values[2] is not None:
+                self.weights_done.add(race_id)
+
+    def discover(self):
+        page = fetch_page(race_list_url(self.date_str), no_data_marker=None)
+        self.requests += 1
+        if not page:
+            return False
+        self.races = parse_race_list(page, self.date_str)
+        print(f"{len(self.races)} races on {self.date_str}.")
+        return bool(self.races)
+
+    def _fetch_race(self, race_id, need_weights):
+        """1レース分のオッズ (と必要なら馬体重) を取得する"""
+        odds_page = fetch_page(odds_url(race_id), no_data_marker=None)
+        odds = parse_odds(odds_page) if odds_page else {}
+        weights = {}
+        if need_weights:
+            card_page = fetch_page(shutuba_url(race_id), no_data_marker=None)
+            weights = parse_shutuba_weights(card_page) if card_page else {}
+        return race_id, odds, weights, 1 + int(need_weights)
+
+    def active_races(self, now):
+        """今回のポーリングで取得するレースと、馬体重も取得するかを返す"""
+        targets = []
+        for race_id, post_time in self.races:
+            if race_id in self.closed:
+                continue
+            minutes_to_post = (post_time - now).total_seconds() / 60
+            if minutes_to_post > ODDS_HORIZON_MINUTES:
+                continue
+            if minutes_to_post < -CLOSE_GRACE_MINUTES:
+                # 発走後の猶予を過ぎたら確定として以後は取得しない
+                self.closed.add(race_id)
+                continue
+            need_weights = race_id not in self.weights_done and minutes_to_post <= WEIGHT_WINDOW_MINUTES
+            targets.append((race_id, need_weights))
+        return targets
+
+    def diff(self, race_id, odds, weights):
+        """前回保存した値から変化した馬の行だけを返す (self.last は保存後に poll が更新する)"""
+        changed = []
+        for horse_no in sorted(set(odds) | set(weights)):
+            previous = self.last.get((race_id, horse_no), (None,) * len(SNAPSHOT_FIELDS))
+            win_odds, popularity = odds.get(horse_no, previous[:2])
+            horse_weight, weight_diff = weights.get(horse_no, previous[2:])
+            values = (win_odds, popularity, horse_weight, weight_diff)
+            if values != previous:
+                changed.append((race_id, horse_no) + values)
+        return changed
+
+    def poll(self, conn, now=None):
+        """1回分のポーリングを行い、保存した行数を返す"""
+        now = now or datetime.datetime.now()
+        targets = self.active_races(now)
+        if not targets:
+            return 0
+        taken_at = int(time.time())
+        changed = []
+        weighed = set()
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            futures = [executor.submit(self._fetch_race, race_id, need_weights) for race_id, need_weights in targets]
+            for future in futures:
+                race_id, odds, weights, requests_made = future.result()
+                self.requests += requests_made
+                # 馬体重は全頭同時に発表されるため、1頭でも取れれば以後は取得しない
+                if weights:
+                    weighed.add(race_id)
+                changed.extend(self.diff(race_id, odds, weights))
+
+        if changed:
+            with metrics.stage('db_write'):
+                try:
+                    conn.executemany('''
+                    INSERT OR REPLACE INTO odds_snapshots (race_id, horse_no, taken_at, odds, popularity, horse_weight, weight_diff)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''', [(r[0], r[1], taken_at) + r[2:] for r in changed])
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    raise
+        # 保存できた値だけを前回値にする (書き込みに失敗すれば次回も変化として扱う)
+        for race_id, horse_no, *values in changed:
+            self.last[(race_id, horse_no)] = tuple(values)
+        self.weights_done |= weighed
+        if changed and self.notify_url:
+            self.notify(changed)
+        print(f"[{now:%H:%M:%S}] {len(targets)} races polled, {len(changed)} rows changed, {self.requests} requests so far.")
+        return len(changed)
+
+    def notify(self, changed):
+        """予測サービスへ変化した直前情報を送る (読み込まれていないレースは無視される)"""
+        by_race = {}
+        for race_id, horse_no, win_odds, popularity, horse_weight, weight_diff in changed:
+            update = {'race_id': race_id, 'horse_no': horse_no, 'odds': win_odds}
+            if horse_weight is not None:
+                update.update({'horse_weight': horse_weight, 'weight_diff': weight_diff})
+            by_race.setdefault(race_id, []).append(update)
+        for race_id, updates in by_race.items():
+            try:
+                requests.post(f"{self.notify_url.rstrip('/')}/update", json={'updates': updates}, timeout=5)
+            except requests.exceptions.RequestException as e:
+                print(f"Failed to notify prediction service for {race_id}: {e}")
+
+    def finished(self):
+        return len(self.closed) == len(self.races)
+
+    def run(self, interval=POLL_INTERVAL, once=False):
+        if not self.discover():
+            print("No races found.")
+            return
+        import initialize_db
+        initialize_db.create_tables()
+        conn = sqlite3.connect(self.db_path)
+        try:
+            self.load_last(conn)
+            while True:
+                started = time.monotonic()
+                try:
+                    self.poll(conn)
+                except Exception as e:
+                    print(f"Poll failed: {e}")
+                    metrics.fail('exception')
+                    traceback.print_exc()
+                if once or self.finished():
+                    break
+                time.sleep(max(0.0, interval - (time.monotonic() - started)))
+        except KeyboardInterrupt:
+            print("Stopping live ingestion...")
+        finally:
+            conn.close()
+        print(f"Live ingestion finished: {self.requests} requests.")
+
+def fill_result_odds(db_path=DB_PATH):
+    """レース結果のオッズが空の行を、発走前最後のスナップショットのオッズで埋める"""
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.execute('''
+        UPDATE results SET odds = (
+            SELECT s.odds FROM odds_snapshots s
+            WHERE s.race_id = results.race_id AND s.horse_no = results.horse_no AND s.odds IS NOT NULL
+            ORDER BY s.taken_at DESC LIMIT 1
+        )
+        WHERE odds IS NULL AND EXISTS (
+            SELECT 1 FROM odds_snapshots s WHERE s.race_id = results.race_id AND s.horse_no = results.horse_no
+        )
+        ''')
+        conn.commit()
+        print(f"Filled odds for {cursor.rowcount} results.")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='当日のオッズ・馬体重を定期的に取得して odds_snapshots に保存する')
+    parser.add_argument('--date', default=datetime.date.today().strftime('%Y%m%d'), help='開催日 (YYYYMMDD)')
+    parser.add_argument('--interval', type=int, default=POLL_INTERVAL, help='ポーリング間隔(秒)')
+    parser.add_argument('--notify', help='更新を送る予測サービスのURL (例: http://127.0.0.1:8765)')
+    parser.add_argument('--once', action='store_true', help='1回だけ取得して終了する')
+    parser.add_argument('--fill-results', action='store_true', help='取得を行わず、レース結果の空のオッズをスナップショットで埋める')
+    args = parser.parse_args()
+
+    if args.fill_results:
+        fill_result_odds()
+    else:
+        LiveOdds(args.date, notify_url=args.notify).run(args.interval, args.once)
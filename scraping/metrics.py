@@ -0,0 +1,184 @@
+import os
+import time
+import json
+import atexit
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from dotenv import load_dotenv
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+
+# SCRAPER_METRICS_JSON: 終了時に計測結果を書き出すJSONファイルのパス
+# SCRAPER_METRICS_PORT: Prometheusテキスト形式で /metrics を公開するローカルポート
+# どちらも未設定の場合は計測を行わない
+METRICS_JSON_PATH = os.getenv('SCRAPER_METRICS_JSON')
+METRICS_PORT = os.getenv('SCRAPER_METRICS_PORT')
+
+# ヒストグラムのバケット境界(秒)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class _NullStage:
+    """計測無効時に使う何もしないコンテキストマネージャ"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    """1区間の所要時間を計測してヒストグラムに記録する"""
+
+    __slots__ = ('registry', 'name', 'start')
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+class Histogram:
+    """固定バケットのレイテンシヒストグラム"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += seconds
+        self.count += 1
+
+class Metrics:
+    """スクレイパーの区間別レイテンシ・失敗原因・処理件数を集計する"""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.histograms = {}
+        self.failures = {}
+        self.items = {}
+
+    def stage(self, name):
+        """区間 (fetch, decode, parse, extract, db_write, sleep など) の計測"""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.observe(seconds)
+
+    def fail(self, cause):
+        """失敗を原因別に数える (timeout, http_error, no_data, parse_error, db_error など)"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.failures[cause] = self.failures.get(cause, 0) + 1
+
+    def item(self, kind):
+        """処理が完了した件数を種類別に数える (race, horse, pedigree, jockey など)"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.items[kind] = self.items.get(kind, 0) + 1
+
+    def to_dict(self):
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            return {
+                'elapsed_seconds': elapsed,
+                'stages': {
+                    name: {
+                        'count': h.count,
+                        'sum_seconds': h.total,
+                        'mean_ms': h.total * 1000 / h.count if h.count else 0.0,
+                        'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'], h.counts)),
+                    }
+                    for name, h in self.histograms.items()
+                },
+                'failures': dict(self.failures),
+                'items': dict(self.items),
+                'items_per_second': {k: v / elapsed for k, v in self.items.items()},
+            }
+
+    def to_prometheus(self):
+        """Prometheusのテキスト形式で出力する"""
+        lines = []
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            lines.append('# TYPE scraper_stage_seconds histogram')
+            for name, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(list(BUCKETS) + ['+Inf'], h.counts):
+                    cumulative += count
+                    lines.append(f'scraper_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'scraper_stage_seconds_sum{{stage="{name}"}} {h.total}')
+                lines.append(f'scraper_stage_seconds_count{{stage="{name}"}} {h.count}')
+            lines.append('# TYPE scraper_failures_total counter')
+            for cause, count in sorted(self.failures.items()):
+                lines.append(f'scraper_failures_total{{cause="{cause}"}} {count}')
+            lines.append('# TYPE scraper_items_total counter')
+            for kind, count in sorted(self.items.items()):
+                lines.append(f'scraper_items_total{{kind="{kind}"}} {count}')
+            lines.append('# TYPE scraper_items_per_second gauge')
+            for kind, count in sorted(self.items.items()):
+                lines.append(f'scraper_items_per_second{{kind="{kind}"}} {count / elapsed}')
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    def serve(self, port, host='127.0.0.1'):
+        """/metrics をPrometheusテキスト形式で返すサーバーをバックグラウンドで起動する"""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = registry.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+metrics = Metrics(enabled=bool(METRICS_JSON_PATH or METRICS_PORT))
+
+if METRICS_PORT:
+    metrics.serve(int(METRICS_PORT))
+if METRICS_JSON_PATH:
+    atexit.register(metrics.write_json, METRICS_JSON_PATH)
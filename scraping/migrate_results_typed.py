@@ -0,0 +1,92 @@
+import os
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from dotenv import load_dotenv
+from scraper_race import MARGIN_WORDS, CORNERS
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DB_PATH = os.getenv('DB_FILE_PATH')
+if not DB_PATH:
+    raise ValueError("DB_FILE_PATH is not set in .env file")
+
+# scraper_race.MARGIN_PATTERN と同じ表記をpandasの正規表現で分解する
+MARGIN_REGEX = r'^(\d+)?(?:[\s.]*(\d)/(\d))?$'
+
+TYPED_COLUMNS = ['corner_1', 'corner_2', 'corner_3', 'corner_4', 'margin_lengths', 'margin_cum']
+
+def parse_margins(margin):
+    """着差の列を馬身の数値列に変換する (scraper_race.parse_margin の列版)"""
+    text = margin.fillna('').str.strip()
+    words = text.map(MARGIN_WORDS)
+    parts = text.str.extract(MARGIN_REGEX)
+    whole = pd.to_numeric(parts[0], errors='coerce')
+    fraction = pd.to_numeric(parts[1], errors='coerce') / pd.to_numeric(parts[2], errors='coerce')
+    numeric = whole.fillna(0) + fraction.fillna(0)
+    numeric[whole.isna() & fraction.isna()] = np.nan
+    return words.astype(float).fillna(numeric)
+
+def parse_corners(passing):
+    """通過順の列を4コーナー分の数値列にする (scraper_race.parse_passing の列版、右詰め)"""
+    reversed_parts = passing.fillna('').str.strip().str.split('-').str[::-1]
+    corners = pd.DataFrame(index=passing.index)
+    for i in range(CORNERS):
+        corners[f'corner_{CORNERS - i}'] = pd.to_numeric(reversed_parts.str[i], errors='coerce')
+    return corners[[f'corner_{i + 1}' for i in range(CORNERS)]]
+
+def convert(df):
+    """race_id, rank, margin, passing の行から数値列を計算する (scraper_race と同じ規則)"""
+    df = df.sort_values(['race_id', 'rank'])
+    typed = parse_corners(df['passing'])
+    lengths = parse_margins(df['margin'])
+    lengths[df['rank'] == 1] = 0.0
+    # 着順に積み上げ、解釈できない着差より後はNone
+    broken = lengths.isna().groupby(df['race_id']).cummax()
+    cum = lengths.fillna(0).groupby(df['race_id']).cumsum()
+    cum[broken] = np.nan
+    typed['margin_lengths'] = lengths
+    typed['margin_cum'] = cum
+    typed['rowid'] = df['rowid']
+    return typed
+
+def migrate(batch_races=5000, force=False):
+    """未変換の出走結果の通過順・着差を数値列に変換する"""
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        condition = '' if force else 'WHERE corner_4 IS NULL AND margin_cum IS NULL'
+        race_ids = [row[0] for row in conn.execute(
+            f"SELECT DISTINCT race_id FROM results {condition} ORDER BY race_id")]
+        if not race_ids:
+            print("No results to convert.")
+            return 0
+
+        updated = 0
+        for start in tqdm(range(0, len(race_ids), batch_races), desc="Converting results"):
+            batch = race_ids[start:start + batch_races]
+            df = pd.read_sql_query(
+                "SELECT rowid, race_id, rank, margin, passing FROM results WHERE race_id BETWEEN ? AND ?",
+                conn, params=(batch[0], batch[-1]))
+            typed = convert(df)
+            rows = typed[TYPED_COLUMNS + ['rowid']].astype(object).where(typed.notna(), None)
+            conn.executemany(
+                f"UPDATE results SET {', '.join(f'{c} = ?' for c in TYPED_COLUMNS)} WHERE rowid = ?",
+                rows.itertuples(index=False, name=None))
+            conn.commit()
+            updated += len(rows)
+        print(f"Converted {updated} rows in {len(race_ids)} races.")
+        return updated
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='既存の出走結果の通過順・着差を数値列に一括変換する')
+    parser.add_argument('--batch-races', type=int, default=5000, help='1回に変換するレース数')
+    parser.add_argument('--force', action='store_true', help='変換済みの行も変換し直す')
+    args = parser.parse_args()
+
+    import initialize_db
+    initialize_db.create_tables()
+    migrate(args.batch_races, args.force)
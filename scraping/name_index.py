@@ -0,0 +1,308 @@
+import os
+import re
+import time
+import shutil
+import sqlite3
+import argparse
+import unicodedata
+import numpy as np
+from dotenv import load_dotenv
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DB_PATH = os.getenv('DB_FILE_PATH')
+if not DB_PATH:
+    raise ValueError("DB_FILE_PATH is not set in .env file")
+
+# 索引を置くディレクトリ (既定は keiba.db と同じ場所の keiba.names/)
+NAME_INDEX_PATH = os.getenv('NAME_INDEX_PATH') or os.path.splitext(DB_PATH)[0] + '.names'
+
+# 索引のファイル (どれも np.load の mmap_mode で開く固定長の配列)
+INDEX_FILES = ('horse_ids', 'names', 'birth_dates', 'kana', 'kana_rows', 'romaji', 'romaji_rows', 'deletions', 'deletion_rows')
+# 索引は版ごとのサブディレクトリに書き、CURRENT ファイルで今の版を指す。
+# 読み込み中の利用者のため、直前の版までは消さずに残す
+CURRENT_FILE = 'CURRENT'
+KEEP_VERSIONS = 2
+# 作り直しと重なって版が消えた場合に読み込みをやり直す回数
+LOAD_RETRIES = 3
+
+# --- 名前の正規化 ---
+# カナのキーはNFKC・ひらがなをカタカナに・区切り記号を除いたもの。
+# ローマ字のキーはカナを訓令式で変換し、入力の揺れ (shi/si, fu/hu, 長音など) をそろえたもの。
+
+_SEPARATORS = re.compile(r'[\s・･=＝\-‐.,\'’]')
+_KANA_ROWS = [
+    ('', 'アイウエオ'), ('k', 'カキクケコ'), ('s', 'サシスセソ'), ('t', 'タチツテト'), ('n', 'ナニヌネノ'),
+    ('h', 'ハヒフヘホ'), ('m', 'マミムメモ'), ('r', 'ラリルレロ'), ('g', 'ガギグゲゴ'), ('z', 'ザジズゼゾ'),
+    ('d', 'ダヂヅデド'), ('b', 'バビブベボ'), ('p', 'パピプペポ'),
+]
+KANA_ROMAJI = {kana: consonant + vowel for consonant, row in _KANA_ROWS for kana, vowel in zip(row, 'aiueo')}
+KANA_ROMAJI.update({'ヤ': 'ya', 'ユ': 'yu', 'ヨ': 'yo', 'ワ': 'wa', 'ヲ': 'o', 'ン': 'n', 'ヴ': 'bu'})
+# 直前の音の母音を置き換える小書きの文字 (キャ → kya, ファ → ha, ティ → ti)
+_SMALL_YOON = {'ャ': 'ya', 'ュ': 'yu', 'ョ': 'yo'}
+_SMALL_VOWELS = {'ァ': 'a', 'ィ': 'i', 'ゥ': 'u', 'ェ': 'e', 'ォ': 'o'}
+# ヘボン式などの綴りを訓令式にそろえる (上から順に置き換える)
+_ROMAJI_CANON = [
+    ('shi', 'si'), ('chi', 'ti'), ('tsu', 'tu'), ('sh', 'sy'), ('ch', 'ty'), ('ji', 'zi'), ('j', 'zy'),
+    ('fu', 'hu'), ('f', 'h'), ('l', 'r'), ('v', 'b'), ('c', 'k'), ('q', 'k'), ('wo', 'o'),
+]
+
+def normalize_kana(name):
+    """名前をカナのキーにする (ひらがなはカタカナに、全角・半角はNFKCでそろえる)"""
+    text = unicodedata.normalize('NFKC', name or '')
+    text = ''.join(chr(ord(c) + 0x60) if 'ぁ' <= c <= 'ゖ' else c for c in text)
+    return _SEPARATORS.sub('', text).upper()
+
+def canonical_romaji(text):
+    """ローマ字の綴りの揺れをそろえる (長音・二重母音・撥音のm・促音の重ね書きを簡略化)"""
+    text = re.sub(r'[^a-z]', '', text.lower())
+    for before, after in _ROMAJI_CANON:
+        text = text.replace(before, after)
+    text = re.sub(r'm(?=[bmp])', 'n', text)
+    text = text.replace('ou', 'o').replace('ei', 'e')
+    text = re.sub(r'([aiueo])\1+', r'\1', text)
+    return re.sub(r'([^aiueon])\1+', r'\1', text)
+
+def kana_to_romaji(kana):
+    """カタカナを訓令式のローマ字にする (変換できない文字はそのまま残す)"""
+    out = []
+    double_next = False
+    for c in kana:
+        if c == 'ッ':
+            double_next = True
+            continue
+        if c == 'ー':
+            continue
+        if c in _SMALL_YOON and out and out[-1].endswith('i') and len(out[-1]) > 1:
+            out[-1] = out[-1][:-1] + _SMALL_YOON[c]
+            continue
+        if c in _SMALL_VOWELS and out:
+            out[-1] = out[-1][:-1] + _SMALL_VOWELS[c]
+            continue
+        romaji = KANA_ROMAJI.get(c, _SMALL_VOWELS.get(c, c.lower()))
+        if double_next and romaji[:1] not in 'aiueo':
+            romaji = romaji[0] + romaji
+        double_next = False
+        out.append(romaji)
+    return ''.join(out)
+
+def romaji_key(name):
+    """名前 (カナでもローマ字でも) をローマ字のキーにする"""
+    kana = normalize_kana(name)
+    return canonical_romaji(kana_to_romaji(kana) if not kana.isascii() else kana)
+
+def deletions(key):
+    """キーとその1文字を消したもの (あいまい検索の候補を引くための変形)"""
+    return {key} | {key[:i] + key[i + 1:] for i in range(len(key))}
+
+def edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+# --- 索引の作成 ---
+
+def _sorted_keys(keys, rows):
+    """キー (UTF-8のバイト列) と行番号を、キーの順に固定長の配列で返す"""
+    keys = np.array(keys, dtype='S') if keys else np.zeros(0, dtype='S1')
+    rows = np.asarray(rows, dtype=np.int32)
+    order = np.argsort(keys, kind='stable')
+    return keys[order], rows[order]
+
+def current_index_dir(path=NAME_INDEX_PATH):
+    """CURRENT が指す版のディレクトリを返す (CURRENT のない古い形式では path 自体)"""
+    try:
+        with open(os.path.join(path, CURRENT_FILE), encoding='utf-8') as f:
+            return os.path.join(path, f.read().strip())
+    except FileNotFoundError:
+        return path
+
+def build_index(db_path=DB_PATH, path=NAME_INDEX_PATH):
+    """horses の名前から索引を作り、新しい版のディレクトリに書いてから CURRENT を差し替える
+
+    CURRENT の差し替えは os.replace 1回のため、同時に NameIndex.load() した利用者は
+    前の版か新しい版のどちらかを必ず読める。
+
+    祖先は scraper_horse.py --ancestors でプロフィールを取得すると horses に入り、索引の対象になる。
+    """
+    start = time.perf_counter()
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute('''
+        SELECT horse_id, name, IFNULL(birth_date, '') FROM horses
+        WHERE name IS NOT NULL AND name != ''
+        ORDER BY horse_id
+        ''').fetchall()
+    finally:
+        conn.close()
+
+    kana_keys, romaji_keys, deletion_keys, deletion_rows = [], [], [], []
+    for row, (_, name, _) in enumerate(rows):
+        kana = normalize_kana(name)
+        kana_keys.append(kana.encode())
+        romaji_keys.append(romaji_key(name).encode())
+        for variant in deletions(kana):
+            deletion_keys.append(variant.encode())
+            deletion_rows.append(row)
+    row_numbers = range(len(rows))
+
+    arrays = {
+        'horse_ids': np.array([r[0].encode() for r in rows], dtype='S') if rows else np.zeros(0, dtype='S1'),
+        'names': np.array([r[1].encode() for r in rows], dtype='S') if rows else np.zeros(0, dtype='S1'),
+        'birth_dates': np.array([r[2].encode() for r in rows], dtype='S') if rows else np.zeros(0, dtype='S1'),
+    }
+    arrays['kana'], arrays['kana_rows'] = _sorted_keys(kana_keys, row_numbers)
+    arrays['romaji'], arrays['romaji_rows'] = _sorted_keys(romaji_keys, row_numbers)
+    arrays['deletions'], arrays['deletion_rows'] = _sorted_keys(deletion_keys, deletion_rows)
+
+    version = f'v{time.time_ns()}'
+    os.makedirs(os.path.join(path, version))
+    for name in INDEX_FILES:
+        np.save(os.path.join(path, version, f'{name}.npy'), arrays[name])
+    pointer_tmp = os.path.join(path, f'{CURRENT_FILE}.{version}.tmp')
+    with open(pointer_tmp, 'w', encoding='utf-8') as f:
+        f.write(version)
+    os.replace(pointer_tmp, os.path.join(path, CURRENT_FILE))
+
+    # 古い版と、CURRENT のない古い形式で直下に置いていたファイルを消す
+    versions = sorted(d for d in os.listdir(path) if d.startswith('v') and os.path.isdir(os.path.join(path, d)))
+    for old in versions[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+    for name in INDEX_FILES:
+        try:
+            os.remove(os.path.join(path, f'{name}.npy'))
+        except FileNotFoundError:
+            pass
+
+    size = sum(a.nbytes for a in arrays.values())
+    print(f"Indexed {len(rows)} horse names ({size / 1024 / 1024:.1f} MB) in {time.perf_counter() - start:.1f} s.")
+    return len(rows)
+
+# --- 検索 ---
+
+class NameIndex:
+    """馬名の索引をメモリマップで開き、馬名から horse_id を引く
+
+    キーはソート済みの固定長バイト列の配列で、完全一致・前方一致は二分探索で引く。
+    あいまい検索は1文字を消したキーどうしの一致で候補を集め、編集距離で確かめる。
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    @classmethod
+    def load(cls, path=NAME_INDEX_PATH):
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"Name index not found at {path}. Run name_index.py --build first.")
+        for attempt in range(LOAD_RETRIES):
+            # 読み込み中に作り直されて版が消えた場合は CURRENT を読み直す
+            try:
+                current = current_index_dir(path)
+                return cls({name: np.load(os.path.join(current, f'{name}.npy'), mmap_mode='r') for name in INDEX_FILES})
+            except FileNotFoundError:
+                if attempt == LOAD_RETRIES - 1:
+                    raise
+                time.sleep(0.05)
+
+    def __len__(self):
+        return len(self.arrays['horse_ids'])
+
+    def _range(self, keys, needle, prefix=False):
+        """ソート済みのキーのうち needle と一致 (prefix=Trueなら前方一致) する範囲"""
+        width = keys.dtype.itemsize
+        if not needle or len(needle) > width:
+            return 0, 0
+        lo = int(np.searchsorted(keys, needle, side='left'))
+        if prefix and len(needle) < width:
+            # UTF-8のバイト列に0xffは現れないため、前方一致の上限に使える
+            hi = int(np.searchsorted(keys, needle + b'\xff', side='left'))
+        else:
+            hi = int(np.searchsorted(keys, needle, side='right'))
+        return lo, hi
+
+    def _match(self, row):
+        """行番号を (horse_id, 馬名, 生年月日) にする"""
+        return (
+            self.arrays['horse_ids'][row].decode(), self.arrays['names'][row].decode(),
+            self.arrays['birth_dates'][row].decode() or None,
+        )
+
+    def _matches(self, rows):
+        """行番号のリストを新しい馬から並べた _match のリストにする"""
+        rows = sorted(set(int(r) for r in rows), key=lambda r: self.arrays['birth_dates'][r], reverse=True)
+        return [self._match(r) for r in rows]
+
+    def _key_arrays(self, name):
+        """入力がローマ字ならローマ字のキー、それ以外はカナのキーで引く"""
+        kana = normalize_kana(name)
+        if kana.isascii():
+            return self.arrays['romaji'], self.arrays['romaji_rows'], romaji_key(name).encode()
+        return self.arrays['kana'], self.arrays['kana_rows'], kana.encode()
+
+    def exact(self, name):
+        keys, rows, needle = self._key_arrays(name)
+        lo, hi = self._range(keys, needle)
+        return self._matches(rows[lo:hi])
+
+    def prefix(self, text, limit=20):
+        keys, rows, needle = self._key_arrays(text)
+        lo, hi = self._range(keys, needle, prefix=True)
+        return self._matches(rows[lo:min(hi, lo + limit)])
+
+    def fuzzy(self, name, max_distance=2, limit=10):
+        """カナのキーで編集距離 max_distance 以内の馬を近い順に返す"""
+        kana = normalize_kana(name)
+        if not kana or kana.isascii():
+            return [match + (0,) for match in self.exact(name)]
+        keys, rows = self.arrays['deletions'], self.arrays['deletion_rows']
+        candidates = set()
+        for variant in deletions(kana):
+            lo, hi = self._range(keys, variant.encode())
+            candidates.update(int(r) for r in rows[lo:hi])
+        scored = []
+        for row in candidates:
+            distance = edit_distance(kana, normalize_kana(self.arrays['names'][row].decode()))
+            if distance <= max_distance:
+                scored.append((distance, row))
+        # 近い順、同じ距離なら新しい馬から
+        scored.sort(key=lambda item: (item[0], -int(self.arrays['birth_dates'][item[1]].replace(b'-', b'') or 0)))
+        return [self._match(row) + (distance,) for distance, row in scored[:limit]]
+
+    def lookup(self, name, max_distance=0):
+        """馬名から horse_id を1つ返す (同名は新しい馬を優先、見つからなければNone)
+
+        既定は完全一致のみ。出馬表の新馬などが索引にない場合に別の馬へ
+        黙って読み替えないよう、あいまい一致は max_distance を指定したときだけ使う。
+        """
+        matches = self.exact(name)
+        if not matches and max_distance > 0:
+            matches = self.fuzzy(name, max_distance=max_distance, limit=1)
+        return matches[0][0] if matches else None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='馬名の検索索引を作成・検索する')
+    parser.add_argument('names', nargs='*', help='検索する馬名 (カナまたはローマ字)')
+    parser.add_argument('--build', action='store_true', help='horses から索引を作り直す')
+    parser.add_argument('--prefix', action='store_true', help='前方一致で検索する')
+    parser.add_argument('--fuzzy', action='store_true', help='あいまい検索する (カナのみ)')
+    args = parser.parse_args()
+
+    if args.build or not os.path.isdir(NAME_INDEX_PATH):
+        build_index()
+    index = NameIndex.load()
+    for name in args.names:
+        start = time.perf_counter()
+        if args.prefix:
+            matches = index.prefix(name)
+        elif args.fuzzy:
+            matches = index.fuzzy(name)
+        else:
+            matches = index.exact(name)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"{name}: {len(matches)} matches ({elapsed:.3f} ms)")
+        for match in matches:
+            print('  ' + '  '.join(str(v) for v in match if v is not None))
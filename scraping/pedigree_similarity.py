@@ -0,0 +1,288 @@
+import os
+import time
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DB_PATH = os.getenv('DB_FILE_PATH')
+if not DB_PATH:
+    raise ValueError("DB_FILE_PATH is not set in .env file")
+
+# MinHashの長さとLSHの分け方 (16バンド×4行: 類似度0.5で約63%、0.7で約98%が候補になる)
+NUM_PERM = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERM // BANDS
+# 5代血統表の世代ごとの重み (血の濃さに比例させ、父母は5代目の16倍)
+MAX_GENERATION = 5
+# ハッシュは 2^31-1 を法とする (a*x+b) で、uint64で桁あふれしない
+PRIME = np.uint64(2 ** 31 - 1)
+SEED = 20240501
+# 1バンドのバケツから取り出す候補の上限 (人気種牡馬の産駒などで巨大になるバケツ対策)
+MAX_BUCKET_CANDIDATES = 2000
+# 署名をまとめて計算する頭数 (一時配列は 頭数×160×NUM_PERM 個)
+SIGNATURE_BATCH = 1000
+
+_rng = np.random.default_rng(SEED)
+_HASH_A = _rng.integers(1, 2 ** 31 - 1, NUM_PERM, dtype=np.uint64)
+_HASH_B = _rng.integers(0, 2 ** 31 - 1, NUM_PERM, dtype=np.uint64)
+_BAND_MIX = _rng.integers(1, 2 ** 63, ROWS_PER_BAND, dtype=np.uint64) | np.uint64(1)
+
+# 日付を YYYYMMDD の整数で比べるときの桁と、日付の分からないレースの値
+DATE_SPAN = 10 ** 8
+UNKNOWN_DATE = DATE_SPAN - 2
+
+def date_numbers(dates, missing):
+    """'YYYY-MM-DD' の並びを YYYYMMDD の整数の配列にする (欠損は missing)"""
+    numbers = pd.to_numeric(pd.Series(dates, dtype=object).str.replace('-', '', regex=False), errors='coerce')
+    return numbers.fillna(missing).to_numpy(np.int64)
+
+def generation_weight(generation):
+    return np.left_shift(1, MAX_GENERATION - np.asarray(generation, dtype=np.int64))
+
+def minhash_signatures(horse_keys, ancestor_keys, generations):
+    """(馬, 祖先, 世代) の行から馬ごとのMinHash署名を計算する
+
+    行は馬ごとにまとまっている前提。祖先は世代の重みの数だけ別々の要素 (祖先キー×64+番号) として
+    集合に入れ、重み付きの集合のJaccard係数を近似する。同じ祖先が複数の位置に
+    現れる (インブリード) 場合は重みを合計する。(馬キーの配列, 署名 uint32[馬, NUM_PERM]) を返す。
+    """
+    df = pd.DataFrame({'horse': horse_keys, 'ancestor': ancestor_keys, 'weight': generation_weight(generations)})
+    df = df.groupby(['horse', 'ancestor'], sort=False, as_index=False)['weight'].sum()
+    horses = df['horse'].to_numpy(np.int64)
+    weights = df['weight'].to_numpy(np.int64)
+
+    # 重みの数だけ行を複製し、何番目の複製かを要素に含める
+    tokens_per_row = np.repeat(np.arange(len(weights)), weights)
+    copy_no = np.arange(len(tokens_per_row)) - np.repeat(np.cumsum(weights) - weights, weights)
+    tokens = (df['ancestor'].to_numpy(np.uint64)[tokens_per_row] * np.uint64(64) + copy_no.astype(np.uint64)) % PRIME
+    token_horses = horses[tokens_per_row]
+
+    starts = np.flatnonzero(np.diff(token_horses, prepend=-1))
+    keys = token_horses[starts]
+    signatures = np.empty((len(keys), NUM_PERM), dtype=np.uint32)
+    # 一時配列が大きくなりすぎないよう、馬のまとまりごとに計算する
+    for first in range(0, len(keys), SIGNATURE_BATCH):
+        last = min(first + SIGNATURE_BATCH, len(keys))
+        lo = starts[first]
+        hi = starts[last] if last < len(keys) else len(tokens)
+        hashed = (_HASH_A[:, None] * tokens[None, lo:hi] + _HASH_B[:, None]) % PRIME
+        signatures[first:last] = np.minimum.reduceat(hashed, starts[first:last] - lo, axis=1).T
+    return keys, signatures
+
+def band_keys(signatures):
+    """署名をバンドごとに1つの64ビット値にまとめる (uint64[馬, BANDS])"""
+    rows = signatures.astype(np.uint64).reshape(len(signatures), BANDS, ROWS_PER_BAND)
+    return (rows * _BAND_MIX[None, None, :]).sum(axis=2)
+
+PEDIGREE_ROWS_QUERY = '''
+SELECT hk.key AS horse_key, ak.key AS ancestor_key, p.generation
+FROM pedigrees p
+JOIN horse_keys hk ON hk.horse_id = p.horse_id
+JOIN horse_keys ak ON ak.horse_id = p.ancestor_id
+{condition}
+ORDER BY hk.key
+'''
+
+def add_signatures(conn, horse_ids=None):
+    """血統表がありまだ署名のない馬の署名を pedigree_signatures に保存する
+
+    horse_ids を渡した場合はその馬だけ (scraper_horse.py が保存のたびに呼ぶ)。
+    子孫の血統表から導出して5代目が欠けている馬 ('pedigree_derived' タスクが残る馬) は除く。
+    コミットは呼び出し側で行う。保存した頭数を返す。
+    """
+    condition = '''WHERE NOT EXISTS (SELECT 1 FROM pedigree_signatures s WHERE s.horse_key = hk.key)
+    AND NOT EXISTS (SELECT 1 FROM scrape_queue q WHERE q.task = 'pedigree_derived' AND q.entity_id = p.horse_id)'''
+    if horse_ids is None:
+        df = pd.read_sql_query(PEDIGREE_ROWS_QUERY.format(condition=condition), conn)
+    else:
+        horse_ids = list(horse_ids)
+        # SQLiteの変数の上限を超えないよう分けて読む
+        chunks = [horse_ids[i:i + 500] for i in range(0, len(horse_ids), 500)]
+        frames = [
+            pd.read_sql_query(PEDIGREE_ROWS_QUERY.format(
+                condition=condition + f" AND p.horse_id IN ({','.join('?' * len(chunk))})"), conn, params=chunk)
+            for chunk in chunks
+        ]
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if df.empty:
+        return 0
+    keys, signatures = minhash_signatures(df['horse_key'], df['ancestor_key'], df['generation'])
+    conn.executemany(
+        "INSERT OR IGNORE INTO pedigree_signatures (horse_key, signature) VALUES (?, ?)",
+        [(int(key), sig.astype('<u4').tobytes()) for key, sig in zip(keys, signatures)])
+    return len(keys)
+
+class PedigreeIndex:
+    """署名を読み込み、バンドごとにソートしたキーで似た血統の馬を引く
+
+    バンドのキーが一致した馬 (同じバケツの馬) を候補とし、署名の一致率で
+    推定したJaccard係数の高い順に返す。
+    """
+
+    def __init__(self, keys, signatures):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.signatures = np.zeros((0, NUM_PERM), dtype=np.uint32)
+        self.add(keys, signatures)
+
+    @classmethod
+    def load(cls, db_path=DB_PATH):
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute("SELECT horse_key, signature FROM pedigree_signatures ORDER BY horse_key").fetchall()
+        finally:
+            conn.close()
+        keys = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        signatures = np.frombuffer(b''.join(row[1] for row in rows), dtype='<u4').reshape(len(rows), NUM_PERM)
+        return cls(keys, signatures)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, keys, signatures):
+        """署名を追加し、バンドごとのソート済みの表を作り直す"""
+        self.keys = np.concatenate([self.keys, np.asarray(keys, dtype=np.int64)])
+        self.signatures = np.concatenate([self.signatures, np.asarray(signatures, dtype=np.uint32)])
+        bands = band_keys(self.signatures).T
+        self.band_order = np.argsort(bands, axis=1, kind='stable')
+        self.band_sorted = np.take_along_axis(bands, self.band_order, axis=1)
+        self.position = {int(key): i for i, key in enumerate(self.keys)}
+
+    def query(self, signatures, k=10, exclude=None):
+        """署名ごとに似た馬を (馬キー, 推定類似度) の配列の組で返す
+
+        exclude に署名と同じ長さの馬キーを渡すと、その馬自身は結果から除く。
+        """
+        query_bands = band_keys(np.asarray(signatures, dtype=np.uint32))
+        # 全クエリ・全バンドのバケツの範囲を一度に求める
+        lo = np.empty(query_bands.shape, dtype=np.int64)
+        hi = np.empty(query_bands.shape, dtype=np.int64)
+        for band in range(BANDS):
+            lo[:, band] = np.searchsorted(self.band_sorted[band], query_bands[:, band], side='left')
+            hi[:, band] = np.searchsorted(self.band_sorted[band], query_bands[:, band], side='right')
+        hi = np.minimum(hi, lo + MAX_BUCKET_CANDIDATES)
+
+        results = []
+        for i, signature in enumerate(signatures):
+            parts = [self.band_order[band, lo[i, band]:hi[i, band]] for band in range(BANDS) if hi[i, band] > lo[i, band]]
+            candidates = np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+            if exclude is not None:
+                candidates = candidates[self.keys[candidates] != exclude[i]]
+            similarity = (self.signatures[candidates] == signature[None, :]).mean(axis=1)
+            top = np.argsort(-similarity, kind='stable')[:k]
+            results.append((self.keys[candidates[top]], similarity[top]))
+        return results
+
+    def similar(self, horse_keys, k=10):
+        """索引にある馬について、自身を除いた似た馬を返す (索引にない馬は空)"""
+        horse_keys = np.asarray(horse_keys, dtype=np.int64)
+        found = [key for key in horse_keys if int(key) in self.position]
+        results = dict(zip(found, self.query(
+            self.signatures[[self.position[int(key)] for key in found]], k, exclude=np.array(found, dtype=np.int64))))
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0))
+        return [results.get(key, empty) for key in horse_keys]
+
+def similar_horses(horse_ids, k=10, db_path=DB_PATH, index=None):
+    """出馬表の馬などをまとめて検索し、(horse_id, similar_horse_id, similarity) のDataFrameを返す
+
+    血統表はあるが署名のない馬は、その場で署名を作って保存してから検索する。
+    """
+    from entity_keys import EntityKeys
+    keys = EntityKeys.load(db_path, kinds=('horse',))['horse']
+    conn = sqlite3.connect(db_path)
+    try:
+        if add_signatures(conn, horse_ids):
+            conn.commit()
+            index = None
+    finally:
+        conn.close()
+    index = index or PedigreeIndex.load(db_path)
+
+    query_keys = keys.keys(list(horse_ids))
+    rows = []
+    for horse_id, (similar_keys, similarity) in zip(horse_ids, index.similar(query_keys, k)):
+        rows.extend(zip([horse_id] * len(similar_keys), keys.ids_of(similar_keys), similarity))
+    return pd.DataFrame(rows, columns=['horse_id', 'similar_horse_id', 'similarity'])
+
+def borrowed_features(horse_ids, k=20, db_path=DB_PATH, index=None, as_of=None):
+    """出走歴のない馬に、血統の似た馬の成績を類似度で重み付けした平均を返す
+
+    似た馬のうち出走歴のある馬だけを使う。列は sim_horses (使った頭数)、
+    sim_win_rate / sim_top3_rate / sim_avg_rank で、行は horse_ids と同じ順。
+    as_of に日付 (1つ、または horse_ids と同じ長さの並び) を渡すと、その日より前の
+    レースの成績だけを使う (学習データに使う場合に未来の結果を含めないため)。
+    """
+    horse_ids = list(horse_ids)
+    dated = as_of is not None
+    as_of = [as_of] * len(horse_ids) if as_of is None or isinstance(as_of, str) else list(as_of)
+    pairs = similar_horses(list(dict.fromkeys(horse_ids)), k, db_path, index)
+    similar_ids = pd.Index(sorted(set(pairs['similar_horse_id'].dropna())))
+    conn = sqlite3.connect(db_path)
+    try:
+        # 似た馬が1頭もいなくても同じ列の結果になるよう、IN () のまま問い合わせる
+        runs = pd.read_sql_query(f'''
+        SELECT r.horse_id AS similar_horse_id, ra.date, r.rank
+        FROM results r LEFT JOIN races ra ON ra.race_id = r.race_id
+        WHERE r.rank > 0 AND r.horse_id IN ({','.join('?' * len(similar_ids))})
+        ''', conn, params=list(similar_ids))
+    finally:
+        conn.close()
+
+    # 似た馬ごと・日付順に並べた累積の成績から、as_of より前の分を二分探索で引く
+    # (日付は YYYYMMDD の整数。日付の分からないレースは as_of を指定したときは使わない)
+    codes = similar_ids.get_indexer(runs['similar_horse_id']).astype(np.int64)
+    dates = date_numbers(runs['date'], UNKNOWN_DATE)
+    order = np.lexsort((dates, codes))
+    run_keys = codes[order] * DATE_SPAN + dates[order]
+    ranks = runs['rank'].to_numpy(float)[order]
+    cumulative = {
+        name: np.concatenate([[0.0], np.cumsum(values)])
+        for name, values in (('n', np.ones_like(ranks)), ('win', ranks == 1), ('top3', ranks <= 3), ('rank', ranks))
+    }
+
+    m = pd.DataFrame({'row': np.arange(len(horse_ids)), 'horse_id': horse_ids, 'as_of': as_of}).merge(pairs, on='horse_id')
+    pair_codes = similar_ids.get_indexer(m['similar_horse_id']).astype(np.int64)
+    limits = date_numbers(m['as_of'], DATE_SPAN - 1)
+    lo = np.searchsorted(run_keys, pair_codes * DATE_SPAN, side='left')
+    hi = np.searchsorted(run_keys, pair_codes * DATE_SPAN + limits, side='left')
+    totals = {name: values[hi] - values[lo] for name, values in cumulative.items()}
+    used = totals['n'] > 0
+    weights = np.where(used, m['similarity'].to_numpy(float), 0.0)
+    n = np.maximum(totals['n'], 1)
+
+    rows = m['row'].to_numpy()
+    weight_sums = np.bincount(rows, weights, minlength=len(horse_ids))
+    features = pd.DataFrame({'horse_id': horse_ids})
+    if dated:
+        features['as_of'] = as_of
+    features['sim_horses'] = np.bincount(rows, used, minlength=len(horse_ids)).astype(int)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for name, total in (('win_rate', 'win'), ('top3_rate', 'top3'), ('avg_rank', 'rank')):
+            features[f'sim_{name}'] = np.bincount(rows, weights * totals[total] / n, minlength=len(horse_ids)) / weight_sums
+    return features
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='5代血統表のMinHash署名を作り、血統の似た馬を検索する')
+    parser.add_argument('horse_ids', nargs='*', help='似た馬を検索する馬ID')
+    parser.add_argument('--k', type=int, default=10, help='1頭あたりの件数')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        start = time.perf_counter()
+        added = add_signatures(conn)
+        conn.commit()
+        print(f"Added signatures for {added} horses in {time.perf_counter() - start:.1f} s.")
+    finally:
+        conn.close()
+    if args.horse_ids:
+        start = time.perf_counter()
+        index = PedigreeIndex.load()
+        print(f"Loaded {len(index)} signatures in {(time.perf_counter() - start) * 1000:.0f} ms.")
+        start = time.perf_counter()
+        result = similar_horses(args.horse_ids, args.k, index=index)
+        print(f"Queried {len(args.horse_ids)} horses in {(time.perf_counter() - start) * 1000:.1f} ms.")
+        print(result.round(3).to_string(index=False))
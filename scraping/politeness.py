@@ -0,0 +1,162 @@
+import os
+import time
+import threading
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+from metrics import metrics
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+
+# リクエスト間隔の既定値(秒)。ホストごとの上書きは SCRAPER_HOST_INTERVALS に
+# "www.jbis.or.jp=0.5:10,db.netkeiba.com=1:30" (ホスト=最小間隔:最大間隔) の形式で指定する
+MIN_INTERVAL = float(os.getenv('SCRAPER_MIN_INTERVAL', '0.5'))
+MAX_INTERVAL = float(os.getenv('SCRAPER_MAX_INTERVAL', '30'))
+START_INTERVAL = float(os.getenv('SCRAPER_START_INTERVAL', '1.0'))
+HOST_INTERVALS = os.getenv('SCRAPER_HOST_INTERVALS', '')
+
+# AIMD の係数: 成功ごとに毎秒のリクエスト数を加算し、失敗・遅延時は乗算で減らす
+ADDITIVE_RATE_STEP = 0.02
+ERROR_BACKOFF = 0.5
+SLOW_BACKOFF = 0.8
+# 応答時間が基準値のこの倍数を超えたらサーバーが混雑しているとみなす
+SLOW_FACTOR = 3.0
+# 応答時間・エラー率の指数移動平均の係数
+EWMA_ALPHA = 0.2
+# 429・5xxに加えて、アクセス制限 (WAF) の応答として返るステータス (netkeibaは400を返す)
+BLOCK_STATUSES = {400, 403}
+# ステータスの分からないSelenium経由の取得で、アクセス制限・エラーのページとみなす文言
+BLOCK_PAGE_MARKERS = ('403 Forbidden', '400 Bad Request', 'Access Denied', '429 Too Many Requests',
+                      '503 Service', 'アクセスが制限', 'アクセスを制限')
+
+def is_blocked_page(title, html=''):
+    """ページのタイトル・本文の先頭がアクセス制限・エラーのページかどうか"""
+    head = (title or '') + (html or '')[:2048]
+    return any(marker in head for marker in BLOCK_PAGE_MARKERS)
+
+class HostBudget:
+    """1ホスト分のリクエスト間隔と応答状況"""
+
+    def __init__(self, min_interval, max_interval, start_interval):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min(max(start_interval, min_interval), max_interval)
+        self.next_time = 0.0
+        self.latency = None
+        self.baseline_latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+
+    def set_rate(self, rate):
+        """毎秒のリクエスト数から間隔を設定する (上下限の範囲内)"""
+        self.interval = min(max(1.0 / rate, self.min_interval), self.max_interval)
+
+class PolitenessScheduler:
+    """ホストごとのリクエスト間隔を応答時間とエラー率からAIMDで調整するスケジューラ
+
+    間隔はリクエスト開始時刻同士で測るため、応答待ちの時間も間隔に含まれる。
+    スレッドセーフで、複数スレッドから同じホストへ取得しても間隔は守られる。
+    """
+
+    def __init__(self, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL,
+                 start_interval=START_INTERVAL, host_intervals=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.start_interval = start_interval
+        self.host_intervals = host_intervals or {}
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        host_intervals = {}
+        for item in HOST_INTERVALS.split(','):
+            if '=' not in item:
+                continue
+            host, bounds = item.split('=', 1)
+            low, _, high = bounds.partition(':')
+            host_intervals[host.strip()] = (float(low), float(high or MAX_INTERVAL))
+        return cls(host_intervals=host_intervals)
+
+    def _budget(self, host):
+        budget = self.hosts.get(host)
+        if budget is None:
+            low, high = self.host_intervals.get(host, (self.min_interval, self.max_interval))
+            budget = self.hosts[host] = HostBudget(low, high, max(self.start_interval, low))
+        return budget
+
+    def wait(self, url):
+        """次のリクエスト枠まで待機する"""
+        host = urlparse(url).netloc
+        with self.lock:
+            budget = self._budget(host)
+            now = time.monotonic()
+            slot = max(now, budget.next_time)
+            budget.next_time = slot + budget.interval
+        delay = slot - now
+        if delay > 0:
+            with metrics.stage('sleep'):
+                time.sleep(delay)
+
+    def record(self, url, elapsed, status=None, error=False, retry_after=None):
+        """リクエストの結果を記録し、ホストの間隔を調整する
+
+        error: 通信エラー・タイムアウトなど応答が得られなかった場合
+        status: HTTPステータス (429・5xx・BLOCK_STATUSES はサーバー側の制限・障害とみなす)
+        retry_after: Retry-Afterヘッダの秒数
+
+        それ以外の2xx以外の応答 (404など) は間隔を広げないが、狭めることもしない。
+        """
+        host = urlparse(url).netloc
+        throttled = error or status == 429 or status in BLOCK_STATUSES or (status is not None and status >= 500)
+        succeeded = status is None or 200 <= status < 300
+        with self.lock:
+            budget = self._budget(host)
+            budget.requests += 1
+            budget.error_rate += EWMA_ALPHA * ((1.0 if throttled else 0.0) - budget.error_rate)
+            rate = 1.0 / budget.interval
+
+            if throttled:
+                budget.set_rate(rate * ERROR_BACKOFF)
+                if retry_after:
+                    budget.next_time = max(budget.next_time, time.monotonic() + retry_after)
+                return
+
+            budget.latency = elapsed if budget.latency is None else budget.latency + EWMA_ALPHA * (elapsed - budget.latency)
+            if budget.baseline_latency is None or budget.latency < budget.baseline_latency:
+                budget.baseline_latency = budget.latency
+
+            if budget.latency > budget.baseline_latency * SLOW_FACTOR:
+                budget.set_rate(rate * SLOW_BACKOFF)
+            elif succeeded and budget.error_rate < 0.05:
+                budget.set_rate(rate + ADDITIVE_RATE_STEP)
+
+    def share(self, parts):
+        """同じホストを複数プロセスで分担する場合に、間隔の上下限をparts倍にする"""
+        with self.lock:
+            self.min_interval *= parts
+            self.start_interval *= parts
+            self.host_intervals = {h: (low * parts, high * parts) for h, (low, high) in self.host_intervals.items()}
+            self.hosts.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                host: {
+                    'interval': b.interval,
+                    'latency': b.latency,
+                    'baseline_latency': b.baseline_latency,
+                    'error_rate': b.error_rate,
+                    'requests': b.requests,
+                }
+                for host, b in self.hosts.items()
+            }
+
+def parse_retry_after(value):
+    """Retry-Afterヘッダ(秒数)を解釈する (日付形式などは無視)"""
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+scheduler = PolitenessScheduler.from_env()
@@ -0,0 +1,300 @@
+import os
+import time
+import sqlite3
+import argparse
+import traceback
+import unicodedata
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from dotenv import load_dotenv
+from metrics import metrics
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DB_PATH = os.getenv('DB_FILE_PATH')
+if not DB_PATH:
+    raise ValueError("DB_FILE_PATH is not set in .env file")
+
+# 索引を保存するファイル (既定は keiba.db と同じ場所の keiba.conditions.npz)
+CONDITION_INDEX_PATH = os.getenv('CONDITION_INDEX_PATH') or os.path.splitext(DB_PATH)[0] + '.conditions.npz'
+
+# 「同じ条件」とみなす races の列
+CONDITION_FIELDS = ('venue', 'course_type', 'distance', 'state', 'race_class')
+# 2019年の条件名の変更前後を同じクラスとして扱う
+# (races.race_class は scraper_race.py がレース条件の行から保存する。既存のレースは --backfill-class で取得し直す)
+CLASS_ALIASES = {
+    '500万下': '1勝クラス', '1000万下': '2勝クラス', '1600万下': '3勝クラス',
+    '500万円以下': '1勝クラス', '1000万円以下': '2勝クラス', '1600万円以下': '3勝クラス',
+    '1勝C': '1勝クラス', '2勝C': '2勝クラス', '3勝C': '3勝クラス',
+    'オープン': 'OP',
+}
+# --backfill-class で同時に取得するレース数
+PREFETCH_RACES = 4
+# 日付は1900-01-01からの日数で持つ
+EPOCH = np.datetime64('1900-01-01', 'D')
+
+def canonical_class(race_class):
+    """クラス名の全角・半角と新旧の表記をそろえる (不明は空文字)"""
+    text = unicodedata.normalize('NFKC', race_class or '').replace(' ', '')
+    return CLASS_ALIASES.get(text, text)
+
+def condition_key(venue, course_type, distance, state, race_class):
+    """races の1行の条件を比較用のタプルにする"""
+    return (
+        unicodedata.normalize('NFKC', venue or ''), unicodedata.normalize('NFKC', course_type or ''),
+        int(distance or 0), unicodedata.normalize('NFKC', state or ''), canonical_class(race_class),
+    )
+
+def to_days(dates):
+    """'YYYY-MM-DD' の並びを EPOCH からの日数 (int64) にする"""
+    return (np.asarray(dates, dtype='datetime64[D]') - EPOCH).astype(np.int64)
+
+class ConditionIndex:
+    """条件ごとに日付順に並べたレースの索引
+
+    レースを (条件番号, 日付, レースID) の順に並べ、条件番号と日付をまとめた
+    64ビットの値の二分探索で「日付Dより前の同じ条件のレース」の範囲を求める。
+    多数の問い合わせも searchsorted 1回で答える。refresh() は前回読んだ後に
+    追加された races の行 (rowid が大きい行) と、前回は日付・クラスが未取得で
+    索引に入れられなかった行 (pending_rowids) だけを読む。
+    """
+
+    def __init__(self):
+        self.conditions = []
+        self.condition_ids = {}
+        self.race_ids = np.zeros(0, dtype='S1')
+        self.days = np.zeros(0, dtype=np.int32)
+        self.cond = np.zeros(0, dtype=np.int32)
+        self.last_rowid = 0
+        self.pending_rowids = np.zeros(0, dtype=np.int64)
+        self._sort()
+
+    @classmethod
+    def load(cls, path=CONDITION_INDEX_PATH, db_path=DB_PATH, refresh=True):
+        """保存した索引を読み込み、その後に追加されたレースを反映する"""
+        index = cls()
+        # pending_rowids のない古い索引はクラスが空のまま作られているため読み込まず作り直す
+        data = np.load(path) if os.path.exists(path) else None
+        if data is not None and 'pending_rowids' not in data.files:
+            data.close()
+            data = None
+        if data is not None:
+            with data:
+                index.last_rowid = int(data['last_rowid'])
+                index.pending_rowids = data['pending_rowids']
+                index.race_ids = data['race_ids']
+                index.days = data['days']
+                index.cond = data['cond']
+                index.conditions = [
+                    (venue, course_type, int(distance), state, race_class)
+                    for venue, course_type, distance, state, race_class in zip(
+                        *(data[f'condition_{field}'].tolist() for field in CONDITION_FIELDS))
+                ]
+            index.condition_ids = {key: i for i, key in enumerate(index.conditions)}
+            index._sort()
+        if refresh:
+            index.refresh(db_path)
+        return index
+
+    def save(self, path=CONDITION_INDEX_PATH):
+        """一時ファイルに書いてから入れ替える"""
+        arrays = {
+            'last_rowid': np.array(self.last_rowid), 'pending_rowids': self.pending_rowids, 'race_ids': self.race_ids,
+            'days': self.days, 'cond': self.cond,
+        }
+        for i, field in enumerate(CONDITION_FIELDS):
+            values = [c[i] for c in self.conditions]
+            arrays[f'condition_{field}'] = np.array(values, dtype=np.int32 if field == 'distance' else str)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.race_ids)
+
+    def refresh(self, db_path=DB_PATH):
+        """前回より後に追加されたレースを読み込み、追加した件数を返す
+
+        日付かクラスが未取得 (NULL) のレースは条件を比べられないため索引に入れず、
+        pending_rowids に残して次回以降に読み直す (クラスが見つからなかったページは空文字で保存済み)。
+        """
+        columns = f"rowid, race_id, date, {', '.join(CONDITION_FIELDS)}"
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute(f"SELECT {columns} FROM races WHERE rowid > ? ORDER BY rowid", (self.last_rowid,)).fetchall()
+            pending = self.pending_rowids.tolist()
+            for i in range(0, len(pending), 500):
+                chunk = pending[i:i + 500]
+                rows += conn.execute(
+                    f"SELECT {columns} FROM races WHERE rowid IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+        finally:
+            conn.close()
+        if rows:
+            self.last_rowid = max(self.last_rowid, max(row[0] for row in rows))
+        ready = [row for row in rows if row[2] and row[-1] is not None]
+        self.pending_rowids = np.array(sorted(row[0] for row in rows if not (row[2] and row[-1] is not None)), dtype=np.int64)
+        rows = ready
+        # 同じレースIDが入れ直された場合に重複させない
+        known = self.positions([row[1] for row in rows]) >= 0
+        rows = [row for row, k in zip(rows, known) if not k]
+        if not rows:
+            return 0
+
+        cond = np.empty(len(rows), dtype=np.int32)
+        for i, row in enumerate(rows):
+            key = condition_key(*row[3:])
+            if key not in self.condition_ids:
+                self.condition_ids[key] = len(self.conditions)
+                self.conditions.append(key)
+            cond[i] = self.condition_ids[key]
+        new_ids = np.array([row[1].encode() for row in rows], dtype='S')
+        width = max(self.race_ids.dtype.itemsize, new_ids.dtype.itemsize)
+        self.race_ids = np.concatenate([self.race_ids.astype(f'S{width}'), new_ids.astype(f'S{width}')])
+        self.days = np.concatenate([self.days, to_days([row[2] for row in rows]).astype(np.int32)])
+        self.cond = np.concatenate([self.cond, cond])
+        self._sort()
+        return len(rows)
+
+    def _sort(self):
+        """(条件番号, 日付, レースID) 順に並べ、探索用の値と各レースの位置を作り直す"""
+        order = np.lexsort((self.race_ids, self.days, self.cond))
+        self.race_ids, self.days, self.cond = self.race_ids[order], self.days[order], self.cond[order]
+        self.sorted_keys = self._keys(self.cond, self.days)
+        # レースIDから位置を引くための二分探索用の配列
+        self.id_order = np.argsort(self.race_ids, kind='stable')
+        self.sorted_ids = self.race_ids[self.id_order]
+
+    @staticmethod
+    def _keys(cond, days):
+        return (np.asarray(cond, dtype=np.int64) << 32) | np.asarray(days, dtype=np.int64)
+
+    def condition_id(self, venue, course_type, distance, state, race_class):
+        """条件の番号を返す (索引にない条件は-1)"""
+        return self.condition_ids.get(condition_key(venue, course_type, distance, state, race_class), -1)
+
+    def positions(self, race_ids):
+        """レースIDの並びを索引内の位置の配列にする (索引にないレースは-1)"""
+        if not len(self.sorted_ids) or not len(race_ids):
+            return np.full(len(race_ids), -1)
+        needles = np.array([(r or '').encode() for r in race_ids], dtype='S')
+        haystack = self.sorted_ids
+        # 切り詰めによる誤一致を避けるため、長い方の幅にそろえて比較する
+        width = max(needles.dtype.itemsize, haystack.dtype.itemsize)
+        needles, haystack = needles.astype(f'S{width}'), haystack.astype(f'S{width}')
+        pos = np.minimum(np.searchsorted(haystack, needles), len(haystack) - 1)
+        return np.where(haystack[pos] == needles, self.id_order[pos], -1)
+
+    def ranges(self, cond, days, n=10, window_days=None):
+        """条件番号と日付の配列について、その日より前の同じ条件の直近n件の範囲 (lo, hi) を返す
+
+        当日のレースは含まない。window_days を指定すると、その日数より古いレースも除く。
+        """
+        cond = np.asarray(cond, dtype=np.int64)
+        days = np.asarray(days, dtype=np.int64)
+        hi = np.searchsorted(self.sorted_keys, self._keys(cond, days), side='left')
+        oldest = days - window_days if window_days is not None else np.zeros_like(days)
+        lo = np.maximum(np.searchsorted(self.sorted_keys, self._keys(cond, oldest), side='left'), hi - n)
+        # 索引にない条件は空の範囲にする
+        lo = np.where(cond >= 0, lo, hi)
+        return lo, hi
+
+    def comparable(self, race_ids, n=10, window_days=None):
+        """レースごとに、それより前の同じ条件の直近n件を (race_id, past_race_id, past_date) で返す
+
+        past_race_id は新しい順。索引にないレースは結果に含まれない。
+        """
+        race_ids = list(race_ids)
+        pos = self.positions(race_ids)
+        found = pos >= 0
+        lo, hi = self.ranges(self.cond[pos[found]], self.days[pos[found]], n, window_days)
+        counts = hi - lo
+        # 範囲を新しい順に展開する
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        past = np.repeat(hi, counts) - 1 - offsets
+        return pd.DataFrame({
+            'race_id': np.repeat(np.array(race_ids, dtype=object)[found], counts),
+            'past_race_id': self.race_ids[past].astype(str),
+            'past_date': (EPOCH + self.days[past].astype('timedelta64[D]')).astype(str),
+        })
+
+    def query(self, venue, course_type, distance, state, race_class, date, n=10, window_days=None):
+        """条件と日付を直接指定して、その日より前の直近n件のレースIDを新しい順に返す (出馬表用)"""
+        lo, hi = self.ranges([self.condition_id(venue, course_type, distance, state, race_class)],
+                             to_days([date]), n, window_days)
+        return self.race_ids[lo[0]:hi[0]][::-1].astype(str).tolist()
+
+def update_index(db_path=DB_PATH, path=CONDITION_INDEX_PATH, full=False):
+    """新しいレースを索引に反映して保存する (full=True で作り直す)"""
+    started = time.perf_counter()
+    index = ConditionIndex.load(path, db_path, refresh=False) if not full else ConditionIndex()
+    last_rowid, pending = index.last_rowid, len(index.pending_rowids)
+    added = index.refresh(db_path)
+    if added or full or index.last_rowid != last_rowid or len(index.pending_rowids) != pending or not os.path.exists(path):
+        index.save(path)
+    print(f"Added {added} races to the condition index ({len(index)} races, {len(index.conditions)} conditions, "
+          f"{len(index.pending_rowids)} waiting for date/class) in {(time.perf_counter() - started) * 1000:.0f} ms.")
+    return index
+
+def backfill_race_classes(db_path=DB_PATH, limit=None):
+    """クラスが未取得の既存のレースの結果ページを取得し直して races.race_class を埋める
+
+    ページからクラスが見つからなければ空文字を保存し、二度は取得しない。
+    取得に失敗したレースはNULLのまま残して次回に回す。
+    """
+    from http_fetch import make_soup, prefetched
+    from scraper_race import construct_jbis_url, parse_race_class
+
+    conn = sqlite3.connect(db_path)
+    try:
+        query = "SELECT race_id, date FROM races WHERE race_class IS NULL AND date IS NOT NULL ORDER BY date DESC"
+        races = conn.execute(query + (f" LIMIT {int(limit)}" if limit else '')).fetchall()
+        if not races:
+            print("All races have a class.")
+            return 0
+
+        filled = 0
+        pages = prefetched(races, lambda race: [url for url in [construct_jbis_url(*race)] if url], window=PREFETCH_RACES)
+        for (race_id, _), fetched in tqdm(pages, total=len(races), desc="Backfilling race classes"):
+            page = fetched[0] if fetched else None
+            if not page:
+                continue
+            try:
+                with metrics.stage('parse'):
+                    soup = make_soup(page, profile='race_info')
+                    box = soup.select_one('div.box-race__text')
+                    race_class = parse_race_class(box.get_text(' ')) if box else ''
+                    soup.decompose()
+                with metrics.stage('db_write'):
+                    conn.execute("UPDATE races SET race_class = ? WHERE race_id = ?", (race_class, race_id))
+                    conn.commit()
+                filled += bool(race_class)
+                metrics.item('race_class')
+            except Exception as e:
+                print(f"An unexpected error occurred for race {race_id}: {e}")
+                metrics.fail('exception')
+                traceback.print_exc()
+        print(f"Stored classes for {filled} of {len(races)} races.")
+        return filled
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='同じ条件の過去レースの索引を更新し、検索する')
+    parser.add_argument('race_ids', nargs='*', help='同じ条件の過去レースを検索するレースID')
+    parser.add_argument('--n', type=int, default=10, help='1レースあたりの件数')
+    parser.add_argument('--window', type=int, default=None, help='何日前までのレースを対象にするか')
+    parser.add_argument('--full', action='store_true', help='保存した索引を使わず作り直す')
+    parser.add_argument('--backfill-class', action='store_true', help='クラスが未取得の既存のレースを取得し直す')
+    parser.add_argument('--limit', type=int, help='--backfill-class で取得するレース数の上限 (新しい順)')
+    args = parser.parse_args()
+
+    if args.backfill_class:
+        backfill_race_classes(limit=args.limit)
+    index = update_index(full=args.full)
+    if args.race_ids:
+        start = time.perf_counter()
+        result = index.comparable(args.race_ids, args.n, args.window)
+        print(f"Queried {len(args.race_ids)} races in {(time.perf_counter() - start) * 1000:.2f} ms.")
+        print(result.to_string(index=False))
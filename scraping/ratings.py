@@ -0,0 +1,215 @@
+import os
+import time
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from entity_keys import load_results, EntityKeys
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DB_PATH = os.getenv('DB_FILE_PATH')
+if not DB_PATH:
+    raise ValueError("DB_FILE_PATH is not set in .env file")
+
+# レーティングの状態を保存するファイル (既定は keiba.db と同じ場所の keiba.ratings.npz)
+RATINGS_STATE_PATH = os.getenv('RATINGS_STATE_PATH') or os.path.splitext(DB_PATH)[0] + '.ratings.npz'
+
+# レーティングを付ける種別
+RATING_KINDS = ('horse', 'jockey', 'trainer')
+INITIAL_RATING = 1500.0
+# 出走数が少ないうちは大きく動かし、経験を積むほど小さくする (Glickoの偏差の代わり)
+K_BASE = 32.0
+K_MIN = 8.0
+K_HALF_GAMES = 10.0
+
+class RatingState:
+    """種別ごとのレーティングと出走数を整数キーを添字とする配列で持つ
+
+    添字0は未登録のIDのキー (entity_keys.MISSING_KEY) で、更新しない。
+    last_date はこの状態に反映済みの最後の開催日。
+    """
+
+    def __init__(self, last_date=''):
+        self.ratings = {kind: np.full(1, INITIAL_RATING) for kind in RATING_KINDS}
+        self.games = {kind: np.zeros(1, dtype=np.int32) for kind in RATING_KINDS}
+        self.last_date = last_date
+
+    @classmethod
+    def load(cls, path=RATINGS_STATE_PATH):
+        """保存した状態を読み込む (ファイルがなければ初期状態)"""
+        state = cls()
+        if not os.path.exists(path):
+            return state
+        with np.load(path) as data:
+            state.last_date = str(data['last_date'])
+            for kind in RATING_KINDS:
+                state.ratings[kind] = data[f'{kind}_ratings']
+                state.games[kind] = data[f'{kind}_games']
+        return state
+
+    def save(self, path=RATINGS_STATE_PATH):
+        """一時ファイルに書いてから入れ替える (途中で止まっても前回の状態が残る)"""
+        arrays = {'last_date': np.array(self.last_date)}
+        for kind in RATING_KINDS:
+            arrays[f'{kind}_ratings'] = self.ratings[kind]
+            arrays[f'{kind}_games'] = self.games[kind]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    def grow(self, kind, max_key):
+        """新しく振られたキーの分だけ配列を伸ばす"""
+        size = len(self.ratings[kind])
+        if max_key >= size:
+            self.ratings[kind] = np.concatenate([self.ratings[kind], np.full(max_key + 1 - size, INITIAL_RATING)])
+            self.games[kind] = np.concatenate([self.games[kind], np.zeros(max_key + 1 - size, dtype=np.int32)])
+
+def k_factor(games):
+    return np.maximum(K_MIN, K_BASE / np.sqrt(1 + games / K_HALF_GAMES))
+
+def rating_deltas(ratings, ranks, race_pos, runner_pos, n_races, field):
+    """1日分の出走のレーティングの変化量を、レースごとの総当たりの勝敗から求める
+
+    各馬の結果は同じレースの他の完走馬との1対1の勝敗 (先着1、同着0.5) の平均で、
+    期待値はElo式の勝率の平均。レースを (レース数, 最大頭数) に並べて一度に計算する。
+    """
+    grid_rating = np.full((n_races, field), np.nan)
+    grid_rank = np.full((n_races, field), np.nan)
+    grid_rating[race_pos, runner_pos] = ratings
+    grid_rank[race_pos, runner_pos] = ranks
+
+    # [レース, 自分, 相手]
+    expected = 1 / (1 + 10 ** ((grid_rating[:, None, :] - grid_rating[:, :, None]) / 400))
+    score = (grid_rank[:, :, None] < grid_rank[:, None, :]) + 0.5 * (grid_rank[:, :, None] == grid_rank[:, None, :])
+    valid = ~np.isnan(grid_rank)
+    pairs = valid[:, :, None] & valid[:, None, :] & ~np.eye(field, dtype=bool)[None, :, :]
+    opponents = pairs.sum(axis=2)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        diff = np.where(pairs, score - expected, 0).sum(axis=2) / opponents
+    diff = np.where(opponents > 0, diff, 0.0)
+    return diff[race_pos, runner_pos]
+
+def apply_day(state, day):
+    """1日分の出走 (DataFrameの一部) を反映し、出走前のレーティングを種別ごとに返す
+
+    同じ日のレースはすべてその日の開始時点のレーティングで計算し、
+    同じ騎手・調教師の複数のレースの変化量は合計して反映する。
+    """
+    race_index = day['race_index'].to_numpy()
+    starts = np.flatnonzero(np.diff(race_index, prepend=-1))
+    counts = np.diff(np.append(starts, len(race_index)))
+    race_pos = np.repeat(np.arange(len(starts)), counts)
+    runner_pos = np.arange(len(race_index)) - np.repeat(starts, counts)
+    ranks = day['rank'].to_numpy(float)
+    finished = ~np.isnan(ranks)
+
+    pre = {}
+    for kind in RATING_KINDS:
+        keys = day[f'{kind}_key'].to_numpy()
+        state.grow(kind, int(keys.max()))
+        ratings = state.ratings[kind][keys]
+        pre[kind] = np.where(keys > 0, ratings, np.nan)
+
+        delta = rating_deltas(ratings, ranks, race_pos, runner_pos, len(starts), int(counts.max()))
+        update = finished & (keys > 0)
+        delta = delta * k_factor(state.games[kind][keys])
+        np.add.at(state.ratings[kind], keys[update], delta[update])
+        np.add.at(state.games[kind], keys[update], 1)
+    return pre
+
+def unapplied_races(db_path, last_date):
+    """last_date 以前の出走結果のあるレースのうち rating_history にないものの (件数, 最初の日付) を返す
+
+    なければ None。
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        count, first_date = conn.execute('''
+        SELECT COUNT(*), MIN(ra.date) FROM races ra
+        WHERE ra.date <= ?
+          AND EXISTS (SELECT 1 FROM results r WHERE r.race_id = ra.race_id AND r.horse_id IS NOT NULL AND r.horse_id != '')
+          AND NOT EXISTS (SELECT 1 FROM rating_history h WHERE h.race_id = ra.race_id)
+        ''', (last_date,)).fetchone()
+    finally:
+        conn.close()
+    return (count, first_date) if count else None
+
+def update_ratings(db_path=DB_PATH, state_path=RATINGS_STATE_PATH, full=False):
+    """前回の状態より後の開催日のレースを日付順に反映し、出走前のレーティングを保存する
+
+    rating_history には出走前の値を保存するため、特徴量に使っても結果が漏れない。
+    反映済みの開催日以前のレースが後から追加された場合 (取得の中断や当日の途中までの
+    取り込みなど) は、状態を巻き戻せないため最初から計算し直す。
+    """
+    started = time.perf_counter()
+    state = RatingState() if full else RatingState.load(state_path)
+    if not full and state.last_date:
+        missed = unapplied_races(db_path, state.last_date)
+        if missed:
+            print(f"Found {missed[0]} unapplied races on or before {state.last_date} "
+                  f"(earliest {missed[1]}). Rebuilding ratings from scratch.")
+            full = True
+            state = RatingState()
+    df, race_ids = load_results(db_path, where='WHERE ra.date > ?', params=(state.last_date,))
+    df = df[df['date'].notna()]
+    if df.empty:
+        print(f"Ratings are up to date (through {state.last_date or '-'}).")
+        return 0
+
+    dates = df['date'].to_numpy()
+    day_starts = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]])
+    day_ends = np.append(day_starts[1:], len(df))
+    pre = {kind: np.empty(len(df)) for kind in RATING_KINDS}
+    for s, e in zip(day_starts, day_ends):
+        for kind, values in apply_day(state, df.iloc[s:e]).items():
+            pre[kind][s:e] = values
+    state.last_date = str(dates[-1])
+
+    conn = sqlite3.connect(db_path)
+    try:
+        if full:
+            conn.execute("DELETE FROM rating_history")
+        conn.executemany('''
+        INSERT OR REPLACE INTO rating_history (race_id, horse_key, horse_rating, jockey_rating, trainer_rating)
+        VALUES (?, ?, ?, ?, ?)
+        ''', [
+            (race_ids[race], int(horse), *(None if np.isnan(v) else round(float(v), 1) for v in values))
+            for race, horse, *values in zip(
+                df['race_index'].to_numpy(), df['horse_key'].to_numpy(),
+                pre['horse'], pre['jockey'], pre['trainer'])
+            if horse > 0
+        ])
+        conn.commit()
+    finally:
+        conn.close()
+    # DBへの保存が終わってから状態を保存する (途中で止まっても同じ日から計算し直せる)
+    state.save(state_path)
+    print(f"Applied {len(day_starts)} race days ({len(race_ids)} races, {len(df)} runs) "
+          f"through {state.last_date} in {(time.perf_counter() - started) * 1000:.0f} ms.")
+    return len(day_starts)
+
+def top_ratings(kind, n=10, db_path=DB_PATH, state_path=RATINGS_STATE_PATH, min_games=5):
+    """現在のレーティング上位を (ID, レーティング, 出走数) のDataFrameで返す"""
+    state = RatingState.load(state_path)
+    ratings, games = state.ratings[kind], state.games[kind]
+    candidates = np.flatnonzero((games >= min_games) & (np.arange(len(games)) > 0))
+    order = candidates[np.argsort(-ratings[candidates], kind='stable')][:n]
+    key_map = EntityKeys.load(db_path, kinds=(kind,))[kind]
+    return pd.DataFrame({
+        f'{kind}_id': key_map.ids_of(order), 'rating': ratings[order].round(1), 'games': games[order],
+    })
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='馬・騎手・調教師のレーティングを開催日順に更新する')
+    parser.add_argument('--full', action='store_true', help='保存した状態を使わず最初から計算し直す')
+    parser.add_argument('--top', type=int, default=0, help='種別ごとに上位N件を表示する')
+    args = parser.parse_args()
+
+    update_ratings(full=args.full)
+    for kind in RATING_KINDS if args.top else ():
+        print(f"\n[{kind}]")
+        print(top_ratings(kind, args.top).to_string(index=False))
@@ -1,18 +1,14 @@
-import requests
-from bs4 import BeautifulSoup
 import sqlite3
-import time
 import re
 from tqdm import tqdm
 import traceback
 import os
+import argparse
 from dotenv import load_dotenv
+from metrics import metrics
+from http_fetch import fetch_page, make_soup, prefetched
+from work_queue import iter_tasks, count_tasks, TASK_HORSE, TASK_PEDIGREE, TASK_PEDIGREE_DERIVED
 from datetime import datetime
-import urllib3
-from urllib3.exceptions import InsecureRequestWarning
-
-# SSL警告を抑制
-urllib3.disable_warnings(InsecureRequestWarning)
 
 # .env読み込み
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
@@ -22,55 +18,95 @@ if not DB_PATH:
 
 BASE_URL = "https://www.jbis.or.jp/horse/"
 
+# 解析中に先読みしておく馬の頭数
+PREFETCH_HORSES = int(os.getenv('HORSE_PREFETCH', '4'))
+
 def get_html_from_jbis(url):
-    """指定されたJBISのURLからHTMLを取得する"""
-    try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-        }
-        response = requests.get(url, headers=headers, verify=False, timeout=10)
-        response.raise_for_status()
-        response.encoding = response.apparent_encoding
-
-        if "該当するデータが見つかりませんでした" in response.text:
-            print(f"Page not found or no data for URL: {url}")
-            return None
-        return response.text
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching {url}: {e}")
-        return None
+    """指定されたJBISのURLからHTMLを取得する (生バイト列と文字コードのPage、取得できなければNone)"""
+    return fetch_page(url)
 
 def get_unscraped_horse_ids():
-    """resultsテーブルにあってhorsesテーブルにないhorse_idを取得する"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # resultsテーブルに存在するが、horsesテーブルには存在しないhorse_idを効率的に取得
-    query = '''
-    SELECT DISTINCT r.horse_id 
-    FROM results r
-    LEFT JOIN horses h ON r.horse_id = h.horse_id
-    WHERE h.horse_id IS NULL AND r.horse_id IS NOT NULL AND r.horse_id != ''
-    '''
-    cursor.execute(query)
-    ids = [row[0] for row in cursor.fetchall() if row[0]] # Noneや空文字を除外
-    conn.close()
-    return ids
+    """プロフィール未取得のhorse_idを順に返す (scrape_queueから少しずつ読み出す)"""
+    return iter_tasks(DB_PATH, TASK_HORSE)
 
 def get_missing_pedigree_horse_ids():
-    """horsesテーブルに存在するが、pedigreesテーブルにデータがない馬のIDを取得する"""
+    """horsesテーブルに存在するが、pedigreesテーブルにデータがない馬のIDを順に返す"""
+    return iter_tasks(DB_PATH, TASK_PEDIGREE)
+
+def get_derived_pedigree_horse_ids():
+    """子孫の血統表から導出した (5代目が欠けている) 血統の馬のIDを順に返す"""
+    return iter_tasks(DB_PATH, TASK_PEDIGREE_DERIVED)
+
+def get_unscraped_ancestor_ids():
+    """pedigreesで参照されているがhorsesテーブルにない祖先IDを、参照数の多い順に返す"""
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        # 参照数はトリガーで ancestor_queue に積み上げてあるため、pedigrees 全体は集計しない
+        return conn.execute("SELECT ancestor_id, refs FROM ancestor_queue ORDER BY refs DESC").fetchall()
+    finally:
+        conn.close()
+
+def add_pedigree_signatures(conn, horse_ids):
+    """類似馬検索の署名を同じ接続で追加する (pedigree_similarity.py)
+
+    署名の作成に失敗しても血統の保存は続けられるよう、セーブポイントで
+    署名の分だけを取り消してログに残す。漏れた馬は pedigree_similarity.py の
+    一括作成 (引数なしで実行) で補完される。
+    """
+    conn.execute("SAVEPOINT pedigree_signatures")
+    try:
+        from pedigree_similarity import add_signatures
+        add_signatures(conn, horse_ids)
+        conn.execute("RELEASE pedigree_signatures")
+    except Exception as e:
+        print(f"Failed to add pedigree signatures: {e}")
+        metrics.fail('signature_error')
+        traceback.print_exc()
+        conn.execute("ROLLBACK TO pedigree_signatures")
+        conn.execute("RELEASE pedigree_signatures")
+
+def derive_ancestor_pedigrees(ancestor_ids):
+    """子孫の5代血統表から祖先自身の血統を導出してpedigreesに保存する
+
+    祖先Xが子孫の血統表の位置p (例: 'f') にいる場合、pから始まる位置の祖先は
+    Xの血統表の位置 (pを除いた部分) にそのまま対応する。導出するのは父・母として
+    現れる (4代分の血統が得られる) 祖先だけで、それより深い位置にしか現れない祖先は
+    1〜3代分しか得られないため、血統ページを取得するよう対象外とする。
+    導出した血統は5代目が欠けているため 'pedigree_derived' タスクを追加し、
+    類似馬検索の署名は scrape_derived_pedigrees() で補完した後に作る。
+    既に血統が保存されている祖先も対象外。導出できた祖先IDの集合を返す。
+    """
+    if not ancestor_ids:
+        return set()
+
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
-    query = '''
-    SELECT h.horse_id
-    FROM horses h
-    LEFT JOIN pedigrees p ON h.horse_id = p.horse_id
-    WHERE p.horse_id IS NULL AND h.horse_id IS NOT NULL AND h.horse_id != ''
-    '''
-    cursor.execute(query)
-    ids = [row[0] for row in cursor.fetchall() if row[0]]
-    conn.close()
-    return ids
+    try:
+        cursor.execute("CREATE TEMP TABLE target_ancestors (ancestor_id TEXT PRIMARY KEY)")
+        cursor.executemany("INSERT OR IGNORE INTO target_ancestors (ancestor_id) VALUES (?)",
+                           [(a,) for a in ancestor_ids])
+        cursor.execute('''
+        INSERT OR IGNORE INTO pedigrees (horse_id, ancestor_id, generation, position)
+        SELECT a.ancestor_id, d.ancestor_id, d.generation - a.generation, substr(d.position, a.generation + 1)
+        FROM target_ancestors t
+        JOIN pedigrees a ON a.ancestor_id = t.ancestor_id AND a.generation = 1
+        JOIN pedigrees d ON d.horse_id = a.horse_id
+            AND d.generation > a.generation
+            AND substr(d.position, 1, a.generation) = a.position
+        WHERE NOT EXISTS (SELECT 1 FROM pedigrees x WHERE x.horse_id = t.ancestor_id)
+        ''')
+        cursor.execute('''
+        SELECT t.ancestor_id FROM target_ancestors t
+        WHERE EXISTS (SELECT 1 FROM pedigrees x WHERE x.horse_id = t.ancestor_id)
+            AND NOT EXISTS (SELECT 1 FROM pedigrees x WHERE x.horse_id = t.ancestor_id AND x.generation = 5)
+        ''')
+        derived = {row[0] for row in cursor.fetchall()}
+        cursor.executemany("INSERT OR IGNORE INTO scrape_queue (task, entity_id) VALUES (?, ?)",
+                           [(TASK_PEDIGREE_DERIVED, a) for a in derived])
+        conn.commit()
+        return derived
+    finally:
+        conn.close()
 
 def parse_pedigree(pedigree_soup):
     """5代血統表を解析して祖先IDの辞書を返す"""
@@ -200,10 +236,12 @@ def parse_horse_page(profile_soup, horse_id):
         traceback.print_exc()
         return None, None, None
 
-def save_horse_to_db(horse_data, owner_data, breeder_data, pedigree_list):
+def save_horse_to_db(horse_data, owner_data, breeder_data, pedigree_list, conn=None):
     if not horse_data: return
     
-    conn = sqlite3.connect(DB_PATH)
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
     try:
@@ -238,17 +276,26 @@ def save_horse_to_db(horse_data, owner_data, breeder_data, pedigree_list):
                 "INSERT OR IGNORE INTO pedigrees (horse_id, ancestor_id, generation, position) VALUES (?, ?, ?, ?)",
                 pedigree_insert_data
             )
+            # 類似馬検索の署名も同じトランザクションで保存する
+            add_pedigree_signatures(conn, [horse_data['horse_id']])
 
         conn.commit()
 
     except sqlite3.Error as e:
         print(f"DB Error: {e}")
+        metrics.fail('db_error')
         traceback.print_exc()
+        conn.rollback()
     finally:
-        conn.close()
+        if own_conn:
+            conn.close()
 
 def save_pedigree_to_db(horse_id, pedigree_list):
-    """指定されたhorse_idの血統情報のみをDBに保存する"""
+    """指定されたhorse_idの血統情報のみをDBに保存する
+
+    導出した血統を補完した場合は 'pedigree_derived' タスクを完了にし、
+    4代分で作られていた署名があれば作り直す。
+    """
     if not horse_id or not pedigree_list:
         return
 
@@ -263,77 +310,218 @@ def save_pedigree_to_db(horse_id, pedigree_list):
             "INSERT OR IGNORE INTO pedigrees (horse_id, ancestor_id, generation, position) VALUES (?, ?, ?, ?)",
             pedigree_insert_data
         )
+        cursor.execute("DELETE FROM scrape_queue WHERE task = ? AND entity_id = ?", (TASK_PEDIGREE_DERIVED, horse_id))
+        if cursor.rowcount:
+            cursor.execute(
+                "DELETE FROM pedigree_signatures WHERE horse_key = (SELECT key FROM horse_keys WHERE horse_id = ?)",
+                (horse_id,))
+        add_pedigree_signatures(conn, [horse_id])
         conn.commit()
+    except sqlite3.Error as e:
+        print(f"DB Error: {e}")
+        metrics.fail('db_error')
+        traceback.print_exc()
+        conn.rollback()
     finally:
         conn.close()
 
+def horse_page_urls(horse_id):
+    """馬のプロフィールページと血統ページのURLを返す"""
+    return [f"{BASE_URL}{horse_id}/", f"{BASE_URL}{horse_id}/pedigree/"]
+
+def pedigree_page_urls(horse_id):
+    """馬の血統ページのURLを返す"""
+    return [f"{BASE_URL}{horse_id}/pedigree/"]
+
+def parse_horse_pages(horse_id, profile_page, pedigree_page):
+    """取得済みのプロフィール・血統ページを解析する (DBには保存しない)
+
+    成功した場合は (horse_data, owner_data, breeder_data, pedigree_list) を、失敗した場合はNoneを返す。
+    """
+    # 1. プロフィールページの解析
+    if not profile_page:
+        print(f"Failed to fetch profile for {horse_id}. Skipping.")
+        return None
+    
+    with metrics.stage('parse'):
+        profile_soup = make_soup(profile_page, profile='horse')
+    with metrics.stage('extract'):
+        horse_data, owner_data, breeder_data = parse_horse_page(profile_soup, horse_id)
+    profile_soup.decompose()
+    
+    if not horse_data:
+        print(f"Failed to parse profile for {horse_id}. Skipping.")
+        metrics.fail('parse_error')
+        return None
+
+    # 2. 血統ページの解析
+    # 血統ページの取得に失敗してもプロフィールは保存し、血統のみ
+    # scrape_missing_pedigrees で補完する (プロフィールの再取得は不要)
+    pedigree_list = []
+    if pedigree_page:
+        with metrics.stage('parse'):
+            pedigree_soup = make_soup(pedigree_page, profile='pedigree')
+        with metrics.stage('extract'):
+            pedigree_list = parse_pedigree(pedigree_soup)
+        pedigree_soup.decompose()
+    else:
+        print(f"Failed to fetch pedigree for {horse_id}. Saving profile only.")
+
+    return horse_data, owner_data, breeder_data, pedigree_list
+
+def process_horse_pages(horse_id, profile_page, pedigree_page):
+    """取得済みのプロフィール・血統ページを解析して保存する (保存できればTrueを返す)"""
+    parsed = parse_horse_pages(horse_id, profile_page, pedigree_page)
+    if not parsed:
+        return False
+    horse_data, owner_data, breeder_data, pedigree_list = parsed
+
+    # 3. DBへの保存
+    with metrics.stage('db_write'):
+        save_horse_to_db(horse_data, owner_data, breeder_data, pedigree_list)
+    metrics.item('horse')
+    if pedigree_list:
+        metrics.item('pedigree')
+    return True
+
+def process_pedigree_page(horse_id, pedigree_page):
+    """取得済みの血統ページを解析して血統のみを保存する (保存できればTrueを返す)"""
+    if not pedigree_page:
+        print(f"Failed to fetch pedigree for {horse_id}. Skipping.")
+        return False
+
+    with metrics.stage('parse'):
+        pedigree_soup = make_soup(pedigree_page, profile='pedigree')
+    with metrics.stage('extract'):
+        pedigree_list = parse_pedigree(pedigree_soup)
+    pedigree_soup.decompose()
+    if not pedigree_list:
+        metrics.fail('parse_error')
+        return False
+    with metrics.stage('db_write'):
+        save_pedigree_to_db(horse_id, pedigree_list)
+    metrics.item('pedigree')
+    return True
+
 def scrape_missing_horses():
-    ids = get_unscraped_horse_ids()
-    print(f"Found {len(ids)} horses to scrape.")
+    total = count_tasks(DB_PATH, TASK_HORSE)
+    print(f"Found {total} horses to scrape.")
     
-    if not ids:
+    if not total:
         print("No new horses to scrape.")
         return
 
-    for horse_id in tqdm(ids, desc="Scraping Horses"):
+    # プロフィールと血統ページを同時に取得し、後続の馬も先読みしておく
+    pages = prefetched(get_unscraped_horse_ids(), horse_page_urls, window=PREFETCH_HORSES)
+    for horse_id, (profile_page, pedigree_page) in tqdm(pages, total=total, desc="Scraping Horses"):
         try:
-            # 1. プロフィールページの取得と解析
-            profile_url = f"{BASE_URL}{horse_id}/"
-            profile_html = get_html_from_jbis(profile_url)
-            if not profile_html:
-                print(f"Failed to fetch profile for {horse_id}. Skipping.")
-                continue
-            
-            profile_soup = BeautifulSoup(profile_html, 'lxml')
-            horse_data, owner_data, breeder_data = parse_horse_page(profile_soup, horse_id)
-            
-            if not horse_data:
-                print(f"Failed to parse profile for {horse_id}. Skipping.")
-                continue
-
-            # 2. 血統ページの取得と解析
-            pedigree_url = f"{BASE_URL}{horse_id}/pedigree/"
-            pedigree_html = get_html_from_jbis(pedigree_url)
-            if not pedigree_html:
-                print(f"Failed to fetch pedigree for {horse_id}. Skipping.")
-                continue
-            
-            pedigree_soup = BeautifulSoup(pedigree_html, 'lxml')
-            pedigree_list = parse_pedigree(pedigree_soup)
-
-            # 3. DBへの保存
-            save_horse_to_db(horse_data, owner_data, breeder_data, pedigree_list)
-            time.sleep(1) # サーバー負荷軽減
-
+            process_horse_pages(horse_id, profile_page, pedigree_page)
         except Exception as e:
             print(f"An unexpected error occurred for horse {horse_id}: {e}")
+            metrics.fail('exception')
             traceback.print_exc()
 
 def scrape_missing_pedigrees():
     """血統情報が欠けている馬のデータを補完する"""
-    ids = get_missing_pedigree_horse_ids()
-    print(f"\nFound {len(ids)} horses with missing pedigrees to update.")
+    total = count_tasks(DB_PATH, TASK_PEDIGREE)
+    print(f"\nFound {total} horses with missing pedigrees to update.")
 
-    if not ids:
+    if not total:
         print("No missing pedigrees to scrape.")
         return
+    scrape_pedigree_pages(get_missing_pedigree_horse_ids(), total, "Scraping Missing Pedigrees")
 
-    for horse_id in tqdm(ids, desc="Scraping Missing Pedigrees"):
-        try:
-            pedigree_url = f"{BASE_URL}{horse_id}/pedigree/"
-            pedigree_html = get_html_from_jbis(pedigree_url)
-            if not pedigree_html:
-                print(f"Failed to fetch pedigree for {horse_id}. Skipping.")
-                continue
+def scrape_derived_pedigrees():
+    """子孫の血統表から導出した血統の5代目を血統ページで補完する (優先度が低いため最後に実行する)"""
+    total = count_tasks(DB_PATH, TASK_PEDIGREE_DERIVED)
+    print(f"\nFound {total} derived pedigrees to complete.")
 
-            pedigree_soup = BeautifulSoup(pedigree_html, 'lxml')
-            pedigree_list = parse_pedigree(pedigree_soup)
-            save_pedigree_to_db(horse_id, pedigree_list)
-            time.sleep(1)
+    if not total:
+        print("No derived pedigrees to complete.")
+        return
+    scrape_pedigree_pages(get_derived_pedigree_horse_ids(), total, "Completing Derived Pedigrees")
+
+def scrape_pedigree_pages(horse_ids, total, desc):
+    """馬の血統ページを取得して血統を保存する"""
+    pages = prefetched(horse_ids, pedigree_page_urls, window=PREFETCH_HORSES)
+    for horse_id, (pedigree_page,) in tqdm(pages, total=total, desc=desc):
+        try:
+            process_pedigree_page(horse_id, pedigree_page)
         except Exception as e:
             print(f"An unexpected error occurred for horse {horse_id}: {e}")
+            metrics.fail('exception')
+
+def scrape_ancestors(limit=None, rounds=1):
+    """血統表で参照されている祖先を、参照数の多い順に1頭1回だけ取得する
+
+    祖先の血統は可能な限り子孫の血統表から導出し、導出できない祖先のみ
+    血統ページを取得する。取得した祖先の血統からさらに祖先が見つかるため、
+    roundsで遡る回数を指定する。
+    """
+    attempted = set()
+    for round_no in range(1, rounds + 1):
+        candidates = [(a, refs) for a, refs in get_unscraped_ancestor_ids() if a not in attempted]
+        if limit is not None:
+            candidates = candidates[:max(0, limit - len(attempted))]
+        if not candidates:
+            print("No new ancestors to scrape.")
+            return
+
+        ids = [a for a, _ in candidates]
+        attempted.update(ids)
+        derived = derive_ancestor_pedigrees(ids)
+        print(f"Round {round_no}: {len(ids)} ancestors to scrape "
+              f"(top refs: {candidates[0][1]}, pedigrees derived from descendants: {len(derived)}).")
+
+        # 血統を導出できた祖先はプロフィールページのみ取得する
+        def ancestor_page_urls(horse_id):
+            return horse_page_urls(horse_id)[:1] if horse_id in derived else horse_page_urls(horse_id)
+
+        pages = prefetched(ids, ancestor_page_urls, window=PREFETCH_HORSES)
+        for horse_id, fetched in tqdm(pages, total=len(ids), desc=f"Scraping Ancestors ({round_no})"):
+            try:
+                profile_page = fetched[0]
+                if not profile_page:
+                    print(f"Failed to fetch profile for ancestor {horse_id}. Skipping.")
+                    continue
+
+                with metrics.stage('parse'):
+                    profile_soup = make_soup(profile_page, profile='horse')
+                with metrics.stage('extract'):
+                    horse_data, owner_data, breeder_data = parse_horse_page(profile_soup, horse_id)
+                profile_soup.decompose()
+                if not horse_data:
+                    metrics.fail('parse_error')
+                    continue
+
+                pedigree_list = []
+                if len(fetched) > 1 and fetched[1]:
+                    with metrics.stage('parse'):
+                        pedigree_soup = make_soup(fetched[1], profile='pedigree')
+                    with metrics.stage('extract'):
+                        pedigree_list = parse_pedigree(pedigree_soup)
+                    pedigree_soup.decompose()
+
+                with metrics.stage('db_write'):
+                    save_horse_to_db(horse_data, owner_data, breeder_data, pedigree_list)
+                metrics.item('ancestor')
+            except Exception as e:
+                print(f"An unexpected error occurred for ancestor {horse_id}: {e}")
+                metrics.fail('exception')
+                traceback.print_exc()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Scrape horse profiles and pedigrees from JBIS')
+    parser.add_argument('--ancestors', action='store_true', help='血統表で参照されている祖先も取得する')
+    parser.add_argument('--ancestor-limit', type=int, default=None, help='取得する祖先の上限頭数')
+    parser.add_argument('--ancestor-rounds', type=int, default=1, help='祖先を遡る回数')
+    parser.add_argument('--complete-derived', action='store_true', help='子孫から導出した祖先の血統の5代目を血統ページで補完する')
+    args = parser.parse_args()
+
     scrape_missing_horses()
     scrape_missing_pedigrees()
+    if args.ancestors:
+        scrape_ancestors(limit=args.ancestor_limit, rounds=args.ancestor_rounds)
+    if args.complete_derived:
+        scrape_derived_pedigrees()
     print("Scraping completed.")
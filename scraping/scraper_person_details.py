@@ -6,12 +6,12 @@ import os
 from dotenv import load_dotenv
 from tqdm import tqdm
 import traceback
-
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from webdriver_manager.chrome import ChromeDriverManager
+from metrics import metrics
+from politeness import scheduler, is_blocked_page
+from work_queue import TASK_JOCKEY, TASK_TRAINER
+from crosswalk import resolve, iter_resolved, count_resolved, unresolved_counts, mark_fetched
 from bs4 import BeautifulSoup
+from http_fetch import PARSE_PROFILES
 
 # .env読み込み
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
@@ -19,8 +19,16 @@ DB_PATH = os.getenv('DB_FILE_PATH')
 if not DB_PATH:
     raise ValueError("DB_FILE_PATH is not set in .env file")
 
+NETKEIBA_DB_URL = "https://db.netkeiba.com/"
+
 def get_driver():
     """Selenium WebDriverを初期化して返す"""
+    # Seleniumは読み込みに時間がかかるため、ブラウザが必要になった時点で読み込む
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
+    from selenium.webdriver.chrome.options import Options
+    from webdriver_manager.chrome import ChromeDriverManager
+
     chrome_options = Options()
     chrome_options.add_argument("--headless")
     chrome_options.add_argument("--no-sandbox")
@@ -33,25 +41,37 @@ def get_driver():
     return driver
 
 def get_html(driver, url):
-    """指定されたURLからHTMLを取得する"""
+    """指定されたURLからHTMLを取得する (ページがない場合は空文字列、取得に失敗した場合はNone)"""
+    scheduler.wait(url) # 負荷軽減
+    start = time.perf_counter()
     try:
-        driver.get(url)
-        time.sleep(1) # 負荷軽減
-        if "エラー" in driver.title or "ご指定のページは見つかりませんでした" in driver.page_source:
+        with metrics.stage('fetch'):
+            driver.get(url)
+        # Seleniumではステータスが分からないため、制限・エラーのページかを内容で判定する
+        if is_blocked_page(driver.title, driver.page_source):
+            print(f"Blocked or server error page for {url}")
+            scheduler.record(url, time.perf_counter() - start, error=True)
+            metrics.fail('blocked')
             return None
+        scheduler.record(url, time.perf_counter() - start)
+        if "エラー" in driver.title or "ご指定のページは見つかりませんでした" in driver.page_source:
+            metrics.fail('no_data')
+            return ''
         return driver.page_source
     except Exception as e:
         print(f"Error fetching {url}: {e}")
+        scheduler.record(url, time.perf_counter() - start, error=True)
+        metrics.fail('http_error')
         return None
 
 # --- Jockey Scraping ---
 
 def get_jockeys_to_scrape():
-    """所属や誕生日が未入力の騎手IDを取得する"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT jockey_id FROM jockeys WHERE belonging IS NULL OR birth_date IS NULL")
-        return [row[0] for row in cursor.fetchall()]
+    """所属や誕生日が未入力の騎手の (JBISのID, netkeibaのID) を順に返す
+
+    netkeibaのIDが分かっていないものと、既にプロフィールを取得したものは含めない。
+    """
+    return iter_resolved(DB_PATH, TASK_JOCKEY)
 
 def parse_person_profile(soup):
     """騎手または調教師のプロフィールページを解析する"""
@@ -88,32 +108,51 @@ def update_jockey_details(jockey_id, details):
         """, (details.get('belonging'), details.get('birth_date'), jockey_id))
         conn.commit()
 
+def scrape_jockey(driver, jockey_id, netkeiba_id):
+    """1人分の騎手の詳細情報を取得して保存する (保存できればTrueを返す)
+
+    jockey_id はDB上のID (JBIS)、netkeiba_id はプロフィールページのID。
+    """
+    url = f"{NETKEIBA_DB_URL}jockey/prof/{netkeiba_id}/"
+    html = get_html(driver, url)
+    if html is not None:
+        # ページがなかった場合も含め、同じ騎手のプロフィールは一度だけ取得する
+        mark_fetched(DB_PATH, TASK_JOCKEY, jockey_id)
+    if not html:
+        return False
+    
+    with metrics.stage('parse'):
+        soup = BeautifulSoup(html, 'lxml', parse_only=PARSE_PROFILES['person'])
+    with metrics.stage('extract'):
+        details = parse_person_profile(soup)
+    soup.decompose()
+    if not details:
+        metrics.fail('parse_error')
+        return False
+    with metrics.stage('db_write'):
+        update_jockey_details(jockey_id, details)
+    metrics.item('jockey')
+    return True
+
 def scrape_jockeys(driver):
     """騎手の詳細情報をスクレイピングする"""
-    jockey_ids = get_jockeys_to_scrape()
-    if not jockey_ids:
+    total = count_resolved(DB_PATH, TASK_JOCKEY)
+    if not total:
         print("No new jockeys to scrape.")
         return
-        
-    print(f"Scraping details for {len(jockey_ids)} jockeys...")
-    for jockey_id in tqdm(jockey_ids, desc="Jockeys"):
-        url = f"https://db.netkeiba.com/jockey/prof/{jockey_id}/"
-        html = get_html(driver, url)
-        if not html: continue
-        
-        soup = BeautifulSoup(html, 'lxml')
-        details = parse_person_profile(soup)
-        if details:
-            update_jockey_details(jockey_id, details)
+
+    print(f"Scraping details for {total} jockeys...")
+    for jockey_id, netkeiba_id in tqdm(get_jockeys_to_scrape(), total=total, desc="Jockeys"):
+        scrape_jockey(driver, jockey_id, netkeiba_id)
 
 # --- Trainer Scraping ---
 
 def get_trainers_to_scrape():
-    """所属や誕生日が未入力の調教師IDを取得する"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT trainer_id FROM trainers WHERE belonging IS NULL OR birth_date IS NULL")
-        return [row[0] for row in cursor.fetchall()]
+    """所属や誕生日が未入力の調教師の (JBISのID, netkeibaのID) を順に返す
+
+    netkeibaのIDが分かっていないものと、既にプロフィールを取得したものは含めない。
+    """
+    return iter_resolved(DB_PATH, TASK_TRAINER)
 
 def update_trainer_details(trainer_id, details):
     """調教師情報を更新する"""
@@ -129,25 +168,53 @@ def update_trainer_details(trainer_id, details):
         """, (details.get('belonging'), details.get('birth_date'), trainer_id))
         conn.commit()
 
+def scrape_trainer(driver, trainer_id, netkeiba_id):
+    """1人分の調教師の詳細情報を取得して保存する (保存できればTrueを返す)
+
+    trainer_id はDB上のID (JBIS)、netkeiba_id はプロフィールページのID。
+    """
+    url = f"{NETKEIBA_DB_URL}trainer/prof/{netkeiba_id}/"
+    html = get_html(driver, url)
+    if html is not None:
+        # ページがなかった場合も含め、同じ調教師のプロフィールは一度だけ取得する
+        mark_fetched(DB_PATH, TASK_TRAINER, trainer_id)
+    if not html:
+        return False
+    
+    with metrics.stage('parse'):
+        soup = BeautifulSoup(html, 'lxml', parse_only=PARSE_PROFILES['person'])
+    with metrics.stage('extract'):
+        details = parse_person_profile(soup)
+    soup.decompose()
+    if not details:
+        metrics.fail('parse_error')
+        return False
+    with metrics.stage('db_write'):
+        update_trainer_details(trainer_id, details)
+    metrics.item('trainer')
+    return True
+
 def scrape_trainers(driver):
     """調教師の詳細情報をスクレイピングする"""
-    trainer_ids = get_trainers_to_scrape()
-    if not trainer_ids:
+    total = count_resolved(DB_PATH, TASK_TRAINER)
+    if not total:
         print("No new trainers to scrape.")
         return
 
-    print(f"Scraping details for {len(trainer_ids)} trainers...")
-    for trainer_id in tqdm(trainer_ids, desc="Trainers"):
-        url = f"https://db.netkeiba.com/trainer/prof/{trainer_id}/"
-        html = get_html(driver, url)
-        if not html: continue
-        
-        soup = BeautifulSoup(html, 'lxml')
-        details = parse_person_profile(soup)
-        if details:
-            update_trainer_details(trainer_id, details)
+    print(f"Scraping details for {total} trainers...")
+    for trainer_id, netkeiba_id in tqdm(get_trainers_to_scrape(), total=total, desc="Trainers"):
+        scrape_trainer(driver, trainer_id, netkeiba_id)
 
 def main():
+    # JBISのIDのままnetkeibaを引いても見つからないため、先にIDの対応をまとめて解決する
+    if any(unresolved_counts(DB_PATH).values()):
+        resolve(DB_PATH)
+
+    # 取得できるものがなければブラウザを起動せずに終了する
+    if not count_resolved(DB_PATH, TASK_JOCKEY) and not count_resolved(DB_PATH, TASK_TRAINER):
+        print("No jockeys or trainers to scrape.")
+        return
+
     print("Initializing Selenium Driver...")
     driver = get_driver()
     
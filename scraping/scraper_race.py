@@ -1,19 +1,16 @@
-import requests
-from bs4 import BeautifulSoup
-import pandas as pd
+import csv
 import sqlite3
-import time
 import re
+import struct
 from tqdm import tqdm
 import traceback
-import urllib3
-from urllib3.exceptions import InsecureRequestWarning
 import os
 import datetime
+import argparse
+import unicodedata
 from dotenv import load_dotenv
-
-# SSL警告を抑制
-urllib3.disable_warnings(InsecureRequestWarning)
+from metrics import metrics
+from http_fetch import fetch_page, make_soup
 
 # .env読み込み
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
@@ -23,24 +20,20 @@ if not DB_PATH:
 
 BASE_URL = "https://www.jbis.or.jp/race/result/"
 
-def get_html_from_jbis_url(url):
-    """指定されたURLからHTMLを取得する"""
-    try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-        }
-        response = requests.get(url, headers=headers, verify=False, timeout=10)
-        response.raise_for_status()
-        response.encoding = response.apparent_encoding
-
-        if "該当するデータが見つかりませんでした" in response.text:
-            print(f"Page not found or no data for URL: {url}")
-            return None
+# 着差の言葉を馬身に換算する値
+MARGIN_WORDS = {'同着': 0.0, 'ハナ': 0.05, 'アタマ': 0.1, 'クビ': 0.2, '大差': 10.0}
+# "1 1/2" "1.1/2" "3/4" "5" のような馬身表記
+MARGIN_PATTERN = re.compile(r'^(\d+)?(?:[\s.]*(\d)/(\d))?$')
+CORNERS = 4
+# レース条件の行 ("3歳以上1勝クラス (混)(特指) 定量" など) のクラスと重賞の格付け
+CLASS_PATTERN = re.compile(r'(新馬|未出走|未勝利|[1-3]勝クラス|\d+万円?(?:以)?下|オープン)')
+GRADE_PATTERN = re.compile(r'\((G|Jpn)(1|2|3|I{1,3})\)|\((L)\)')
+# ハロンタイムは0.1秒単位の符号なし16ビット整数の並び (リトルエンディアン) で races.laps に保存する
+LAP_SCALE = 10
 
-        return response.text
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching {url}: {e}")
-        return None
+def get_html_from_jbis_url(url):
+    """指定されたURLからHTMLを取得する (生バイト列と文字コードのPage、取得できなければNone)"""
+    return fetch_page(url)
 
 def parse_race_info(soup, race_id):
     """レース情報を解析して辞書で返す"""
@@ -71,10 +64,14 @@ def parse_race_info(soup, race_id):
         state_match = re.search(r'(?:芝|ダート)：(.*?)\s', race_info_box.text)
         state = state_match.group(1).strip() if state_match else ""
 
+        # クラス (重賞・リステッドは格付け)
+        race_class = parse_race_class(race_info_box.get_text(' '))
+
         return {
             'race_id': race_id,
-            # 'date', 'venue', 'race_name', 'race_round', 'race_class' は
+            # 'date', 'venue', 'race_name', 'race_round' は
             # 呼び出し元で設定される想定
+            'race_class': race_class,
             'course_type': course_type,
             'distance': distance,
             'rotation': rotation,
@@ -87,6 +84,68 @@ def parse_race_info(soup, race_id):
         traceback.print_exc()
         return None
 
+def parse_race_class(text):
+    """レース条件の文からクラスを返す (重賞は 'G1' 'Jpn2' 'L' など、見つからなければ空文字)"""
+    text = unicodedata.normalize('NFKC', text or '')
+    grade = GRADE_PATTERN.search(text)
+    if grade:
+        if grade.group(3):
+            return 'L'
+        level = grade.group(2)
+        return grade.group(1) + ({'I': '1', 'II': '2', 'III': '3'}.get(level, level))
+    match = CLASS_PATTERN.search(text)
+    return match.group(1) if match else ''
+
+def parse_lap_times(soup):
+    """ハロンタイムの行を0.1秒単位の整数のリストにする (行がなければ空リスト)"""
+    for th in soup.find_all('th'):
+        if th.get_text(strip=True) == 'ハロンタイム':
+            td = th.find_next_sibling('td')
+            # "12.4 - 10.9 - 11.3 - ..."
+            return [round(float(t) * LAP_SCALE) for t in re.findall(r'\d+\.\d', td.get_text())] if td else []
+    return []
+
+def encode_laps(laps):
+    """ハロンタイムのリストを races.laps のBLOBにする"""
+    return struct.pack(f'<{len(laps)}H', *laps)
+
+def parse_margin(text):
+    """着差の表記を馬身の数値に変換する (解釈できなければNone)"""
+    text = (text or '').strip()
+    if text in MARGIN_WORDS:
+        return MARGIN_WORDS[text]
+    match = MARGIN_PATTERN.match(text)
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    lengths = float(match.group(1) or 0)
+    if match.group(2):
+        lengths += int(match.group(2)) / int(match.group(3))
+    return lengths
+
+def parse_passing(text):
+    """通過順 "3-3-2-1" を4コーナー分の順位のリストにする
+
+    コーナーが4つ未満のレースは最後の値を4コーナーとして右詰めにし、ないコーナーはNone。
+    """
+    positions = [int(p) if p.isdigit() else None for p in (text or '').strip().split('-') if p]
+    positions = positions[-CORNERS:]
+    return [None] * (CORNERS - len(positions)) + positions
+
+def add_margin_cum(results):
+    """着順に着差を積み上げ、勝ち馬からの着差 margin_cum を設定する
+
+    勝ち馬は0。途中に解釈できない着差があれば、それ以降はNoneとする。
+    """
+    cum = 0.0
+    for res in sorted(results, key=lambda r: r['rank']):
+        if res['rank'] == 1:
+            res['margin_lengths'] = 0.0
+        elif cum is not None and res['margin_lengths'] is not None:
+            cum += res['margin_lengths']
+        else:
+            cum = None
+        res['margin_cum'] = cum
+
 def parse_race_results(soup, race_id):
     """レース結果テーブルを解析して (results, jockeys, trainers) のタプルを返す"""
     results, jockeys, trainers = [], [], []
@@ -152,6 +211,7 @@ def parse_race_results(soup, race_id):
             margin = cols[7].text.strip() # "---" or "クビ"
             
             passing = cols[8].text.strip() # "1-1"
+            corners = parse_passing(passing)
 
             last_3f_text = cols[9].text.strip() # "35.1"
             try:
@@ -159,7 +219,8 @@ def parse_race_results(soup, race_id):
             except (ValueError, TypeError):
                 last_3f = None
             
-            # スピード指数は cols[10]
+            speed_text = cols[10].text.strip() # "65" (未算出は空欄や"-")
+            speed_index = int(speed_text) if re.fullmatch(r'-?\d+', speed_text) else None
 
             pop_text = cols[11].text.strip().replace('人気', '')
             popularity = int(pop_text) if pop_text.isdigit() else None
@@ -191,10 +252,13 @@ def parse_race_results(soup, race_id):
                 'frame_no': frame_no, 'horse_no': horse_no,
                 'jockey_id': jockey_id, 'trainer_id': trainer_id,
                 'age': age, 'weight': weight, 'time_seconds': time_seconds,
-                'margin': margin, 'passing': passing, 'last_3f': last_3f,
+                'margin': margin, 'passing': passing, 'last_3f': last_3f, 'speed_index': speed_index,
                 'odds': odds, 'popularity': popularity,
-                'horse_weight': horse_weight, 'weight_diff': weight_diff
+                'horse_weight': horse_weight, 'weight_diff': weight_diff,
+                'corner_1': corners[0], 'corner_2': corners[1], 'corner_3': corners[2], 'corner_4': corners[3],
+                'margin_lengths': parse_margin(margin),
             })
+        add_margin_cum(results)
     except Exception as e:
         print(f"Error parsing results for {race_id}: {e}")
         traceback.print_exc()
@@ -202,8 +266,8 @@ def parse_race_results(soup, race_id):
     
     return results, jockeys, trainers
 
-def save_to_db(race_info, results, jockeys, trainers):
-    """DBに保存する"""
+def save_to_db(race_info, results, jockeys, trainers, conn=None):
+    """DBに保存する (connを渡した場合はその接続を使い、閉じずに返す)"""
     if not race_info or not results:
         return
     
@@ -213,19 +277,21 @@ def save_to_db(race_info, results, jockeys, trainers):
     # race_info['venue'] = venue
     # ...
 
-    conn = sqlite3.connect(DB_PATH)
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
     try:
         # Racesテーブルへの挿入
         cursor.execute('''
-        INSERT OR IGNORE INTO races (race_id, date, venue, race_name, race_class, race_round, course_type, distance, rotation, weather, state, entries)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        INSERT OR IGNORE INTO races (race_id, date, venue, race_name, race_class, race_round, course_type, distance, rotation, weather, state, entries, laps)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
             race_info.get('race_id'), race_info.get('date'), race_info.get('venue'), race_info.get('race_name'),
             race_info.get('race_class'), race_info.get('race_round'), race_info.get('course_type'),
             race_info.get('distance'), race_info.get('rotation'), race_info.get('weather'), race_info.get('state'),
-            len(results)
+            len(results), race_info.get('laps')
         ))
         
         # Jockeysテーブルへの挿入
@@ -243,34 +309,26 @@ def save_to_db(race_info, results, jockeys, trainers):
         # Resultsテーブルへの挿入
         for res in results:
             cursor.execute('''
-            INSERT OR IGNORE INTO results (race_id, horse_id, rank, frame_no, horse_no, jockey_id, trainer_id, age, weight, time_seconds, margin, passing, last_3f, odds, popularity, horse_weight, weight_diff)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            INSERT OR IGNORE INTO results (race_id, horse_id, rank, frame_no, horse_no, jockey_id, trainer_id, age, weight, time_seconds, margin, passing, last_3f, odds, popularity, horse_weight, weight_diff, corner_1, corner_2, corner_3, corner_4, margin_lengths, margin_cum, speed_index)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 res['race_id'], res['horse_id'], res['rank'], res['frame_no'], res['horse_no'],
                 res['jockey_id'], res['trainer_id'], res['age'], res['weight'],
                 res['time_seconds'], res['margin'], res['passing'], res['last_3f'], res['odds'],
-                res['popularity'], res['horse_weight'], res['weight_diff']
+                res['popularity'], res['horse_weight'], res['weight_diff'],
+                res['corner_1'], res['corner_2'], res['corner_3'], res['corner_4'],
+                res['margin_lengths'], res['margin_cum'], res['speed_index']
             ))
             
         conn.commit()
     except Exception as e:
         print(f"DB Error: {e}")
+        metrics.fail('db_error')
         traceback.print_exc()
+        conn.rollback()
     finally:
-        conn.close()
-
-import argparse
-# get_race_ids.pyから関数をインポート
-# この変更に伴い、get_race_ids.pyが直接実行されるだけでなく、
-# # インポート可能な関数(例: get_race_ids_for_year)を提供する必要があります。
-# try:
-#     from get_race_ids import get_race_ids_for_year as fetch_race_ids_from_netkeiba
-# except ImportError:
-#     print("Error: Could not import 'get_race_ids_for_year' from get_race_ids.py.")
-#     print("Please ensure get_race_ids.py exists and contains the function.")
-#     # 依存関係が解決できない場合は、ダミー関数を定義してクラッシュを防ぐ
-#     def fetch_race_ids_from_netkeiba(year):
-#         return []
+        if own_conn:
+            conn.close()
 
 def get_existing_race_ids(year):
     """指定した年の既に保存されているレースIDのセットを返す"""
@@ -299,6 +357,80 @@ def construct_jbis_url(race_id, date_str):
     
     return f"{BASE_URL}{date_yyyymmdd}/{venue_code_jbis}/{race_num:02d}/"
 
+def read_race_ids_csv(year):
+    """get_race_ids.pyが出力したCSVから (race_id, 日付) のリストを読み込む"""
+    csv_file_path = race_csv_path(year)
+    with open(csv_file_path, 'r', encoding='utf-8', newline='') as f:
+        return [(row[0].strip(), row[1].strip()) for row in csv.reader(f) if len(row) >= 2]
+
+def race_csv_path(year):
+    """指定した年のレースID一覧CSVのパス"""
+    return f"./scraping/race_csv/race_ids_{year}.csv"
+
+def fetch_race(race_id, date_str):
+    """1レース分の結果を取得・解析する (DBには保存しない)
+
+    成功した場合は (race_info, results, jockeys, trainers) を、失敗した場合はNoneを返す。
+    """
+    url = construct_jbis_url(race_id, date_str)
+    if not url:
+        print(f"Could not construct URL for race_id {race_id}. Skipping.")
+        return None
+
+    page = get_html_from_jbis_url(url)
+    if not page:
+        print(f"Failed to get HTML for {race_id} from {url}. Skipping.")
+        return None
+
+    with metrics.stage('parse'):
+        soup = make_soup(page, profile='race')
+    try:
+        with metrics.stage('extract'):
+            race_info = parse_race_info(soup, race_id)
+            results, jockeys, trainers = parse_race_results(soup, race_id) if race_info else ([], [], [])
+            if race_info:
+                race_info['laps'] = encode_laps(parse_lap_times(soup))
+    finally:
+        soup.decompose()
+    if not race_info:
+        print(f"Failed to parse race info for {race_id}. Skipping.")
+        metrics.fail('parse_error')
+        return None
+
+    # --- netkeibaから取得した情報をrace_infoにマージ ---
+    # netkeibaのrace_idから情報を抽出
+    race_round = int(race_id[10:12])
+    # venueは別途変換が必要
+    venue_map_nk_to_name = {
+        '01': '札幌', '02': '函館', '03': '福島', '04': '新潟', '05': '東京',
+        '06': '中山', '07': '中京', '08': '京都', '09': '阪神', '10': '小倉'
+    }
+    race_info['date'] = date_str
+    race_info['race_round'] = race_round
+    race_info['venue'] = venue_map_nk_to_name.get(race_id[4:6], 'Unknown')
+
+    if not results:
+        print(f"No results found for {race_id}. Skipping.")
+        metrics.fail('parse_error')
+        return None
+
+    return race_info, results, jockeys, trainers
+
+def scrape_race(race_id, date_str):
+    """1レース分の結果を取得・解析してDBに保存する
+
+    保存できた場合は (results, jockeys, trainers) を、失敗した場合はNoneを返す。
+    """
+    fetched = fetch_race(race_id, date_str)
+    if not fetched:
+        return None
+    race_info, results, jockeys, trainers = fetched
+
+    with metrics.stage('db_write'):
+        save_to_db(race_info, results, jockeys, trainers)
+    metrics.item('race')
+    return results, jockeys, trainers
+
 def scrape_year(year):
     """指定した年の全レースをスクレイピングする"""
     print(f"Starting scrape for year {year}...")
@@ -307,18 +439,9 @@ def scrape_year(year):
     existing_ids = get_existing_race_ids(year)
     print(f"Found {len(existing_ids)} existing races in DB. These will be skipped.")
 
-    # # get_race_ids.pyからレースIDと日付のタプルリストを取得
-    # race_id_date_pairs = fetch_race_ids_from_netkeiba(year)
-    # if not race_id_date_pairs:
-    #     print("No race IDs found to scrape.")
-    #     return
-
     # csvからレースIDと日付のダブルリストを取得する
     try:
-        csv_file_path = f"./scraping/race_csv/race_ids_{year}.csv"
-        with open(csv_file_path, 'r', encoding='utf-8') as f:
-            df = pd.read_csv(f, header=None, names=['race_id', 'date'], dtype={'race_id': str})
-            race_id_date_pairs = list(zip(df['race_id'], df['date']))
+        race_id_date_pairs = read_race_ids_csv(year)
     except Exception as e:
         print(f"Error reading CSV file: {e}")
         return  
@@ -335,88 +458,15 @@ def scrape_year(year):
 
     for race_id, date_str in tqdm(races_to_process, desc=f"Scraping races for {year}"):
         try:
-            url = construct_jbis_url(race_id, date_str)
-            if not url:
-                print(f"Could not construct URL for race_id {race_id}. Skipping.")
-                continue
-
-            html = get_html_from_jbis_url(url)
-            if not html:
-                print(f"Failed to get HTML for {race_id} from {url}. Skipping.")
-                continue
-
-            soup = BeautifulSoup(html, 'lxml')
-            race_info = parse_race_info(soup, race_id)
-            if not race_info:
-                print(f"Failed to parse race info for {race_id}. Skipping.")
-                continue
-
-            # --- netkeibaから取得した情報をrace_infoにマージ ---
-            # netkeibaのrace_idから情報を抽出
-            race_round = int(race_id[10:12])
-            # venueは別途変換が必要
-            venue_map_nk_to_name = {
-                '01': '札幌', '02': '函館', '03': '福島', '04': '新潟', '05': '東京',
-                '06': '中山', '07': '中京', '08': '京都', '09': '阪神', '10': '小倉'
-            }
-            race_info['date'] = date_str
-            race_info['race_round'] = race_round
-            race_info['venue'] = venue_map_nk_to_name.get(race_id[4:6], 'Unknown')
-
-            results, jockeys, trainers = parse_race_results(soup, race_id)
-            if not results:
-                print(f"No results found for {race_id}. Skipping.")
-                continue
-
-            save_to_db(race_info, results, jockeys, trainers)
-            time.sleep(1) # サーバーへの負荷を軽減するための待機
-
+            scrape_race(race_id, date_str)
         except Exception as e:
             print(f"An unexpected error occurred for race {race_id}: {e}")
+            metrics.fail('exception')
             traceback.print_exc()
 
-# if __name__ == "__main__":
-#     parser = argparse.ArgumentParser(description='Scrape race data from netkeiba')
-#     parser.add_argument('year', type=int, help='Year to scrape (e.g., 2023)')
-#     args = parser.parse_args()
-
-#     scrape_year(args.year)
-#     print("No new races to process.")
-
-
-#     for race_id, date_str in tqdm(race_id_date_pairs, desc=f"Scraping races for {year}"):
-#         try:
-#             url = construct_jbis_url(race_id, date_str)
-#             if not url:
-#                 print(f"Could not construct URL for race_id {race_id}. Skipping.")
-#                 continue
-
-#             html = get_html_from_jbis_url(url)
-#             if not html:
-#                 print(f"Failed to get HTML for {race_id} from {url}. Skipping.")
-#                 continue
-
-#             soup = BeautifulSoup(html, 'lxml')
-#             race_info = parse_race_info(soup, race_id)
-#             if not race_info:
-#                 print(f"Failed to parse race info for {race_id}. Skipping.")
-#                 continue
-
-#             results, jockeys, trainers = parse_race_results(soup, race_id)
-#             if not results:
-#                 print(f"No results found for {race_id}. Skipping.")
-#                 continue
-
-#             save_to_db(race_info, results, jockeys, trainers)
-#             time.sleep(1) # サーバーへの負荷を軽減するための待機
-
-#         except Exception as e:
-#             print(f"An unexpected error occurred for race {race_id}: {e}")
-#             traceback.print_exc()
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Scrape race data from netkeiba')
     parser.add_argument('year', type=int, help='Year to scrape (e.g., 2023)')
     args = parser.parse_args()
 
-    scrape_year(args.year)
\ No newline at end of file
+    scrape_year(args.year)
@@ -0,0 +1,251 @@
+import os
+import sqlite3
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DB_PATH = os.getenv('DB_FILE_PATH')
+if not DB_PATH:
+    raise ValueError("DB_FILE_PATH is not set in .env file")
+
+# 単勝オッズは小数1桁のため10倍した整数で保存する
+ODDS_SCALE = 10
+# 発走後この秒数が過ぎたレースのスナップショットを圧縮対象とする
+COMPACT_AFTER_SECONDS = 24 * 60 * 60
+
+# --- 符号化 ---
+# 系列は「前の値との差分 → zigzag (符号を下位ビットへ) → 7ビットずつの可変長整数」で
+# BLOBにする。件数は別の列に持つため、BLOBには値のバイト列だけが並ぶ。
+
+def zigzag(values):
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+def unzigzag(values):
+    values = np.asarray(values, dtype=np.uint64)
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+def encode_varints(values):
+    """符号なし整数の配列を可変長整数のバイト列にする"""
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return b''
+    # 各値を7ビットずつに分け、必要なバイト数だけを取り出す
+    shifts = np.arange(0, 70, 7, dtype=np.uint64)
+    groups = (values[:, None] >> shifts[None, :]) & np.uint64(0x7f)
+    # 最上位の0でないグループまでを使う (値が0なら1バイト)
+    nonzero = groups != 0
+    lengths = np.where(nonzero.any(axis=1), 10 - np.argmax(nonzero[:, ::-1], axis=1), 1)
+    used = np.arange(10)[None, :] < lengths[:, None]
+    more = np.arange(10)[None, :] < (lengths - 1)[:, None]
+    encoded = (groups | np.where(more, np.uint64(0x80), np.uint64(0))).astype(np.uint8)
+    return encoded[used].tobytes()
+
+def decode_varints(buffer):
+    """可変長整数のバイト列を符号なし整数の配列に戻す"""
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    # バイトごとに所属する値の中での位置 (0, 1, 2, ...) を求める
+    value_index = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    position = np.arange(len(data)) - starts[value_index]
+    parts = (data & 0x7f).astype(np.uint64) << (np.uint64(7) * position.astype(np.uint64))
+    return np.add.reduceat(parts, starts)
+
+def encode_series(values):
+    """整数系列を差分・zigzag・可変長整数で符号化する"""
+    values = np.asarray(values, dtype=np.int64)
+    return encode_varints(zigzag(np.diff(values, prepend=0)))
+
+def decode_series(blobs, counts):
+    """複数の系列BLOBをまとめて復号し、(連結した値の配列, 各系列の開始位置) を返す
+
+    BLOBを連結して1回で可変長整数を読み、差分の累積和も全体で1回計算してから
+    系列の先頭ごとに補正する。系列iの値は values[offsets[i]:offsets[i + 1]]。
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    deltas = unzigzag(decode_varints(b''.join(blobs)))
+    if len(deltas) != offsets[-1]:
+        raise ValueError(f"series length mismatch: expected {offsets[-1]} values, got {len(deltas)}")
+    total = np.cumsum(deltas)
+    # 各系列の直前までの累積値を引いて、系列ごとの累積和にする
+    base = np.concatenate([[0], total])[offsets[:-1]]
+    return total - np.repeat(base, counts), offsets
+
+# --- 馬体重の履歴 ---
+
+def build_weight_series(db_path=DB_PATH, full=False):
+    """出走結果の馬体重・増減を馬ごとの系列にまとめて weight_series に保存する
+
+    出走数が保存済みの系列と異なる馬だけを作り直す (full=Trueで全頭)。
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        condition = '' if full else '''
+        WHERE hk.key NOT IN (
+            SELECT w.horse_key FROM weight_series w
+            JOIN horse_keys k ON k.key = w.horse_key
+            WHERE w.n = (SELECT COUNT(*) FROM results x WHERE x.horse_id = k.horse_id)
+        )'''
+        df = pd.read_sql_query(f'''
+        SELECT hk.key AS horse_key, ra.date, r.horse_weight, r.weight_diff
+        FROM results r
+        JOIN races ra ON ra.race_id = r.race_id
+        JOIN horse_keys hk ON hk.horse_id = r.horse_id
+        {condition}
+        ORDER BY hk.key, ra.date
+        ''', conn)
+        if df.empty:
+            print("Weight series are up to date.")
+            return 0
+
+        days = pd.to_datetime(df['date'], errors='coerce').to_numpy().astype('datetime64[D]').astype(np.int64)
+        # 日付・馬体重の欠損は0として保存する (馬体重0は計不などの欠損を表す)
+        days[pd.isna(df['date']).to_numpy()] = 0
+        weights = df['horse_weight'].fillna(0).to_numpy(np.int64)
+        diffs = df['weight_diff'].fillna(0).to_numpy(np.int64)
+        keys = df['horse_key'].to_numpy(np.int64)
+        starts = np.flatnonzero(np.diff(keys, prepend=-1))
+        ends = np.append(starts[1:], len(keys))
+
+        rows = [
+            (int(keys[s]), int(e - s), encode_series(days[s:e]), encode_series(weights[s:e]), encode_series(diffs[s:e]))
+            for s, e in zip(starts, ends)
+        ]
+        conn.executemany(
+            "INSERT OR REPLACE INTO weight_series (horse_key, n, days, weights, diffs) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.commit()
+        print(f"Built weight series for {len(rows)} horses ({len(df)} runs).")
+        return len(rows)
+    finally:
+        conn.close()
+
+def read_weight_series(db_path=DB_PATH, horse_keys=None):
+    """馬体重の系列をまとめて読み込む
+
+    (horse_keys, offsets, days, weights, diffs) を返す。馬iの値は
+    days[offsets[i]:offsets[i + 1]] のように取り出す。daysは1970-01-01からの日数。
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        if horse_keys is None:
+            rows = conn.execute("SELECT horse_key, n, days, weights, diffs FROM weight_series ORDER BY horse_key").fetchall()
+        else:
+            conn.execute("CREATE TEMP TABLE wanted_keys (key INTEGER PRIMARY KEY)")
+            conn.executemany("INSERT OR IGNORE INTO wanted_keys (key) VALUES (?)", [(int(k),) for k in horse_keys])
+            rows = conn.execute('''
+            SELECT w.horse_key, w.n, w.days, w.weights, w.diffs
+            FROM weight_series w JOIN wanted_keys k ON k.key = w.horse_key
+            ORDER BY w.horse_key
+            ''').fetchall()
+    finally:
+        conn.close()
+
+    keys = np.array([r[0] for r in rows], dtype=np.int64)
+    counts = [r[1] for r in rows]
+    days, offsets = decode_series([r[2] for r in rows], counts)
+    weights, _ = decode_series([r[3] for r in rows], counts)
+    diffs, _ = decode_series([r[4] for r in rows], counts)
+    return keys, offsets, days, weights, diffs
+
+# --- オッズの推移 ---
+
+def compact_odds(db_path=DB_PATH, older_than=COMPACT_AFTER_SECONDS):
+    """取得が終わったレースの odds_snapshots を馬ごとの系列にまとめて odds_series に移す
+
+    最後のスナップショットから older_than 秒以上たったレースが対象。既に系列が
+    ある場合は後ろにつなげる。移した行は odds_snapshots から削除する。
+    """
+    cutoff = int(time.time()) - older_than
+    conn = sqlite3.connect(db_path)
+    try:
+        df = pd.read_sql_query('''
+        SELECT s.race_id, s.horse_no, s.taken_at, s.odds, s.popularity, s.horse_weight, s.weight_diff
+        FROM odds_snapshots s
+        WHERE s.race_id IN (SELECT race_id FROM odds_snapshots GROUP BY race_id HAVING MAX(taken_at) < ?)
+        ORDER BY s.race_id, s.horse_no, s.taken_at
+        ''', conn, params=(cutoff,))
+        if df.empty:
+            print("No odds snapshots to compact.")
+            return 0
+
+        existing = {
+            (race_id, horse_no): (n, (times, odds, popularity), (horse_weight, weight_diff))
+            for race_id, horse_no, n, times, odds, popularity, horse_weight, weight_diff in conn.execute(
+                "SELECT race_id, horse_no, n, times, odds, popularity, horse_weight, weight_diff FROM odds_series WHERE race_id IN "
+                "(SELECT race_id FROM odds_snapshots GROUP BY race_id HAVING MAX(taken_at) < ?)", (cutoff,))
+        }
+
+        times = df['taken_at'].to_numpy(np.int64)
+        odds = np.rint(df['odds'].fillna(0).to_numpy(np.float64) * ODDS_SCALE).astype(np.int64)
+        popularity = df['popularity'].fillna(0).to_numpy(np.int64)
+        group = (df['race_id'] + ':' + df['horse_no'].astype(str)).to_numpy()
+        starts = np.flatnonzero(np.concatenate([[True], group[1:] != group[:-1]]))
+        ends = np.append(starts[1:], len(df))
+
+        rows = []
+        for s, e in zip(starts, ends):
+            race_id, horse_no = df['race_id'].iat[s], int(df['horse_no'].iat[s])
+            t, o, p = times[s:e], odds[s:e], popularity[s:e]
+            horse_weight, weight_diff = None, None
+            if (race_id, horse_no) in existing:
+                n, blobs, (horse_weight, weight_diff) = existing[(race_id, horse_no)]
+                t, o, p = [np.concatenate([decode_series([b], [n])[0], new]) for b, new in zip(blobs, (t, o, p))]
+                order = np.argsort(t, kind='stable')
+                t, o, p = t[order], o[order], p[order]
+            # 馬体重は系列にせず、最後に取得した値 (確定値) だけを残す
+            weight = df[['horse_weight', 'weight_diff']].iloc[s:e].dropna()
+            if len(weight):
+                horse_weight, weight_diff = int(weight.iat[-1, 0]), int(weight.iat[-1, 1])
+            rows.append((race_id, horse_no, len(t), encode_series(t), encode_series(o), encode_series(p),
+                         horse_weight, weight_diff))
+
+        conn.executemany('''
+        INSERT OR REPLACE INTO odds_series (race_id, horse_no, n, times, odds, popularity, horse_weight, weight_diff)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.execute('''
+        DELETE FROM odds_snapshots
+        WHERE race_id IN (SELECT race_id FROM odds_snapshots GROUP BY race_id HAVING MAX(taken_at) < ?)
+        ''', (cutoff,))
+        conn.commit()
+        print(f"Compacted {len(df)} snapshot rows into {len(rows)} series.")
+        return len(rows)
+    finally:
+        conn.close()
+
+def read_odds_series(race_id, db_path=DB_PATH):
+    """1レース分のオッズの推移を馬番ごとに {horse_no: (times, odds, popularity)} で返す"""
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT horse_no, n, times, odds, popularity FROM odds_series WHERE race_id = ? ORDER BY horse_no",
+            (race_id,)).fetchall()
+    finally:
+        conn.close()
+    counts = [r[1] for r in rows]
+    times, offsets = decode_series([r[2] for r in rows], counts)
+    odds, _ = decode_series([r[3] for r in rows], counts)
+    popularity, _ = decode_series([r[4] for r in rows], counts)
+    return {
+        horse_no: (times[offsets[i]:offsets[i + 1]], odds[offsets[i]:offsets[i + 1]] / ODDS_SCALE,
+                   popularity[offsets[i]:offsets[i + 1]])
+        for i, (horse_no, *_) in enumerate(rows)
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='馬体重の履歴とオッズの推移を差分符号化した系列として保存する')
+    parser.add_argument('--full', action='store_true', help='馬体重の系列を全頭作り直す')
+    parser.add_argument('--skip-odds', action='store_true', help='オッズのスナップショットを圧縮しない')
+    args = parser.parse_args()
+
+    build_weight_series(full=args.full)
+    if not args.skip_odds:
+        compact_odds()
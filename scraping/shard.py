@@ -0,0 +1,360 @@
+import os
+import time
+import queue
+import sqlite3
+import argparse
+import secrets
+import threading
+import traceback
+from multiprocessing.connection import Listener, Client
+from dotenv import load_dotenv
+from metrics import metrics
+from politeness import scheduler
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DB_PATH = os.getenv('DB_FILE_PATH')
+if not DB_PATH:
+    raise ValueError("DB_FILE_PATH is not set in .env file")
+
+# 書き込みプロセスの待受アドレス
+SHARD_HOST = os.getenv('SHARD_HOST', '127.0.0.1')
+SHARD_PORT = int(os.getenv('SHARD_PORT', '6543'))
+# 認証キー。接続を受けたオブジェクトはpickleで復元するため、推測できる既定値は持たない。
+# 未設定なら書き込みプロセスが keiba.db と同じ場所にランダムなキーのファイルを作り、
+# ワーカーは共有のファイルシステム上のそのファイルを読む
+SHARD_AUTHKEY = os.getenv('SHARD_AUTHKEY')
+SHARD_AUTHKEY_PATH = os.getenv('SHARD_AUTHKEY_PATH') or os.path.splitext(DB_PATH)[0] + '.shard_key'
+
+KIND_RACE = 'race'
+KIND_HORSE = 'horse'
+
+# 1回に貸し出す件数と、完了報告がない場合に再貸し出しするまでの秒数
+LEASE_SIZE = 20
+LEASE_SECONDS = 900
+# 貸し出し前に読み込んでおくレースの件数
+RACE_BUFFER = LEASE_SIZE * 10
+# 取得対象が上流から届くのを待つ間隔(秒)
+WAIT_SECONDS = 5
+
+# 貸し出せる範囲はないが、上流の処理や期限切れの再貸し出しを待つ場合の応答
+WAIT = 'wait'
+
+def load_authkey(create=False):
+    """認証キーを返す (SHARD_AUTHKEY、なければキーファイル)
+
+    create=True (書き込みプロセス) でファイルがなければ、所有者だけが読める権限で作る。
+    """
+    if SHARD_AUTHKEY:
+        return SHARD_AUTHKEY.encode()
+    if create and not os.path.exists(SHARD_AUTHKEY_PATH):
+        fd = os.open(SHARD_AUTHKEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        print(f"Created shard auth key: {SHARD_AUTHKEY_PATH}")
+    if not os.path.exists(SHARD_AUTHKEY_PATH):
+        raise ValueError(f"SHARD_AUTHKEY is not set and {SHARD_AUTHKEY_PATH} does not exist (start the writer first)")
+    with open(SHARD_AUTHKEY_PATH) as f:
+        key = f.read().strip()
+    if not key:
+        raise ValueError(f"{SHARD_AUTHKEY_PATH} is empty")
+    return key.encode()
+
+class Lease:
+    def __init__(self, lease_id, kind, items, expires_at):
+        self.lease_id = lease_id
+        self.kind = kind
+        self.items = items
+        self.expires_at = expires_at
+
+class Coordinator:
+    """IDの範囲をワーカーに貸し出し、送られてきた行をDBに書き込む
+
+    DBへの書き込みはこのプロセスの1接続だけで行うため、ワーカーを増やしても
+    SQLiteのロック競合は起きない。レースはCSVのID順、馬はscrape_queueのキー順に
+    LEASE_SIZE件ずつの重ならない範囲として貸し出す。完了報告がないまま期限が
+    切れた範囲、または接続が切れたワーカーの範囲は別のワーカーに貸し直す。
+    レースIDの列挙 (CSVがなければカレンダーの取得) は別スレッドで進め、
+    lock を持ったまま待たないようにする。
+    """
+
+    def __init__(self, db_path, years):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.active = {}
+        self.leased_horses = set()
+        self.horse_cursor = ''
+        self.races = queue.Queue(maxsize=RACE_BUFFER)
+        self.races_exhausted = not years
+        if years:
+            threading.Thread(target=self._produce_races, args=(years,), daemon=True).start()
+        self.saved = {KIND_RACE: 0, KIND_HORSE: 0}
+        self.connections = 0
+
+    def _produce_races(self, years):
+        """レースIDを列挙してキューに入れ、最後にNoneを入れる"""
+        from backfill import discover_races
+        try:
+            for race in discover_races(years):
+                self.races.put(race)
+        except Exception as e:
+            print(f"Failed to list races: {e}")
+            traceback.print_exc()
+        finally:
+            self.races.put(None)
+
+    def _next_races(self):
+        """列挙済みのレースだけを取り出す (列挙を待たない)"""
+        items = []
+        while not self.races_exhausted and len(items) < LEASE_SIZE:
+            try:
+                race = self.races.get_nowait()
+            except queue.Empty:
+                break
+            if race is None:
+                self.races_exhausted = True
+            else:
+                items.append(race)
+        return items
+
+    def _next_horses(self):
+        """取得待ちの馬をキー順に、まだ貸し出していないものから取り出す"""
+        items = []
+        wrapped = False
+        while len(items) < LEASE_SIZE:
+            rows = self.conn.execute(
+                "SELECT entity_id FROM scrape_queue WHERE task = 'horse' AND entity_id > ? ORDER BY entity_id LIMIT ?",
+                (self.horse_cursor, LEASE_SIZE)
+            ).fetchall()
+            if not rows:
+                # 末尾まで読んだら先頭に戻り、後から追加された馬を拾う
+                if wrapped or not self.horse_cursor:
+                    break
+                self.horse_cursor = ''
+                wrapped = True
+                continue
+            for (horse_id,) in rows:
+                if horse_id not in self.leased_horses and len(items) < LEASE_SIZE:
+                    items.append(horse_id)
+            self.horse_cursor = rows[-1][0] if len(items) < LEASE_SIZE else items[-1]
+        self.leased_horses.update(items)
+        return items
+
+    def lease(self, kind, worker, owned):
+        """次の範囲を貸し出す (なければWAITまたはNone)"""
+        with self.lock:
+            now = time.time()
+            for lease in self.active.values():
+                if lease.kind == kind and lease.expires_at < now:
+                    return self._grant(lease, worker, owned, now)
+
+            items = self._next_races() if kind == KIND_RACE else self._next_horses()
+            if items:
+                keys = [item[0] for item in items] if kind == KIND_RACE else items
+                cursor = self.conn.execute(
+                    "INSERT INTO shard_leases (kind, range_start, range_end, items, leased_at, expires_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (kind, min(keys), max(keys), len(items), now, now + LEASE_SECONDS)
+                )
+                lease = Lease(cursor.lastrowid, kind, items, now + LEASE_SECONDS)
+                self.active[lease.lease_id] = lease
+                return self._grant(lease, worker, owned, now)
+
+            if any(lease.kind == kind for lease in self.active.values()):
+                return WAIT
+            # レースIDの列挙が終わっていなければ待たせる
+            if kind == KIND_RACE and not self.races_exhausted:
+                return WAIT
+            # 馬はレースの書き込みで追加されるため、レースが残っている間は待たせる
+            if kind == KIND_HORSE and not (self.races_exhausted and not any(
+                    lease.kind == KIND_RACE for lease in self.active.values())):
+                return WAIT
+            return None
+
+    def _grant(self, lease, worker, owned, now):
+        lease.expires_at = now + LEASE_SECONDS
+        self.conn.execute(
+            "UPDATE shard_leases SET worker = ?, expires_at = ? WHERE lease_id = ?",
+            (worker, lease.expires_at, lease.lease_id)
+        )
+        self.conn.commit()
+        owned.add(lease.lease_id)
+        return lease.lease_id, lease.items
+
+    def complete(self, lease_id, owned):
+        with self.lock:
+            self.active.pop(lease_id, None)
+            owned.discard(lease_id)
+            self.conn.execute("UPDATE shard_leases SET done_at = ? WHERE lease_id = ?", (time.time(), lease_id))
+            self.conn.commit()
+
+    def release(self, owned):
+        """接続が切れたワーカーの範囲をすぐに貸し直せるようにする"""
+        with self.lock:
+            for lease_id in owned:
+                if lease_id in self.active:
+                    self.active[lease_id].expires_at = 0
+            owned.clear()
+
+    def save_race(self, race_info, results, jockeys, trainers):
+        import scraper_race
+        with self.lock, metrics.stage('db_write'):
+            scraper_race.save_to_db(race_info, results, jockeys, trainers, conn=self.conn)
+            self.saved[KIND_RACE] += 1
+
+    def save_horse(self, horse_data, owner_data, breeder_data, pedigree_list):
+        import scraper_horse
+        with self.lock, metrics.stage('db_write'):
+            scraper_horse.save_horse_to_db(horse_data, owner_data, breeder_data, pedigree_list, conn=self.conn)
+            self.saved[KIND_HORSE] += 1
+
+    def idle(self):
+        with self.lock:
+            return self.races_exhausted and not self.active and self.connections == 0
+
+    def serve_connection(self, conn):
+        owned = set()
+        with self.lock:
+            self.connections += 1
+        try:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    break
+                op = message[0]
+                if op == 'lease':
+                    conn.send(self.lease(message[1], message[2], owned))
+                elif op == KIND_RACE:
+                    self.save_race(*message[1])
+                elif op == KIND_HORSE:
+                    self.save_horse(*message[1])
+                elif op == 'done':
+                    self.complete(message[1], owned)
+        except Exception as e:
+            print(f"Writer error: {e}")
+            traceback.print_exc()
+        finally:
+            self.release(owned)
+            with self.lock:
+                self.connections -= 1
+            conn.close()
+
+def run_writer(years, host=SHARD_HOST, port=SHARD_PORT, exit_when_idle=True):
+    """単一の書き込みプロセスを起動し、ワーカーからの貸し出し要求と行を受け付ける"""
+    import initialize_db
+    initialize_db.create_tables()
+
+    authkey = load_authkey(create=True)
+    coordinator = Coordinator(DB_PATH, years)
+    listener = Listener((host, port), authkey=authkey)
+    print(f"Shard writer listening on {host}:{port}")
+    stop = threading.Event()
+
+    def monitor():
+        started = False
+        ticks = 0
+        while not stop.wait(WAIT_SECONDS):
+            ticks += 1
+            with coordinator.lock:
+                started = started or coordinator.connections > 0
+                if ticks % 6 == 0:
+                    print(f"races saved={coordinator.saved[KIND_RACE]} horses saved={coordinator.saved[KIND_HORSE]} "
+                          f"active leases={len(coordinator.active)} workers={coordinator.connections}")
+            # ワーカーが一度接続し、全員が終了して貸し出し中の範囲もなくなったら止める
+            if exit_when_idle and started and coordinator.idle():
+                stop.set()
+                # 待受中のacceptを自分への接続で起こす
+                Client((host, port), authkey=authkey).close()
+                return
+
+    threading.Thread(target=monitor, daemon=True).start()
+    try:
+        while True:
+            conn = listener.accept()
+            if stop.is_set():
+                conn.close()
+                break
+            threading.Thread(target=coordinator.serve_connection, args=(conn,), daemon=True).start()
+    except KeyboardInterrupt:
+        print("Stopping writer...")
+    finally:
+        stop.set()
+        listener.close()
+        coordinator.conn.close()
+    print(f"Writer finished: races={coordinator.saved[KIND_RACE]} horses={coordinator.saved[KIND_HORSE]}")
+
+def _race_loop(client, lease_id, items):
+    import scraper_race
+    for race_id, date_str in items:
+        fetched = scraper_race.fetch_race(race_id, date_str)
+        if fetched:
+            client.send((KIND_RACE, fetched))
+            metrics.item('race')
+
+def _horse_loop(client, lease_id, items):
+    import scraper_horse
+    from http_fetch import prefetched
+    for horse_id, (profile_page, pedigree_page) in prefetched(items, scraper_horse.horse_page_urls, scraper_horse.PREFETCH_HORSES):
+        parsed = scraper_horse.parse_horse_pages(horse_id, profile_page, pedigree_page)
+        if parsed:
+            client.send((KIND_HORSE, parsed))
+            metrics.item('horse')
+
+def worker_loop(kind, host=SHARD_HOST, port=SHARD_PORT, name=None):
+    """範囲を借りて取得・解析し、行を書き込みプロセスへ送ることを繰り返す"""
+    name = name or f"{os.getpid()}-{threading.get_ident()}"
+    process = _race_loop if kind == KIND_RACE else _horse_loop
+    client = Client((host, port), authkey=load_authkey())
+    try:
+        while True:
+            client.send(('lease', kind, name))
+            lease = client.recv()
+            if lease is None:
+                return
+            if lease == WAIT:
+                time.sleep(WAIT_SECONDS)
+                continue
+            lease_id, items = lease
+            print(f"[{name}] {kind} lease {lease_id}: {len(items)} items")
+            process(client, lease_id, items)
+            client.send(('done', lease_id))
+    finally:
+        client.close()
+
+def run_workers(kind, threads=1, share=1, host=SHARD_HOST, port=SHARD_PORT):
+    """1プロセス内でthreads本のワーカーを動かす
+
+    share は同じホストを取得するワーカープロセスの総数で、リクエスト間隔を
+    その倍数に広げてプロセス全体での負荷を単一プロセスと同程度に保つ。
+    """
+    if share > 1:
+        scheduler.share(share)
+    workers = [
+        threading.Thread(target=worker_loop, args=(kind, host, port, f"{os.getpid()}-{kind}-{i}"))
+        for i in range(threads)
+    ]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='複数プロセスでレース・馬を分担して取得する')
+    parser.add_argument('--host', default=SHARD_HOST, help='書き込みプロセスのアドレス')
+    parser.add_argument('--port', type=int, default=SHARD_PORT, help='書き込みプロセスのポート')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    writer_parser = subparsers.add_parser('writer', help='貸し出しとDB書き込みを行うプロセスを起動する')
+    writer_parser.add_argument('years', type=int, nargs='*', help='レースを取得する年 (省略時は馬のみ)')
+    writer_parser.add_argument('--keep-running', action='store_true', help='ワーカーが全員終了しても待ち受けを続ける')
+
+    worker_parser = subparsers.add_parser('worker', help='範囲を借りて取得するワーカーを起動する')
+    worker_parser.add_argument('kind', choices=[KIND_RACE, KIND_HORSE], help='取得対象')
+    worker_parser.add_argument('--threads', type=int, default=1, help='このプロセス内のワーカー数')
+    worker_parser.add_argument('--share', type=int, default=1, help='同じサイトを取得するワーカープロセスの総数')
+    args = parser.parse_args()
+
+    if args.command == 'writer':
+        run_writer(args.years, args.host, args.port, not args.keep_running)
+    else:
+        run_workers(args.kind, args.threads, args.share, args.host, args.port)
@@ -0,0 +1,97 @@
+import os
+import time
+import sqlite3
+import pathlib
+import argparse
+import datetime
+from dotenv import load_dotenv
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DB_PATH = os.getenv('DB_FILE_PATH')
+if not DB_PATH:
+    raise ValueError("DB_FILE_PATH is not set in .env file")
+
+# 分析用の読み取り専用コピー (既定は keiba.db と同じ場所の keiba.snapshot.db)
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_FILE_PATH') or os.path.splitext(DB_PATH)[0] + '.snapshot.db'
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', '3600'))
+
+# 読み取り専用接続の設定 (mmapで読み、ページキャッシュを大きめに取る)
+READ_MMAP_SIZE = int(os.getenv('READ_MMAP_SIZE', str(1024 * 1024 * 1024)))
+READ_CACHE_KB = int(os.getenv('READ_CACHE_KB', str(256 * 1024)))
+
+def _uri(path, **params):
+    query = '&'.join(f'{k}={v}' for k, v in params.items())
+    return f"{pathlib.Path(path).resolve().as_uri()}?{query}"
+
+def take_snapshot(db_path=DB_PATH, snapshot_path=SNAPSHOT_PATH):
+    """オンラインバックアップAPIで一貫したコピーを作り、既存のスナップショットと入れ替える
+
+    WALモードでは1回の読み取りトランザクションでコピーするため、書き込み側を
+    止めずにある時点のDB全体が得られる。一時ファイルに書いてから os.replace で
+    入れ替えるので、開いている読み手は古いファイルを最後まで読める。
+    """
+    started = time.monotonic()
+    tmp_path = f"{snapshot_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    source = sqlite3.connect(_uri(db_path, mode='ro'), uri=True)
+    target = sqlite3.connect(tmp_path)
+    try:
+        # ページを分けてコピーすると書き込みのたびに最初からやり直しになるため一括で行う
+        source.backup(target)
+        # 読み手がimmutableで開けるよう、WALを使わない単一ファイルにする
+        target.execute("PRAGMA journal_mode=DELETE")
+        target.execute("ANALYZE")
+        target.commit()
+    finally:
+        target.close()
+        source.close()
+
+    os.replace(tmp_path, snapshot_path)
+    size_mb = os.path.getsize(snapshot_path) / 1024 / 1024
+    print(f"[{datetime.datetime.now():%H:%M:%S}] Snapshot {snapshot_path} written ({size_mb:.1f} MB, {time.monotonic() - started:.1f}s).")
+    return snapshot_path
+
+def connect_readonly(path=None):
+    """分析用に読み取り専用で接続する
+
+    スナップショットがあればimmutableで開き (ロックも変更検知も行わない)、
+    なければ keiba.db 本体を mode=ro で開く。どちらも書き込みはできない。
+    """
+    if path is None:
+        path = SNAPSHOT_PATH if os.path.exists(SNAPSHOT_PATH) else DB_PATH
+    if os.path.abspath(path) == os.path.abspath(DB_PATH):
+        conn = sqlite3.connect(_uri(path, mode='ro'), uri=True)
+    else:
+        conn = sqlite3.connect(_uri(path, mode='ro', immutable=1), uri=True)
+    conn.execute(f"PRAGMA mmap_size={READ_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size={-READ_CACHE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA query_only=1")
+    return conn
+
+def run(interval=SNAPSHOT_INTERVAL, once=False, db_path=DB_PATH, snapshot_path=SNAPSHOT_PATH):
+    """interval秒ごとにスナップショットを作り直す"""
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                take_snapshot(db_path, snapshot_path)
+            except sqlite3.Error as e:
+                print(f"Snapshot failed: {e}")
+            if once:
+                break
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        print("Stopping snapshots...")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='keiba.db の分析用読み取り専用コピーを定期的に作る')
+    parser.add_argument('--interval', type=int, default=SNAPSHOT_INTERVAL, help='作り直す間隔(秒)')
+    parser.add_argument('--output', default=SNAPSHOT_PATH, help='スナップショットの保存先')
+    parser.add_argument('--once', action='store_true', help='1回だけ作って終了する')
+    args = parser.parse_args()
+
+    run(args.interval, args.once, snapshot_path=args.output)
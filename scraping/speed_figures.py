@@ -0,0 +1,190 @@
+import os
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+# .env読み込み
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DB_PATH = os.getenv('DB_FILE_PATH')
+if not DB_PATH:
+    raise ValueError("DB_FILE_PATH is not set in .env file")
+
+# 基準タイムの条件 (競馬場・芝ダ・距離・馬場状態)
+PAR_KEY = ['venue', 'course_type', 'distance', 'state']
+# 競馬場ごとの勝ちタイムが少ない条件は、全場をまとめた基準タイムを使う
+FALLBACK_KEY = ['course_type', 'distance', 'state']
+MIN_PAR_RACES = 5
+# 馬場差は同じ日・競馬場・芝ダのレースがこの数以上あるときだけ求める
+VARIANT_KEY = ['date', 'venue', 'course_type']
+MIN_VARIANT_RACES = 2
+
+# 基準タイムで勝った馬の指数
+BASE_FIGURE = 80.0
+# 1000mで1秒の差を何ポイントとするか (距離に反比例させ、長い距離ほど1秒の価値を小さくする)
+POINTS_PER_SECOND_1000M = 20.0
+
+def group_median(codes, values, n_groups):
+    """グループ番号ごとの中央値と件数を返す (件数0のグループはNaN)"""
+    order = np.lexsort((values, codes))
+    sorted_values = values[order]
+    counts = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    median = np.full(n_groups, np.nan)
+    has = counts > 0
+    lo = starts[has] + (counts[has] - 1) // 2
+    hi = starts[has] + counts[has] // 2
+    median[has] = (sorted_values[lo] + sorted_values[hi]) / 2
+    return median, counts
+
+def load_runs(conn):
+    """speed_figures にないレースを含む開催日 (日付・競馬場・芝ダ) の全出走を読み込む
+
+    馬場差はその日の全レースから求めるため、一部のレースだけが新しい日も
+    日ごと読み直す。is_new は基準タイムにまだ足していないレースかどうか。
+    """
+    return pd.read_sql_query('''
+    SELECT r.race_id, r.horse_id, r.rank, r.time_seconds,
+           ra.date, ra.venue, ra.course_type, ra.distance, ra.state,
+           NOT EXISTS (SELECT 1 FROM speed_figures f WHERE f.race_id = r.race_id) AS is_new
+    FROM results r
+    JOIN races ra ON ra.race_id = r.race_id
+    WHERE (ra.date, ra.venue, ra.course_type) IN (
+        SELECT x.date, x.venue, x.course_type FROM races x
+        WHERE EXISTS (SELECT 1 FROM results y WHERE y.race_id = x.race_id)
+          AND NOT EXISTS (SELECT 1 FROM speed_figures f WHERE f.race_id = x.race_id)
+    )
+    ''', conn)
+
+def winning_times(df):
+    """レースごとの勝ちタイム (同着は1行) を返す"""
+    winners = df[(df['rank'] == 1) & (df['time_seconds'] > 0)].dropna(subset=PAR_KEY)
+    return winners.drop_duplicates('race_id')
+
+def update_pars(conn, winners):
+    """新しいレースの勝ちタイムを条件ごとの件数・合計に足して speed_pars を更新する"""
+    if winners.empty:
+        return 0
+    codes = winners.groupby(PAR_KEY, sort=False).ngroup().to_numpy()
+    keys = winners[PAR_KEY].iloc[np.unique(codes, return_index=True)[1]].reset_index(drop=True)
+    added = keys.assign(
+        n=np.bincount(codes),
+        total_seconds=np.bincount(codes, weights=winners['time_seconds'].to_numpy(float)),
+    )
+    existing = pd.read_sql_query("SELECT * FROM speed_pars", conn)
+    merged = pd.concat([existing, added]).groupby(PAR_KEY, as_index=False)[['n', 'total_seconds']].sum()
+    conn.executemany('''
+    INSERT OR REPLACE INTO speed_pars (venue, course_type, distance, state, n, total_seconds)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ''', [
+        (row.venue, row.course_type, int(row.distance), row.state, int(row.n), float(row.total_seconds))
+        for row in merged.itertuples(index=False)
+    ])
+    return len(added)
+
+def par_times(conn, df):
+    """各出走の基準タイム (秒) を返す (件数の足りない条件は全場の値、それもなければNaN)"""
+    pars = pd.read_sql_query("SELECT * FROM speed_pars", conn)
+    local = pars[pars['n'] >= MIN_PAR_RACES]
+    local = local.assign(par=local['total_seconds'] / local['n'])[PAR_KEY + ['par']]
+    overall = pars.groupby(FALLBACK_KEY, as_index=False)[['n', 'total_seconds']].sum()
+    overall = overall[overall['n'] >= MIN_PAR_RACES]
+    overall = overall.assign(fallback=overall['total_seconds'] / overall['n'])[FALLBACK_KEY + ['fallback']]
+
+    keyed = df[PAR_KEY].merge(local, on=PAR_KEY, how='left').merge(overall, on=FALLBACK_KEY, how='left')
+    return keyed['par'].fillna(keyed['fallback']).to_numpy(float)
+
+def track_variants(df, par):
+    """開催日ごとの馬場差 (1000mあたりの秒数) を勝ちタイムと基準タイムの差の中央値で求める
+
+    (日ごとの表, 各出走の馬場差) を返す。レースが少ない日の馬場差は0とする。
+    """
+    codes = df.groupby(VARIANT_KEY, sort=False).ngroup().to_numpy()
+    n_groups = int(codes.max()) + 1 if len(codes) else 0
+    is_winner = (
+        (df['rank'] == 1).to_numpy() & (df['time_seconds'] > 0).to_numpy()
+        & ~df.duplicated(['race_id', 'rank']).to_numpy() & ~np.isnan(par)
+    )
+    distance = df['distance'].to_numpy(float)
+    deviation = (df['time_seconds'].to_numpy(float) - par) / distance * 1000
+    median, races = group_median(codes[is_winner], deviation[is_winner], n_groups)
+    variant = np.where(races >= MIN_VARIANT_RACES, median, 0.0)
+
+    first = np.unique(codes, return_index=True)[1]
+    days = df[VARIANT_KEY].iloc[first].reset_index(drop=True).assign(variant=variant, races=races)
+    return days, variant[codes]
+
+def compute_figures(df, par, variant):
+    """馬場差で補正した基準タイムとの差をポイントにする (タイム・基準タイムがない出走はNaN)"""
+    distance = df['distance'].to_numpy(float)
+    adjusted_par = par + variant * distance / 1000
+    time = df['time_seconds'].to_numpy(float)
+    figure = BASE_FIGURE + (adjusted_par - time) * POINTS_PER_SECOND_1000M * 1000 / distance
+    figure[~(time > 0)] = np.nan
+    return figure
+
+def build_figures(db_path=DB_PATH, full=False):
+    """スピード指数を計算して speed_figures に保存する
+
+    新しいレースの勝ちタイムを基準タイムに足し、それらを含む開催日の馬場差と
+    指数を計算し直す。それ以外の日の指数は、基準タイムが変わっても
+    計算し直さない (full=Trueで基準タイムから全て作り直す)。
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        if full:
+            for table in ('speed_pars', 'track_variants', 'speed_figures'):
+                conn.execute(f"DELETE FROM {table}")
+        df = load_runs(conn)
+        if df.empty:
+            print("Speed figures are up to date.")
+            return 0
+
+        winners = winning_times(df)
+        conditions = update_pars(conn, winners[winners['is_new'] == 1])
+        par = par_times(conn, df)
+        days, variant = track_variants(df, par)
+        figure = compute_figures(df, par, variant)
+
+        conn.executemany('''
+        INSERT OR REPLACE INTO track_variants (date, venue, course_type, variant, races)
+        VALUES (?, ?, ?, ?, ?)
+        ''', [
+            (row.date, row.venue, row.course_type, float(row.variant), int(row.races))
+            for row in days.dropna(subset=VARIANT_KEY).itertuples(index=False)
+        ])
+        conn.executemany('''
+        INSERT OR REPLACE INTO speed_figures (race_id, horse_id, par_seconds, figure)
+        VALUES (?, ?, ?, ?)
+        ''', [
+            (race_id, horse_id, None if np.isnan(p) else float(p), None if np.isnan(f) else round(float(f), 1))
+            for race_id, horse_id, p, f in zip(df['race_id'], df['horse_id'], par, figure)
+        ])
+        conn.commit()
+        print(f"Computed {np.count_nonzero(~np.isnan(figure))} figures for {df['race_id'].nunique()} races "
+              f"on {len(days)} race days ({conditions} par conditions updated).")
+        return len(df)
+    finally:
+        conn.close()
+
+def read_figures(db_path=DB_PATH):
+    """出走ごとのスピード指数を日付・JBISの指数と合わせて返す"""
+    conn = sqlite3.connect(db_path)
+    try:
+        return pd.read_sql_query('''
+        SELECT f.race_id, f.horse_id, ra.date, f.par_seconds, f.figure, r.speed_index
+        FROM speed_figures f
+        JOIN races ra ON ra.race_id = f.race_id
+        JOIN results r ON r.race_id = f.race_id AND r.horse_id = f.horse_id
+        ORDER BY ra.date, f.race_id
+        ''', conn)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='基準タイムと馬場差から出走ごとのスピード指数を計算する')
+    parser.add_argument('--full', action='store_true', help='基準タイムから全て作り直す')
+    args = parser.parse_args()
+
+    build_figures(full=args.full)
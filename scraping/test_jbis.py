@@ -1,12 +1,10 @@
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
 from webdriver_manager.chrome import ChromeDriverManager
+import os
 import time
 from bs4 import BeautifulSoup
-import re
 
 def get_driver():
     chrome_options = Options()
@@ -20,36 +18,22 @@ def get_driver():
     driver = webdriver.Chrome(service=service, options=chrome_options)
     return driver
 
-def search_jbis(driver, horse_name):
-    print(f"Searching Google for JBIS page of: {horse_name}")
-    
-    # Google検索で "site:jbis.or.jp {馬名}" を検索
-    driver.get("https://www.google.com/")
-    time.sleep(2)
-    
-    try:
-        # 検索ボックスを探す (name="q")
-        search_box = driver.find_element(By.NAME, "q")
-        search_box.send_keys(f"site:jbis.or.jp {horse_name}")
-        search_box.send_keys(Keys.RETURN)
-        time.sleep(3)
-        
-        print(f"Google Result Title: {driver.title}")
-        
-        # 検索結果のリンクを探す
-        # h3タグの親のaタグなどが一般的
-        links = driver.find_elements(By.TAG_NAME, "a")
-        for link in links:
-            href = link.get_attribute('href')
-            if href and 'jbis.or.jp/horse/' in href and 'pedigree' not in href:
-                # IDが含まれているか確認
-                if re.search(r'/horse/\d+/$', href):
-                    print(f"Found JBIS link via Google: {href}")
-                    return href
-                    
-    except Exception as e:
-        print(f"Error during Google search: {e}")
-        
+def search_jbis(horse_name):
+    print(f"Looking up JBIS page of: {horse_name}")
+
+    # Google検索の代わりに、horses から作った馬名の索引 (name_index.py) で引く
+    from name_index import NameIndex, build_index, NAME_INDEX_PATH
+    if not os.path.isdir(NAME_INDEX_PATH):
+        build_index()
+    index = NameIndex.load()
+    horse_id = index.lookup(horse_name)
+    if horse_id:
+        href = f"https://www.jbis.or.jp/horse/{horse_id}/"
+        print(f"Found JBIS link via name index: {href}")
+        return href
+    # 完全一致がなければ別の馬を取得しないよう、近い馬名は候補として表示するだけにする
+    for match_id, name, *_, distance in index.fuzzy(horse_name, max_distance=1, limit=5):
+        print(f"  Not found. Did you mean: {name} ({match_id}, distance {distance})")
     return None
 
 def get_pedigree_jbis(driver, horse_url):
@@ -84,16 +68,15 @@ def get_pedigree_jbis(driver, horse_url):
             print(f"TD {i}: {td.text.strip().replace(chr(10), '')}")
             
 if __name__ == "__main__":
-    driver = get_driver()
-    try:
-        # テスト馬: アンモシエラ
-        horse_name = "アンモシエラ"
-        horse_url = search_jbis(driver, horse_name)
-        
-        if horse_url:
+    # テスト馬: アンモシエラ
+    horse_name = "アンモシエラ"
+    horse_url = search_jbis(horse_name)
+
+    if horse_url:
+        driver = get_driver()
+        try:
             get_pedigree_jbis(driver, horse_url)
-        else:
-            print("Could not find horse on JBIS.")
-            
-    finally:
-        driver.quit()
+        finally:
+            driver.quit()
+    else:
+        print("Could not find horse on JBIS.")
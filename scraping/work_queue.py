@@ -0,0 +1,57 @@
+import sqlite3
+
+# scrape_queue のタスク種別
+TASK_HORSE = 'horse'
+TASK_PEDIGREE = 'pedigree'
+# 子孫の血統表から導出した (5代目が欠けている) 血統の補完
+TASK_PEDIGREE_DERIVED = 'pedigree_derived'
+TASK_JOCKEY = 'jockey'
+TASK_TRAINER = 'trainer'
+
+def count_tasks(db_path, task):
+    """取得待ちの件数を返す"""
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM scrape_queue WHERE task = ?", (task,)).fetchone()[0]
+    finally:
+        conn.close()
+
+def iter_tasks(db_path, task, batch_size=1000):
+    """取得待ちのIDをキー順に少しずつ読み出して返すジェネレータ
+
+    全件をリストにせず、主キー順にbatch_size件ずつ取得する。読み出しの合間は
+    接続を閉じるため、反復中に別の接続から書き込んでもロックで待たされない。
+    反復中に完了したIDはキューから削除されても問題なく、新たに追加された
+    IDも未読の範囲にあれば返される。
+    """
+    last_id = ''
+    while True:
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute(
+                "SELECT entity_id FROM scrape_queue WHERE task = ? AND entity_id > ? ORDER BY entity_id LIMIT ?",
+                (task, last_id, batch_size)
+            ).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return
+        for (entity_id,) in rows:
+            yield entity_id
+        last_id = rows[-1][0]
+
+def pending_ids(db_path, task, ids):
+    """idsのうち取得待ちのものを集合で返す"""
+    ids = list(ids)
+    if not ids:
+        return set()
+    conn = sqlite3.connect(db_path)
+    try:
+        placeholders = ','.join('?' * len(ids))
+        rows = conn.execute(
+            f"SELECT entity_id FROM scrape_queue WHERE task = ? AND entity_id IN ({placeholders})",
+            [task] + ids
+        ).fetchall()
+        return {row[0] for row in rows}
+    finally:
+        conn.close()